@@ -11,6 +11,7 @@ from inbox.models.session import session_scope
 from imaplib import IMAP4
 from inbox.sendmail.base import generate_attachments
 from inbox.sendmail.message import create_email
+from inbox.util.itert import chunk
 from inbox.util.misc import imap_folder_path
 
 log = get_logger()
@@ -21,15 +22,19 @@ __all__ = ['set_remote_starred', 'set_remote_unread', 'remote_move',
            'remote_save_draft', 'remote_delete_draft', 'remote_create_folder',
            'remote_update_folder', 'remote_delete_folder']
 
+# UIDs are sent to the server at most this many per command, to keep command
+# lines within the length servers accept.
+UID_CHUNK_SIZE = 500
+
 # STOPSHIP(emfree):
 # * should update local UID state here after action succeeds, instead of
 #   waiting for sync to pick it up
 # * should add support for rolling back message.categories() on failure.
 
 
-def uids_by_folder(message_id, db_session):
+def uids_by_folder(message_ids, db_session):
     results = db_session.query(ImapUid.msg_uid, Folder.name).join(Folder). \
-        filter(ImapUid.message_id == message_id).all()
+        filter(ImapUid.message_id.in_(message_ids)).all()
     mapping = defaultdict(list)
     for uid, folder_name in results:
         mapping[folder_name].append(uid)
@@ -55,44 +60,50 @@ def _create_email(account, message):
     return msg
 
 
-def _set_flag(crispin_client, account_id, message_id, flag_name,
+def _set_flag(crispin_client, account_id, message_ids, flag_name,
                           is_add):
     with session_scope(account_id) as db_session:
-        uids_for_message = uids_by_folder(message_id, db_session)
-    if not uids_for_message:
-        log.warning('No UIDs found for message', message_id=message_id)
+        uids_for_messages = uids_by_folder(message_ids, db_session)
+    if not uids_for_messages:
+        log.warning('No UIDs found for messages', message_ids=message_ids)
         return
 
-    for folder_name, uids in uids_for_message.items():
+    for folder_name, uids in uids_for_messages.items():
         crispin_client.select_folder_if_necessary(folder_name, uidvalidity_cb)
-        if is_add:
-            crispin_client.conn.add_flags(uids, [flag_name], silent=True)
-        else:
-            crispin_client.conn.remove_flags(uids, [flag_name], silent=True)
+        for uid_chunk in chunk(uids, UID_CHUNK_SIZE):
+            if is_add:
+                crispin_client.conn.add_flags(list(uid_chunk), [flag_name],
+                                              silent=True)
+            else:
+                crispin_client.conn.remove_flags(list(uid_chunk),
+                                                 [flag_name], silent=True)
 
 
-def set_remote_starred(crispin_client, account, message_id, starred):
-    _set_flag(crispin_client, account, message_id, '\\Flagged',
+def set_remote_starred(crispin_client, account, message_ids, starred):
+    _set_flag(crispin_client, account, message_ids, '\\Flagged',
                           starred)
 
 
-def set_remote_unread(crispin_client, account, message_id, unread):
-    _set_flag(crispin_client, account, message_id, '\\Seen',
+def set_remote_unread(crispin_client, account, message_ids, unread):
+    _set_flag(crispin_client, account, message_ids, '\\Seen',
                           not unread)
 
 
-def remote_move(crispin_client, account_id, message_id,
+def remote_move(crispin_client, account_id, message_ids,
                             destination):
     with session_scope(account_id) as db_session:
-        uids_for_message = uids_by_folder(message_id, db_session)
-    if not uids_for_message:
-        log.warning('No UIDs found for message', message_id=message_id)
+        uids_for_messages = uids_by_folder(message_ids, db_session)
+    if not uids_for_messages:
+        log.warning('No UIDs found for messages', message_ids=message_ids)
         return
 
-    for folder_name, uids in uids_for_message.items():
+    for folder_name, uids in uids_for_messages.items():
+        if folder_name == destination:
+            continue
         crispin_client.select_folder_if_necessary(folder_name, uidvalidity_cb)
-        crispin_client.conn.copy(uids, destination)
-        crispin_client.delete_uids(uids)
+        for uid_chunk in chunk(uids, UID_CHUNK_SIZE):
+            crispin_client.conn.copy(list(uid_chunk), destination)
+            crispin_client.delete_uids(list(uid_chunk))
 
 
 def remote_create_folder(crispin_client, account_id, category_id):
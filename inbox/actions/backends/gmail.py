@@ -1,10 +1,11 @@
 """ Operations for syncing back local datastore changes to Gmail. """
 
 import imapclient
-from inbox.actions.backends.generic import uids_by_folder
+from inbox.actions.backends.generic import uids_by_folder, UID_CHUNK_SIZE
 from inbox.mailsync.backends.imap.generic import uidvalidity_cb
 from inbox.models.category import Category
 from inbox.models.session import session_scope
+from inbox.util.itert import chunk
 from imaplib import IMAP4
 
 PROVIDER = 'gmail'
@@ -18,23 +19,20 @@ def _encode_labels(labels):
 
 def remote_change_labels(crispin_client, account_id, message_ids,
                          removed_labels, added_labels):
-    uids_for_message = {}
     with session_scope(account_id) as db_session:
-        for message_id in message_ids:
-            folder_uids_map = uids_by_folder(message_id, db_session)
-            for folder_name, uids in folder_uids_map.items():
-                if folder_name not in uids_for_message:
-                    uids_for_message[folder_name] = []
-                uids_for_message[folder_name].extend(uids)
-
-    for folder_name, uids in uids_for_message.items():
+        uids_for_messages = uids_by_folder(message_ids, db_session)
+
+    for folder_name, uids in uids_for_messages.items():
         crispin_client.select_folder_if_necessary(folder_name, uidvalidity_cb)
-        if len(added_labels) > 0:
-            crispin_client.conn.add_gmail_labels(
-                uids, _encode_labels(added_labels), silent=True)
-        if len(removed_labels) > 0:
-            crispin_client.conn.remove_gmail_labels(
-                uids, _encode_labels(removed_labels), silent=True)
+        for uid_chunk in chunk(uids, UID_CHUNK_SIZE):
+            if len(added_labels) > 0:
+                crispin_client.conn.add_gmail_labels(
+                    list(uid_chunk), _encode_labels(added_labels),
+                    silent=True)
+            if len(removed_labels) > 0:
+                crispin_client.conn.remove_gmail_labels(
+                    list(uid_chunk), _encode_labels(removed_labels),
+                    silent=True)
 
 
 def remote_create_label(crispin_client, account_id, category_id):
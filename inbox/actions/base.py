@@ -46,22 +46,23 @@ log = get_logger()
 
 
 def can_handle_multiple_records(action_name):
-    return action_name == 'change_labels'
+    return action_name in ('mark_unread', 'mark_starred', 'move',
+                           'change_labels')
 
 
-def mark_unread(crispin_client, account_id, message_id, args):
+def mark_unread(crispin_client, account_id, message_ids, args):
     unread = args['unread']
-    set_remote_unread(crispin_client, account_id, message_id, unread)
+    set_remote_unread(crispin_client, account_id, message_ids, unread)
 
 
-def mark_starred(crispin_client, account_id, message_id, args):
+def mark_starred(crispin_client, account_id, message_ids, args):
     starred = args['starred']
-    set_remote_starred(crispin_client, account_id, message_id, starred)
+    set_remote_starred(crispin_client, account_id, message_ids, starred)
 
 
-def move(crispin_client, account_id, message_id, args):
+def move(crispin_client, account_id, message_ids, args):
     destination = args['destination']
-    remote_move(crispin_client, account_id, message_id, destination)
+    remote_move(crispin_client, account_id, message_ids, destination)
 
 
 def change_labels(crispin_client, account_id, message_ids, args):
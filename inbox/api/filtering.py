@@ -1,12 +1,18 @@
+import arrow
 from sqlalchemy import and_, or_, desc, asc, func, bindparam
 from sqlalchemy.orm import subqueryload, contains_eager
 from inbox.api.err import InputError
+from inbox.api.pagination import after_page_token, make_page
 from inbox.api.validation import valid_public_id
 from inbox.models import (Contact, Event, Calendar, Message,
                           MessageContactAssociation, Thread,
                           Block, Part, MessageCategory, Category,
                           Metadata)
-from inbox.models.event import RecurringEvent
+from inbox.models.event import (RecurringEvent, RecurringEventOccurrence,
+                                InflatedEvent)
+from inbox.events.recurring import (update_occurrences, occurrence_horizon,
+                                    EXPAND_RECURRING_YEARS)
+from inbox.models.counter import get_count
 from inbox.sqlalchemy_ext.util import bakery
 from inbox.ignition import engine_manager
 from inbox.models.session import session_scope_by_shard_id
@@ -26,12 +32,24 @@ def contact_subquery(db_session, namespace_id, email_address, field):
 def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
             any_email, thread_public_id, started_before, started_after,
             last_message_before, last_message_after, filename, in_, unread,
-            starred, limit, offset, view, db_session):
+            starred, limit, offset, view, db_session, page_token=None):
 
     if view == 'count':
+        # Counts of a whole category, optionally restricted to unread or
+        # starred threads, are maintained and don't need to be computed.
+        if all(v is None for v in [subject, from_addr, to_addr, cc_addr,
+                                   bcc_addr, any_email, thread_public_id,
+                                   started_before, started_after,
+                                   last_message_before, last_message_after,
+                                   filename]):
+            count = get_count(db_session, namespace_id, 'thread', in_,
+                              unread, starred)
+            if count is not None:
+                return {"count": count}
         query = db_session.query(func.count(Thread.id))
     elif view == 'ids':
-        query = db_session.query(Thread.public_id)
+        query = db_session.query(Thread.public_id, Thread.recentdate,
+                                 Thread.id)
     else:
         query = db_session.query(Thread)
 
@@ -54,6 +72,10 @@ def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
     if subject is not None:
         filters.append(Thread.subject == subject)
 
+    if page_token is not None:
+        filters.append(after_page_token(Thread.recentdate, Thread.id,
+                                        page_token))
+
     query = query.filter(*filters)
 
     if from_addr is not None:
@@ -129,15 +151,18 @@ def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
         expand = (view == 'expanded')
         query = query.options(*Thread.api_loading_options(expand))
 
-    query = query.order_by(desc(Thread.recentdate)).limit(limit)
+    query = query.order_by(desc(Thread.recentdate), desc(Thread.id)). \
+        limit(limit)
 
     if offset:
         query = query.offset(offset)
 
     if view == 'ids':
-        return [x[0] for x in query.all()]
+        return make_page(query.all(), limit, key=lambda x: (x[1], x[2]),
+                         value=lambda x: x[0])
 
-    return query.all()
+    return make_page(query.all(), limit,
+                     key=lambda t: (t.recentdate, t.id))
 
 
 def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
@@ -145,7 +170,7 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
                        started_before, started_after, last_message_before,
                        last_message_after, received_before, received_after,
                        filename, in_, unread, starred, limit, offset, view,
-                       db_session):
+                       db_session, page_token=None):
     # Warning: complexities ahead. This function sets up the query that gets
     # results for the /messages API. It loads from several tables, supports a
     # variety of views and filters, and is performance-critical for the API. As
@@ -181,11 +206,23 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
         'limit': limit,
         'offset': offset
     }
+    if page_token is not None:
+        param_dict['page_sort_key'], param_dict['page_id'] = page_token
 
     if view == 'count':
+        if not drafts and all(v is None for v in [
+                subject, from_addr, to_addr, cc_addr, bcc_addr, any_email,
+                thread_public_id, started_before, started_after,
+                last_message_before, last_message_after, received_before,
+                received_after, filename]):
+            count = get_count(db_session, namespace_id, 'message', in_,
+                              unread, starred)
+            if count is not None:
+                return {"count": count}
         query = bakery(lambda s: s.query(func.count(Message.id)))
     elif view == 'ids':
-        query = bakery(lambda s: s.query(Message.public_id))
+        query = bakery(lambda s: s.query(Message.public_id,
+                                         Message.received_date, Message.id))
     else:
         query = bakery(lambda s: s.query(Message))
 
@@ -335,14 +372,21 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
         res = query(db_session).params(**param_dict).one()[0]
         return {"count": res}
 
-    query += lambda q: q.order_by(desc(Message.received_date))
+    if page_token is not None:
+        query += lambda q: q.filter(after_page_token(
+            Message.received_date, Message.id, (bindparam('page_sort_key'),
+                                                bindparam('page_id'))))
+
+    query += lambda q: q.order_by(desc(Message.received_date),
+                                  desc(Message.id))
     query += lambda q: q.limit(bindparam('limit'))
     if offset:
         query += lambda q: q.offset(bindparam('offset'))
 
     if view == 'ids':
         res = query(db_session).params(**param_dict).all()
-        return [x[0] for x in res]
+        return make_page(res, limit, key=lambda x: (x[1], x[2]),
+                         value=lambda x: x[0])
 
     # Eager-load related attributes to make constructing API representations
     # faster. Note that we don't use the options defined by
@@ -355,16 +399,17 @@ def messages_or_drafts(namespace_id, drafts, subject, from_addr, to_addr,
         subqueryload(Message.events))
 
     prepared = query(db_session).params(**param_dict)
-    return prepared.all()
+    return make_page(prepared.all(), limit,
+                     key=lambda m: (m.received_date, m.id))
 
 
 def files(namespace_id, message_public_id, filename, content_type,
-          limit, offset, view, db_session):
+          limit, offset, view, db_session, page_token=None):
 
     if view == 'count':
         query = db_session.query(func.count(Block.id))
     elif view == 'ids':
-        query = db_session.query(Block.public_id)
+        query = db_session.query(Block.public_id, Block.id)
     else:
         query = db_session.query(Block)
 
@@ -383,6 +428,10 @@ def files(namespace_id, message_public_id, filename, content_type,
     if filename is not None:
         query = query.filter(Block.filename == filename)
 
+    if page_token is not None:
+        query = query.filter(after_page_token(None, Block.id, page_token,
+                                              descending=False))
+
     # Handle the case of fetching attachments on a particular message.
     if message_public_id is not None:
         query = query.join(Message) \
@@ -397,9 +446,10 @@ def files(namespace_id, message_public_id, filename, content_type,
         query = query.offset(offset)
 
     if view == 'ids':
-        return [x[0] for x in query.all()]
+        return make_page(query.all(), limit, key=lambda x: (None, x[1]),
+                         value=lambda x: x[0])
     else:
-        return query.all()
+        return make_page(query.all(), limit, key=lambda b: (None, b.id))
 
 
 def filter_event_query(query, event_cls, namespace_id, event_public_id,
@@ -477,10 +527,77 @@ def recurring_events(filters, starts_before, starts_after, ends_before,
     return recur_instances
 
 
+def recurring_event_occurrences(filters, starts_before, starts_after,
+                                ends_before, ends_after, until, db_session,
+                                show_cancelled=False):
+    # Like recurring_events, but returns a query for the instances'
+    # RecurringEventOccurrences, generating them first if necessary. `until`
+    # is the latest start time to consider.
+    recur_query = db_session.query(RecurringEvent)
+    recur_query = filter_event_query(recur_query, RecurringEvent, *filters)
+
+    if show_cancelled is False:
+        recur_query = recur_query.filter(RecurringEvent.status != 'cancelled')
+
+    update_occurrences(db_session, recur_query, until)
+
+    # Instances are expanded inclusively of the requested range,
+    # see events/recurring.py.
+    occurrence_criteria = [
+        RecurringEventOccurrence.namespace_id == filters[0],
+        RecurringEventOccurrence.start <= until]
+    if starts_before:
+        occurrence_criteria.append(
+            RecurringEventOccurrence.start <= starts_before)
+    if starts_after:
+        occurrence_criteria.append(
+            RecurringEventOccurrence.start >= starts_after)
+    if ends_before:
+        occurrence_criteria.append(
+            RecurringEventOccurrence.end <= ends_before)
+    if ends_after:
+        occurrence_criteria.append(RecurringEventOccurrence.end >= ends_after)
+
+    return recur_query.join(
+        RecurringEventOccurrence,
+        RecurringEventOccurrence.master_event_id == RecurringEvent.id). \
+        filter(*occurrence_criteria).with_entities(RecurringEventOccurrence)
+
+
+def _inflate_occurrences(events, db_session):
+    # Replace the RecurringEventOccurrences in a list of events by the
+    # overrides or InflatedEvents they stand for.
+    occurrences = [e for e in events
+                   if isinstance(e, RecurringEventOccurrence)]
+    master_ids = {o.master_event_id for o in occurrences
+                  if o.override_id is None}
+    override_ids = {o.override_id for o in occurrences
+                    if o.override_id is not None}
+    masters = overrides = {}
+    if master_ids:
+        masters = {e.id: e for e in db_session.query(RecurringEvent).filter(
+            RecurringEvent.id.in_(master_ids))}
+    if override_ids:
+        overrides = {e.id: e for e in db_session.query(Event).filter(
+            Event.id.in_(override_ids))}
+
+    def inflate(e):
+        if not isinstance(e, RecurringEventOccurrence):
+            return e
+        if e.override_id is not None:
+            return overrides[e.override_id]
+        return InflatedEvent(masters[e.master_event_id], e.start)
+
+    return [inflate(e) for e in events]
+
+
 def events(namespace_id, event_public_id, calendar_public_id, title,
            description, location, busy, starts_before, starts_after,
            ends_before, ends_after, limit, offset, view,
-           expand_recurring, show_cancelled, db_session):
+           expand_recurring, show_cancelled, db_session, page_token=None):
+
+    if expand_recurring and page_token is not None:
+        raise InputError('page_token is not supported with expand_recurring.')
 
     query = db_session.query(Event)
 
@@ -488,7 +605,7 @@ def events(namespace_id, event_public_id, calendar_public_id, title,
         if view == 'count':
             query = db_session.query(func.count(Event.id))
         elif view == 'ids':
-            query = db_session.query(Event.public_id)
+            query = db_session.query(Event.public_id, Event.start, Event.id)
 
     filters = [namespace_id, event_public_id, calendar_public_id,
                title, description, location, busy]
@@ -522,29 +639,68 @@ def events(namespace_id, event_public_id, calendar_public_id, title,
                 ((Event.status != 'cancelled') & (Event.discriminator !=
                                                   'recurringeventoverride')))
 
+    if page_token is not None:
+        event_criteria.append(after_page_token(Event.start, Event.id,
+                                               page_token, descending=False))
+
     event_predicate = and_(*event_criteria)
     query = query.filter(event_predicate)
 
     if expand_recurring:
-        expanded = recurring_events(filters, starts_before, starts_after,
-                                    ends_before, ends_after, db_session,
-                                    show_cancelled=show_cancelled)
+        # Instances are expanded up to now + EXPAND_RECURRING_YEARS by
+        # default (see events/recurring.py).
+        bounds = [arrow.get(b).to('utc').naive
+                  for b in (starts_before, ends_before) if b is not None]
+        until = min(bounds) if bounds else \
+            arrow.utcnow().replace(years=+EXPAND_RECURRING_YEARS).naive
+
+        if until <= occurrence_horizon():
+            # Filter, sort and paginate the materialized instances in SQL.
+            occurrences = recurring_event_occurrences(
+                filters, starts_before, starts_after, ends_before,
+                ends_after, until, db_session, show_cancelled=show_cancelled)
+            query = query.filter(Event.discriminator == 'event')
+
+            if view == 'count':
+                return {"count": query.count() + occurrences.count()}
+
+            query = query.order_by(asc(Event.start), asc(Event.id))
+            occurrences = occurrences.order_by(
+                asc(RecurringEventOccurrence.start),
+                asc(RecurringEventOccurrence.id))
+            offset = offset or 0
+            if limit:
+                # The page is made of the first offset + limit of either.
+                query = query.limit(offset + limit)
+                occurrences = occurrences.limit(offset + limit)
+            all_events = sorted(query.all() + occurrences.all(),
+                                key=lambda e: e.start)
+        else:
+            # Further ahead than instances are materialized, so expand
+            # them on the fly.
+            expanded = recurring_events(filters, starts_before, starts_after,
+                                        ends_before, ends_after, db_session,
+                                        show_cancelled=show_cancelled)
 
-        # Combine non-recurring events with expanded recurring ones
-        all_events = query.filter(Event.discriminator == 'event').all() + \
-            expanded
+            # Combine non-recurring events with expanded recurring ones
+            all_events = query.filter(Event.discriminator == 'event').all() \
+                + expanded
 
-        if view == 'count':
-            return {"count": len(all_events)}
+            if view == 'count':
+                return {"count": len(all_events)}
 
-        all_events = sorted(all_events, key=lambda e: e.start)
+            all_events = sorted(all_events, key=lambda e: e.start)
         if limit:
             offset = offset or 0
             all_events = all_events[offset:offset + limit]
+        all_events = _inflate_occurrences(all_events, db_session)
+        if view == 'ids':
+            return [e.public_id for e in all_events]
+        return all_events
     else:
         if view == 'count':
             return {"count": query.one()[0]}
-        query = query.order_by(asc(Event.start)).limit(limit)
+        query = query.order_by(asc(Event.start), asc(Event.id)).limit(limit)
         if offset:
             query = query.offset(offset)
         # Eager-load some objects in order to make constructing API
@@ -552,35 +708,19 @@ def events(namespace_id, event_public_id, calendar_public_id, title,
         all_events = query.all()
 
     if view == 'ids':
-        return [x[0] for x in all_events]
+        return make_page(all_events, limit, key=lambda x: (x[1], x[2]),
+                         value=lambda x: x[0])
     else:
-        return all_events
-
-
-def messages_for_contact_scores(db_session, namespace_id, starts_after=None):
-    query = (db_session.query(
-        Message.to_addr, Message.cc_addr, Message.bcc_addr,
-        Message.id, Message.received_date.label('date'))
-        .join(MessageCategory.message)
-        .join(MessageCategory.category)
-        .filter(Message.namespace_id == namespace_id)
-        .filter(Category.name == 'sent')
-        .filter(~Message.is_draft)
-        .filter(Category.namespace_id == namespace_id))
-
-    if starts_after:
-        query = query.filter(Message.received_date > starts_after)
-
-    return query.all()
+        return make_page(all_events, limit, key=lambda e: (e.start, e.id))
 
 
 def metadata(namespace_id, app_id, view, limit, offset,
-             db_session):
+             db_session, page_token=None):
 
     if view == 'count':
         query = db_session.query(func.count(Metadata.id))
     elif view == 'ids':
-        query = db_session.query(Metadata.object_public_id)
+        query = db_session.query(Metadata.object_public_id, Metadata.id)
     else:
         query = db_session.query(Metadata)
 
@@ -588,6 +728,8 @@ def metadata(namespace_id, app_id, view, limit, offset,
                Metadata.value.isnot(None)]
     if app_id is not None:
         filters.append(Metadata.app_id == app_id)
+    if page_token is not None:
+        filters.append(after_page_token(None, Metadata.id, page_token))
 
     query = query.filter(*filters)
     if view == 'count':
@@ -599,9 +741,10 @@ def metadata(namespace_id, app_id, view, limit, offset,
         query = query.offset(offset)
 
     if view == 'ids':
-        return [x[0] for x in query.all()]
+        return make_page(query.all(), limit, key=lambda x: (None, x[1]),
+                         value=lambda x: x[0])
 
-    return query.all()
+    return make_page(query.all(), limit, key=lambda m: (None, m.id))
 
 
 def metadata_for_app(app_id, limit, last, query_value, query_type, db_session):
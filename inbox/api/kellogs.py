@@ -207,9 +207,8 @@ def _encode(obj, namespace_public_id=None, expand=False, is_n1=False):
             base['labels'] = categories
 
         if not expand:
-            base['message_ids'] = \
-                [m.public_id for m in obj.messages if not m.is_draft]
-            base['draft_ids'] = [m.public_id for m in obj.drafts]
+            base['message_ids'] = obj.message_public_ids
+            base['draft_ids'] = obj.draft_public_ids
             return base
 
         # Expand messages within threads
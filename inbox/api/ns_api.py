@@ -4,7 +4,6 @@ import json
 import time
 import uuid
 import base64
-import gevent
 import itertools
 from hashlib import sha256
 from datetime import datetime
@@ -21,9 +20,11 @@ from sqlalchemy.orm import joinedload, load_only
 
 from inbox.models import (Message, Block, Part, Thread, Namespace,
                           Contact, Calendar, Event, Transaction,
-                          DataProcessingCache, Category, MessageCategory)
+                          Category, MessageCategory)
 from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.models.category import EPOCH
+from inbox.models.counter import (CategoryCounter, ALL_CATEGORIES,
+                                  COUNTER_FIELDS, count_categories)
 from inbox.models.backends.generic import GenericAccount
 from inbox.api.sending import (send_draft, send_raw_mime, send_draft_copy,
                                update_draft_on_send)
@@ -34,16 +35,16 @@ from inbox.api.validation import (valid_account, get_attachments, get_calendar,
                                   get_recipients, get_draft, valid_public_id,
                                   valid_event, valid_event_update, timestamp,
                                   bounded_str, view, strict_parse_args,
-                                  limit, offset, ValidatableArgument,
+                                  limit, offset, page_token,
+                                  ValidatableArgument,
                                   strict_bool, validate_draft_recipients,
                                   valid_delta_object_types, valid_display_name,
                                   noop_event_update, valid_category_type,
                                   comma_separated_email_list,
                                   get_sending_draft)
 from inbox.config import config
-from inbox.contacts.algorithms import (calculate_contact_scores,
-                                       calculate_group_scores,
-                                       calculate_group_counts, is_stale)
+from inbox.contacts.scores import (get_scores_cache, update_scores,
+                                   read_scores)
 import inbox.contacts.crud
 from inbox.contacts.search import ContactSearchClient
 from inbox.sendmail.base import (create_message_from_json, update_draft,
@@ -158,6 +159,7 @@ def start():
     g.parser.add_argument('limit', default=DEFAULT_LIMIT, type=limit,
                           location='args')
     g.parser.add_argument('offset', default=0, type=offset, location='args')
+    g.parser.add_argument('page_token', type=page_token, location='args')
 
 
 @app.before_request
@@ -197,6 +199,25 @@ def finish(response):
     return response
 
 
+def paginated_jsonify(encoder, results):
+    """
+    Like encoder.jsonify, but also returns the token for the next page of
+    results, if any, in the Next-Page-Token header.
+
+    """
+    response = encoder.jsonify(results)
+    next_page_token = getattr(results, 'next_page_token', None)
+    if next_page_token is not None:
+        response.headers['Next-Page-Token'] = next_page_token
+    return response
+
+
+def get_page_token(args):
+    if args['page_token'] is not None and args['offset']:
+        raise InputError('Cannot specify both offset and page_token.')
+    return args['page_token']
+
+
 @app.errorhandler(OperationalError)
 def handle_operational_error(error):
     rule = request.url_rule
@@ -298,12 +319,13 @@ def thread_query_api():
         limit=args['limit'],
         offset=args['offset'],
         view=args['view'],
-        db_session=g.db_session)
+        db_session=g.db_session,
+        page_token=get_page_token(args))
 
     # Use a new encoder object with the expand parameter set.
     encoder = APIEncoder(g.namespace.public_id,
                          args['view'] == 'expanded')
-    return encoder.jsonify(threads)
+    return paginated_jsonify(encoder, threads)
 
 
 @app.route('/threads/search', methods=['GET'])
@@ -464,11 +486,12 @@ def message_query_api():
         limit=args['limit'],
         offset=args['offset'],
         view=args['view'],
-        db_session=g.db_session)
+        db_session=g.db_session,
+        page_token=get_page_token(args))
 
     # Use a new encoder object with the expand parameter set.
     encoder = APIEncoder(g.namespace.public_id, args['view'] == 'expanded')
-    return encoder.jsonify(messages)
+    return paginated_jsonify(encoder, messages)
 
 
 @app.route('/messages/search', methods=['GET'])
@@ -817,6 +840,42 @@ def folder_label_delete_api(public_id):
     return g.encoder.jsonify(None)
 
 
+@app.route('/counts')
+def counts_api():
+    """
+    Thread and message counts for the whole namespace (with a null id) and
+    for each folder or label, e.g. for unread badges.
+
+    """
+    counters = g.db_session.query(CategoryCounter).filter(
+        CategoryCounter.namespace_id == g.namespace.id).all()
+    if counters:
+        counts = {c.category_id: {field: max(getattr(c, field), 0)
+                                  for field in COUNTER_FIELDS}
+                  for c in counters}
+    else:
+        # The namespace's counters haven't been set up yet.
+        counts = count_categories(g.db_session, g.namespace.id)
+
+    categories = {c.id: c for c in g.db_session.query(Category).filter(
+        Category.namespace_id == g.namespace.id,
+        Category.deleted_at == EPOCH)}  # noqa
+    results = []
+    for category_id, category_counts in sorted(counts.iteritems()):
+        if category_id == ALL_CATEGORIES:
+            result = {'id': None, 'name': None, 'display_name': None}
+        elif category_id in categories:
+            category = categories[category_id]
+            result = {'id': category.public_id,
+                      'name': category.name or None,
+                      'display_name': category.display_name}
+        else:
+            continue
+        result.update(category_counts)
+        results.append(result)
+    return g.encoder.jsonify(results)
+
+
 #
 # Contacts
 ##
@@ -921,9 +980,10 @@ def event_api():
         view=args['view'],
         expand_recurring=args['expand_recurring'],
         show_cancelled=args['show_cancelled'],
-        db_session=g.db_session)
+        db_session=g.db_session,
+        page_token=get_page_token(args))
 
-    return g.encoder.jsonify(results)
+    return paginated_jsonify(g.encoder, results)
 
 
 @app.route('/events/', methods=['POST'])
@@ -1233,9 +1293,10 @@ def files_api():
         limit=args['limit'],
         offset=args['offset'],
         view=args['view'],
-        db_session=g.db_session)
+        db_session=g.db_session,
+        page_token=get_page_token(args))
 
-    return g.encoder.jsonify(files)
+    return paginated_jsonify(g.encoder, files)
 
 
 @app.route('/files/<public_id>', methods=['GET'])
@@ -1331,39 +1392,69 @@ def file_download_api(public_id):
             # HACK just append the major part of the content type
             name = 'attachment.{0}'.format(ct.split('/')[0])
 
-    # TODO the part.data object should really behave like a stream we can read
-    # & write to
-    try:
-        account = g.namespace.account
-        statsd_string = 'api.direct_fetching.{}.{}'.format(account.provider,
-                                                           account.id)
-
-        response = make_response(f.data)
-        statsd_client.incr('{}.successes'.format(statsd_string))
-
-    except TemporaryEmailFetchException:
-        statsd_client.incr('{}.temporary_failure'.format(statsd_string))
-        log.warning('Exception when fetching email',
-                    account_id=account.id, provider=account.provider,
-                    logstash_tag='direct_fetching', exc_info=True)
-
-        return err(503, "Email server returned a temporary error. "
-                        "Please try again in a few minutes.")
-    except EmailDeletedException:
-        statsd_client.incr('{}.deleted'.format(statsd_string))
-        log.warning('Exception when fetching email',
-                    account_id=account.id, provider=account.provider,
-                    logstash_tag='direct_fetching', exc_info=True)
-
-        return err(404, "The data was deleted on the email server.")
-    except EmailFetchException:
-        statsd_client.incr('{}.failures'.format(statsd_string))
-        log.warning('Exception when fetching email',
-                    logstash_tag='direct_fetching', exc_info=True)
-
-        return err(404, "Couldn't find data on email server.")
+    byte_range = None
+    # Only single ranges are served as such; the full file is a valid
+    # response to a request for several.
+    if request.range is not None and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(f.size)
+        if byte_range is None:
+            response = err(416, 'Requested range not satisfiable.')
+            response.headers['Content-Range'] = 'bytes */{}'.format(f.size)
+            return response
+
+    # Stream the file straight from the blockstore if we can, so that large
+    # attachments aren't read into memory all at once.
+    start, stop = byte_range or (0, None)
+    stream = f.stream(start, stop)
+    if stream is not None:
+        response = Response(stream_with_context(stream))
+        if byte_range is not None:
+            response.status_code = 206
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, f.size)
+            response.headers['Content-Length'] = stop - start
+        else:
+            response.headers['Content-Length'] = f.size
+    else:
+        try:
+            account = g.namespace.account
+            statsd_string = 'api.direct_fetching.{}.{}'.format(
+                account.provider, account.id)
+
+            data = f.data
+            statsd_client.incr('{}.successes'.format(statsd_string))
+
+        except TemporaryEmailFetchException:
+            statsd_client.incr('{}.temporary_failure'.format(statsd_string))
+            log.warning('Exception when fetching email',
+                        account_id=account.id, provider=account.provider,
+                        logstash_tag='direct_fetching', exc_info=True)
+
+            return err(503, "Email server returned a temporary error. "
+                            "Please try again in a few minutes.")
+        except EmailDeletedException:
+            statsd_client.incr('{}.deleted'.format(statsd_string))
+            log.warning('Exception when fetching email',
+                        account_id=account.id, provider=account.provider,
+                        logstash_tag='direct_fetching', exc_info=True)
+
+            return err(404, "The data was deleted on the email server.")
+        except EmailFetchException:
+            statsd_client.incr('{}.failures'.format(statsd_string))
+            log.warning('Exception when fetching email',
+                        logstash_tag='direct_fetching', exc_info=True)
+
+            return err(404, "Couldn't find data on email server.")
+
+        if byte_range is not None:
+            response = make_response(data[start:stop], 206)
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, len(data))
+        else:
+            response = make_response(data)
 
     response.headers['Content-Type'] = 'application/octet-stream'  # ct
+    response.headers['Accept-Ranges'] = 'bytes'
     # Werkzeug will try to encode non-ascii header values as latin-1. Try that
     # first; if it fails, use RFC2047/MIME encoding. See
     # https://tools.ietf.org/html/rfc7230#section-3.2.4.
@@ -1477,9 +1568,10 @@ def draft_query_api():
         limit=args['limit'],
         offset=args['offset'],
         view=args['view'],
-        db_session=g.db_session)
+        db_session=g.db_session,
+        page_token=get_page_token(args))
 
-    return g.encoder.jsonify(drafts)
+    return paginated_jsonify(g.encoder, drafts)
 
 
 @app.route('/drafts/<public_id>', methods=['GET'])
@@ -1778,6 +1870,7 @@ def sync_deltas():
 
     start_time = time.time()
     while time.time() - start_time < timeout:
+        notified_id = delta_sync.notifier.latest_transaction_id(g.namespace.id)
         with session_scope(g.namespace.id) as db_session:
             deltas, _ = delta_sync.format_transactions_after_pointer(
                 g.namespace, start_pointer, db_session, args['limit'],
@@ -1794,7 +1887,10 @@ def sync_deltas():
 
         # No changes. perhaps wait
         elif '/delta/longpoll' in request.url_rule.rule:
-            gevent.sleep(poll_interval)
+            for _ in delta_sync.wait_for_transactions(
+                    g.namespace.id, max(start_pointer, notified_id),
+                    poll_interval, start_time + timeout):
+                pass
         else:  # Return immediately
             response['cursor_end'] = cursor
             return g.encoder.jsonify(response)
@@ -1916,47 +2012,25 @@ def stream_changes():
 # Groups and Contact Rankings
 ##
 
+def _contact_scores_cache(force_recalculate):
+    # Kept up to date (and periodically rebuilt) by the contact-scores
+    # service; only computed here the first time, or when forced.
+    dpcache = get_scores_cache(g.db_session, g.namespace.id)
+    if (force_recalculate or dpcache.contact_groups is None or
+            dpcache.contact_rankings is None):
+        update_scores(g.db_session, g.namespace, dpcache,
+                      rebuild=force_recalculate)
+        g.db_session.commit()
+    return dpcache
+
+
 @app.route('/groups/intrinsic')
 def groups_intrinsic():
     g.parser.add_argument('force_recalculate', type=strict_bool,
                           location='args')
     args = strict_parse_args(g.parser, request.args)
-    try:
-        dpcache = g.db_session.query(DataProcessingCache).filter(
-            DataProcessingCache.namespace_id == g.namespace.id).one()
-    except NoResultFound:
-        dpcache = DataProcessingCache(namespace_id=g.namespace.id)
-
-    last_updated = dpcache.contact_groups_last_updated
-    cached_data = dpcache.contact_groups
-
-    use_cached_data = (not (is_stale(last_updated) or cached_data is None) and
-                       args['force_recalculate'] is not True)
-
-    if not use_cached_data:
-        last_updated = None
-
-    messages = filtering.messages_for_contact_scores(
-        g.db_session, g.namespace.id, last_updated)
-
-    from_email = g.namespace.email_address
-
-    if use_cached_data:
-        result = cached_data
-        new_guys = calculate_group_counts(messages, from_email)
-        for k, v in new_guys.items():
-            if k in result:
-                result[k] += v
-            else:
-                result[k] = v
-    else:
-        result = calculate_group_scores(messages, from_email)
-        dpcache.contact_groups = result
-        g.db_session.add(dpcache)
-        g.db_session.commit()
-
-    result = sorted(result.items(), key=lambda x: x[1], reverse=True)
-    return g.encoder.jsonify(result)
+    dpcache = _contact_scores_cache(args['force_recalculate'] is True)
+    return g.encoder.jsonify(read_scores(dpcache.contact_groups))
 
 
 @app.route('/contacts/rankings')
@@ -1964,37 +2038,5 @@ def contact_rankings():
     g.parser.add_argument('force_recalculate', type=strict_bool,
                           location='args')
     args = strict_parse_args(g.parser, request.args)
-    try:
-        dpcache = g.db_session.query(DataProcessingCache).filter(
-            DataProcessingCache.namespace_id == g.namespace.id).one()
-    except NoResultFound:
-        dpcache = DataProcessingCache(namespace_id=g.namespace.id)
-
-    last_updated = dpcache.contact_rankings_last_updated
-    cached_data = dpcache.contact_rankings
-
-    use_cached_data = (not (is_stale(last_updated) or cached_data is None) and
-                       args['force_recalculate'] is not True)
-
-    if not use_cached_data:
-        last_updated = None
-
-    messages = filtering.messages_for_contact_scores(
-        g.db_session, g.namespace.id, last_updated)
-
-    if use_cached_data:
-        new_guys = calculate_contact_scores(messages, time_dependent=False)
-        result = cached_data
-        for k, v in new_guys.items():
-            if k in result:
-                result[k] += v
-            else:
-                result[k] = v
-    else:
-        result = calculate_contact_scores(messages)
-        dpcache.contact_rankings = result
-        g.db_session.add(dpcache)
-        g.db_session.commit()
-
-    result = sorted(result.items(), key=lambda x: x[1], reverse=True)
-    return g.encoder.jsonify(result)
+    dpcache = _contact_scores_cache(args['force_recalculate'] is True)
+    return g.encoder.jsonify(read_scores(dpcache.contact_rankings))
@@ -0,0 +1,86 @@
+"""
+Keyset pagination for the API's listing endpoints.
+
+Results are ordered by a sort key (e.g. Thread.recentdate) with the row id
+as a tie-breaker, and the page token encodes the (sort key, id) of the last
+result returned. The next page starts right after that row, so fetching it
+uses the same (namespace_id, sort key) index range scan as the first page,
+however deep into the results it is. With OFFSET, MySQL has to scan and
+discard all the preceding rows instead.
+
+"""
+import json
+import base64
+import calendar
+from datetime import datetime
+
+import arrow
+from sqlalchemy import and_, or_
+
+
+class Page(list):
+    """
+    A page of results. `next_page_token` is set if there may be more
+    results.
+
+    """
+    next_page_token = None
+
+
+def encode_page_token(sort_key, id_):
+    if isinstance(sort_key, arrow.Arrow):
+        sort_key = sort_key.timestamp
+    elif isinstance(sort_key, datetime):
+        sort_key = calendar.timegm(sort_key.utctimetuple())
+    # Drop the padding so that tokens can be used in URLs as-is.
+    return base64.urlsafe_b64encode(json.dumps([sort_key, id_])).rstrip('=')
+
+
+def decode_page_token(value):
+    """
+    Returns the (sort key, id) pair encoded in a page token. Timestamps are
+    returned as datetimes. Raises ValueError for malformed tokens.
+
+    """
+    try:
+        value = str(value)
+        sort_key, id_ = json.loads(base64.urlsafe_b64decode(
+            value + '=' * (-len(value) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('Invalid page_token.')
+    if not isinstance(id_, (int, long)) or \
+            not isinstance(sort_key, (int, long, type(None))):
+        raise ValueError('Invalid page_token.')
+    if sort_key is not None:
+        sort_key = datetime.utcfromtimestamp(sort_key)
+    return sort_key, id_
+
+
+def after_page_token(sort_column, id_column, page_token, descending=True):
+    """
+    Filter criterion selecting the rows which come after the page token's
+    row in (sort_column, id_column) order. The redundant bound on
+    sort_column alone lets MySQL use it for an index range scan.
+
+    """
+    sort_key, id_ = page_token
+    if sort_column is None:
+        return id_column < id_ if descending else id_column > id_
+    if descending:
+        return and_(sort_column <= sort_key,
+                    or_(sort_column < sort_key, id_column < id_))
+    return and_(sort_column >= sort_key,
+                or_(sort_column > sort_key, id_column > id_))
+
+
+def make_page(rows, limit, key, value=None):
+    """
+    Build a Page from a list of result rows. `key` maps a row to its
+    (sort key, id) pair, and `value`, if given, maps a row to the result
+    returned to the client.
+
+    """
+    page = Page(rows if value is None else [value(row) for row in rows])
+    if rows and limit and len(rows) >= limit:
+        page.next_page_token = encode_page_token(*key(rows[-1]))
+    return page
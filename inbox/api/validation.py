@@ -12,6 +12,7 @@ from inbox.models.constants import MAX_INDEXABLE_LENGTH
 from inbox.api.err import (InputError, NotFoundError, ConflictError,
                            AccountInvalidError, AccountStoppedError)
 from inbox.api.kellogs import encode
+from inbox.api.pagination import decode_page_token
 from inbox.util.addr import valid_email
 
 MAX_LIMIT = 1000
@@ -87,6 +88,10 @@ def offset(value):
     return value
 
 
+def page_token(value):
+    return decode_page_token(value)
+
+
 def valid_public_id(value):
     try:
         # raise ValueError on malformed public ids
@@ -1,4 +1,5 @@
 import datetime
+import math
 from collections import defaultdict
 
 '''
@@ -10,6 +11,13 @@ and the groups/intrinsic endpoint.
 LOOKBACK_TIME = 63072000.0  # datetime.timedelta(days=2*365).total_seconds()
 MIN_MESSAGE_WEIGHT = .01
 
+# For scores kept up to date incrementally (see inbox.contacts.scores), message
+# weights decay exponentially instead, so that they can be stored relative to
+# a fixed epoch: a message's weight at time t is
+# epoch_weight(message date) * decay_factor(t).
+SCORE_EPOCH = datetime.datetime(2010, 1, 1)
+SCORE_DECAY_TIME = 31536000.0  # datetime.timedelta(days=365).total_seconds()
+
 # For calculate_group_scores
 MIN_GROUP_SIZE = 2
 MIN_MESSAGE_COUNT = 2.5  # Might want to tune this param. (1.5, 2.5?)
@@ -31,6 +39,25 @@ def _get_message_weight(now, message_date):
     return max(weight, MIN_MESSAGE_WEIGHT)
 
 
+def epoch_weight(message_date, now):
+    # Messages dated in the future (some are, bogusly, by centuries) count as
+    # sent now; their weight would overflow otherwise.
+    message_date = min(message_date, now)
+    return math.exp((message_date - SCORE_EPOCH).total_seconds() /
+                    SCORE_DECAY_TIME)
+
+
+def decay_factor(now):
+    return math.exp(-(now - SCORE_EPOCH).total_seconds() / SCORE_DECAY_TIME)
+
+
+def decay_scores(scores, now):
+    """Scale scores stored relative to SCORE_EPOCH to their value at
+    `now`."""
+    factor = decay_factor(now)
+    return {k: v * factor for k, v in scores.iteritems()}
+
+
 def _jaccard_similarity(set1, set2):
     return len(set1.intersection(set2)) / float(len(set1.union(set2)))
 
@@ -96,19 +123,56 @@ def calculate_group_scores(messages, user_email):
         date - datetime.datetime object
     """
     now = datetime.datetime.now()
-    message_ids_to_scores = {}
-    molecules_dict = defaultdict(set)  # (emails, ...) -> {message ids, ...}
+    molecule_weights = defaultdict(float)
+    for msg in messages:
+        participants = _get_participants(msg, [user_email])
+        if len(participants) >= MIN_GROUP_SIZE:
+            molecule_weights[tuple(participants)] += \
+                _get_message_weight(now, msg.date)
+    return _score_molecules(molecule_weights)
 
-    def get_message_list_weight(message_ids):
-        return sum([message_ids_to_scores[m_id] for m_id in message_ids])
 
-    # Gather initial candidate social molecules
+def add_message_scores(contact_scores, group_cooccurrences, messages,
+                       user_email):
+    """Add the weights of sent messages, relative to SCORE_EPOCH, to the
+    scores of their recipients and to the co-occurrence weights of their
+    groups of recipients. Both dicts are updated in place.
+    """
+    now = datetime.datetime.utcnow()
     for msg in messages:
+        weight = epoch_weight(msg.date, now)
+        for (name, email) in msg.to_addr + msg.cc_addr + msg.bcc_addr:
+            contact_scores[email] = contact_scores.get(email, 0) + weight
         participants = _get_participants(msg, [user_email])
         if len(participants) >= MIN_GROUP_SIZE:
-            molecules_dict[tuple(participants)].add(msg.id)
-            message_ids_to_scores[msg.id] = \
-                _get_message_weight(now, msg.date)
+            group = ', '.join(participants)
+            group_cooccurrences[group] = \
+                group_cooccurrences.get(group, 0) + weight
+
+
+def calculate_group_scores_from_cooccurrences(group_cooccurrences):
+    """Like calculate_group_scores, but from the summed message weights
+    of each group of recipients (as kept by add_message_scores) rather than
+    from the messages themselves.
+    """
+    return _score_molecules({tuple(group.split(', ')): weight
+                             for group, weight
+                             in group_cooccurrences.iteritems()})
+
+
+def _score_molecules(molecule_weights):
+    # molecule_weights maps each group of recipients to the summed weight of
+    # the messages sent to exactly that group. Since every message is in
+    # exactly one of them, a molecule's set of initial groups stands in for
+    # its set of messages.
+    molecules_dict = defaultdict(set)  # (emails, ...) -> {(emails, ...), ...}
+
+    def get_message_list_weight(groups):
+        return sum([molecule_weights[group] for group in groups])
+
+    # Gather initial candidate social molecules
+    for participants in molecule_weights:
+        molecules_dict[participants].add(participants)
 
     if len(molecules_dict) > SOCIAL_MOLECULE_LIMIT:
         return {}  # Not worth the calculation
@@ -0,0 +1,127 @@
+"""
+Contact rankings and intrinsic groups, kept up to date incrementally.
+
+Every sent message adds weight to the scores of its recipients and to the
+co-occurrence weight of its group of recipients. Weights decay exponentially
+with the age of the message, so rather than recomputing them all as time
+passes, they're stored relative to a fixed epoch (see
+inbox.contacts.algorithms.SCORE_EPOCH) and scaled to the present when read.
+Newly sent messages are simply added to the stored weights, by the
+contact-scores service as they're synced, and the API endpoints read the
+results.
+
+"""
+import datetime
+
+from sqlalchemy import or_
+from sqlalchemy.orm.exc import NoResultFound
+
+from inbox.contacts.algorithms import (
+    add_message_scores, calculate_group_scores_from_cooccurrences,
+    decay_factor, decay_scores, is_stale)
+from inbox.models import (Category, DataProcessingCache, Message,
+                          MessageCategory)
+
+# Scores are recomputed from all sent messages this often (in days), which
+# picks up sent messages which weren't counted as they arrived, e.g. older
+# ones synced after newer ones.
+REBUILD_INTERVAL = 14
+
+
+def messages_for_contact_scores(db_session, namespace_id,
+                                last_message_id=None, last_message_date=None):
+    """The namespace's sent messages, or only those newer (by id or by date)
+    than the given ones."""
+    query = (db_session.query(
+        Message.to_addr, Message.cc_addr, Message.bcc_addr,
+        Message.id, Message.received_date.label('date'))
+        .join(MessageCategory.message)
+        .join(MessageCategory.category)
+        .filter(Message.namespace_id == namespace_id)
+        .filter(Category.name == 'sent')
+        .filter(~Message.is_draft)
+        .filter(Category.namespace_id == namespace_id))
+
+    if last_message_date is not None:
+        query = query.filter(or_(Message.id > last_message_id,
+                                 Message.received_date > last_message_date))
+    elif last_message_id is not None:
+        query = query.filter(Message.id > last_message_id)
+
+    return query.all()
+
+
+def get_scores_cache(db_session, namespace_id):
+    try:
+        return db_session.query(DataProcessingCache).filter(
+            DataProcessingCache.namespace_id == namespace_id).one()
+    except NoResultFound:
+        dpcache = DataProcessingCache(namespace_id=namespace_id)
+        db_session.add(dpcache)
+        return dpcache
+
+
+def update_scores(db_session, namespace, dpcache=None, rebuild=False):
+    """
+    Add the namespace's sent messages since the last update to its stored
+    contact rankings and groups. They're recomputed from all its sent
+    messages instead if `rebuild` is set, if there aren't any stored yet, or
+    if they were last recomputed more than REBUILD_INTERVAL days ago.
+
+    Returns the updated DataProcessingCache. The caller commits.
+
+    """
+    if dpcache is None:
+        dpcache = get_scores_cache(db_session, namespace.id)
+
+    rebuild = (rebuild or dpcache.group_cooccurrences is None or
+               dpcache.contact_rankings is None or
+               dpcache.scores_last_message_id is None or
+               is_stale(dpcache.scores_rebuilt_at, REBUILD_INTERVAL))
+    if rebuild:
+        contact_scores, group_cooccurrences = {}, {}
+        messages = messages_for_contact_scores(db_session, namespace.id)
+    else:
+        contact_scores = dpcache.contact_rankings
+        group_cooccurrences = dpcache.group_cooccurrences
+        messages = messages_for_contact_scores(
+            db_session, namespace.id, dpcache.scores_last_message_id,
+            dpcache.scores_last_message_date)
+        if not messages:
+            return dpcache
+
+    add_message_scores(contact_scores, group_cooccurrences, messages,
+                       namespace.email_address)
+
+    # Group scores depend on absolute weight thresholds, so they're computed
+    # from the co-occurrence weights as of now, then stored relative to the
+    # epoch like the rest.
+    now = datetime.datetime.utcnow()
+    factor = decay_factor(now)
+    group_scores = calculate_group_scores_from_cooccurrences(
+        decay_scores(group_cooccurrences, now))
+
+    dpcache.contact_rankings = contact_scores
+    dpcache.group_cooccurrences = group_cooccurrences
+    dpcache.contact_groups = {group: score / factor
+                              for group, score in group_scores.iteritems()}
+    if rebuild:
+        last_message_id, last_message_date = 0, None
+    else:
+        last_message_id = dpcache.scores_last_message_id
+        last_message_date = dpcache.scores_last_message_date
+    for message in messages:
+        last_message_id = max(last_message_id, message.id)
+        if last_message_date is None or message.date > last_message_date:
+            last_message_date = message.date
+    dpcache.scores_last_message_id = last_message_id
+    dpcache.scores_last_message_date = last_message_date
+    if rebuild:
+        dpcache.scores_rebuilt_at = datetime.datetime.now()
+    return dpcache
+
+
+def read_scores(scores):
+    """Stored scores as of now, highest first."""
+    scores = decay_scores(scores, datetime.datetime.utcnow())
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
@@ -1,20 +1,55 @@
 import re
 import json
+import time
+import heapq
+from collections import Counter
 
 import boto3
 
 from flanker.addresslib import address
 
 from inbox.config import config
-from inbox.models import Contact
+from inbox.models import Contact, DataProcessingCache
+from inbox.models.search import ContactSearchTerm
 from inbox.models.session import session_scope
+from inbox.search.index import fold, prefix_pattern, MAX_TERM_LENGTH
 from inbox.sqlalchemy_ext.util import safer_yield_per
+from inbox.util.blockcache import SizedLRU
 
 from sqlalchemy.orm import joinedload
 
 from nylas.logging import get_logger
 log = get_logger()
 
+# Contacts are searched with a local index (ContactSearchTerm rows on each
+# namespace's shard) of the words of their names and email addresses, their
+# full email addresses and the digits of their phone numbers. Query terms
+# are matched as prefixes of these terms, using the (namespace_id, term)
+# index, and matching contacts are ranked by their contact score (see
+# inbox.contacts.scores), exact matches first. The contact-search-index
+# service keeps the index up to date from the transaction log, and
+# bin/contact-search-backfill builds it. Contacts are also still uploaded
+# to CloudSearch while it's configured.
+
+# A query term matching more index terms than this only matches the
+# contacts with the first of them (the shortest terms, and so the closest
+# matches, first) and those of the TOP_SCORED_CANDIDATES highest-scored
+# contacts, unless other query terms narrow it down.
+MAX_TERM_MATCHES = 5000
+TOP_SCORED_CANDIDATES = 1000
+
+# How long contact scores are cached for, in seconds.
+SCORES_CACHE_TTL = 60
+
+INDEX_CHUNK_SIZE = 1000
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+_phone_query_re = re.compile(r'^[\d\s()+.-]*\d[\d\s()+.-]*$')
+
+# Contact scores by namespace id and lowercased email address.
+_scores_cache = SizedLRU(
+    config.get('CONTACT_SCORES_CACHE_MAX_ENTRIES', 100000))
+
 # CloudSearch charges per 1000 batched uploads. Batches must be
 # < 5 MB. This assumes that individual items are <= 1kb each.
 DOC_UPLOAD_CHUNK_SIZE = 5000
@@ -34,6 +69,10 @@ def get_domain_config(conn, domain_name):
     return None
 
 
+def cloudsearch_configured():
+    return bool(search_service_url and doc_service_url)
+
+
 def get_search_service():
     return boto3.client(
         "cloudsearchdomain", region_name="us-west-2",
@@ -85,12 +124,179 @@ def cloudsearch_contact_repr(contact):
     }
 
 
+def contact_terms(contact):
+    """The terms the contact is indexed under."""
+    email_address = fold(contact.email_address)
+    terms = set(_word_re.findall(fold(contact.name)))
+    terms.update(_word_re.findall(email_address))
+    if email_address:
+        terms.add(email_address)
+    for phone_number in contact.phone_numbers:
+        digits = _strip_non_numeric(phone_number.number or '')
+        if digits:
+            terms.add(digits)
+            # Also match national numbers without their country code.
+            terms.add(digits[-10:])
+    return {term[:MAX_TERM_LENGTH] for term in terms}
+
+
+def index_contacts(db_session, contacts):
+    """
+    Replace the index terms of the given contacts, which should have their
+    phone numbers loaded. The caller commits.
+
+    """
+    contacts = list(contacts)
+    unindex_contacts(db_session, [contact.id for contact in contacts])
+    db_session.bulk_insert_mappings(ContactSearchTerm, [
+        dict(namespace_id=contact.namespace_id, term=term,
+             contact_id=contact.id)
+        for contact in contacts for term in contact_terms(contact)])
+    return len(contacts)
+
+
+def unindex_contacts(db_session, contact_ids):
+    """Remove the given contacts from the index."""
+    contact_ids = list(contact_ids)
+    if not contact_ids:
+        return
+    db_session.query(ContactSearchTerm).filter(
+        ContactSearchTerm.contact_id.in_(contact_ids)).delete(
+        synchronize_session=False)
+
+
+def query_terms(search_query):
+    """The terms of a search query, to match as prefixes of index terms."""
+    search_query = fold(search_query)
+    if _phone_query_re.match(search_query):
+        return [_strip_non_numeric(search_query)[:MAX_TERM_LENGTH]]
+    terms = []
+    for piece in search_query.split():
+        if '@' in piece:
+            pieces = [piece]
+        else:
+            pieces = _word_re.findall(piece)
+        for term in pieces:
+            term = term[:MAX_TERM_LENGTH]
+            if term not in terms:
+                terms.append(term)
+    return terms
+
+
+def _term_matches(db_session, namespace_id, term, contact_ids=None):
+    query = db_session.query(
+        ContactSearchTerm.contact_id, ContactSearchTerm.term).filter(
+        ContactSearchTerm.namespace_id == namespace_id,
+        ContactSearchTerm.term.like(prefix_pattern(term), escape='\\'))
+    if contact_ids is not None:
+        query = query.filter(ContactSearchTerm.contact_id.in_(contact_ids))
+    # Follows the (namespace_id, term) index, so that the truncated matches
+    # are the same every time.
+    return query.order_by(ContactSearchTerm.term, ContactSearchTerm.id). \
+        limit(MAX_TERM_MATCHES + 1).all()
+
+
+def _top_scored_contact_ids(db_session, namespace_id, scores):
+    email_addresses = heapq.nlargest(TOP_SCORED_CANDIDATES, scores,
+                                     key=scores.get)
+    if not email_addresses:
+        return []
+    return [id_ for id_, in db_session.query(Contact.id).filter(
+        Contact.namespace_id == namespace_id,
+        Contact.email_address.in_(email_addresses))]
+
+
+def _contact_scores(db_session, namespace_id):
+    """
+    The namespace's contact scores by lowercased email address. They're
+    relative to the same epoch, so they rank contacts as their current
+    values would.
+
+    """
+    cached = _scores_cache.get(namespace_id)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    dpcache = db_session.query(DataProcessingCache).filter(
+        DataProcessingCache.namespace_id == namespace_id).first()
+    scores = {}
+    if dpcache is not None and dpcache.contact_rankings:
+        for email_address, score in dpcache.contact_rankings.iteritems():
+            email_address = email_address.lower()
+            scores[email_address] = max(score,
+                                        scores.get(email_address, 0))
+    _scores_cache.set(namespace_id, (time.time() + SCORES_CACHE_TTL, scores),
+                      len(scores) + 1)
+    return scores
+
+
+def rank_contacts(db_session, namespace_id, search_query):
+    """
+    The ids of the namespace's contacts which match all the terms of the
+    query, best matches first.
+
+    """
+    terms = query_terms(search_query)
+    if not terms:
+        return []
+    matches = sorted([(term, _term_matches(db_session, namespace_id, term))
+                      for term in terms], key=lambda match: len(match[1]))
+
+    scores = _contact_scores(db_session, namespace_id)
+    candidates = None
+    exact_matches = Counter()
+    for term, rows in matches:
+        if candidates is not None and len(rows) > MAX_TERM_MATCHES:
+            rows = _term_matches(db_session, namespace_id, term, candidates)
+        elif len(rows) > MAX_TERM_MATCHES:
+            # Too many matches to rank them all: make sure the best-ranked
+            # contacts are among the ones we do.
+            top_scored = _top_scored_contact_ids(db_session, namespace_id,
+                                                 scores)
+            rows = rows[:MAX_TERM_MATCHES]
+            if top_scored:
+                seen = {row.contact_id for row in rows}
+                rows += [row for row in _term_matches(
+                         db_session, namespace_id, term, top_scored)
+                         if row.contact_id not in seen]
+        contact_ids = set()
+        for row in rows:
+            contact_ids.add(row.contact_id)
+            if row.term == term:
+                exact_matches[row.contact_id] += 1
+        if candidates is None:
+            candidates = contact_ids
+        else:
+            candidates.intersection_update(contact_ids)
+        if not candidates:
+            return []
+
+    contacts = db_session.query(
+        Contact.id, Contact.name, Contact.email_address).filter(
+        Contact.namespace_id == namespace_id,
+        Contact.id.in_(candidates))
+    ranked = sorted(contacts, key=lambda contact: (
+        -scores.get((contact.email_address or '').lower(), 0),
+        -exact_matches[contact.id], fold(contact.name), contact.id))
+    return [contact.id for contact in ranked]
+
+
 class ContactSearchClient(object):
-    """ Search client that talks to AWS CloudSearch (or a compatible API). """
+    """
+    Search client for a namespace's contacts. Queries are answered from the
+    local index; the CloudSearch methods are used to maintain the
+    CloudSearch domain while it's configured.
+
+    """
 
     def __init__(self, namespace_id):
         self.namespace_id = namespace_id
-        self.search_service = get_search_service()
+        self._search_service = None
+
+    @property
+    def search_service(self):
+        if self._search_service is None:
+            self._search_service = get_search_service()
+        return self._search_service
 
     def _fetch_search_page(self, **kwargs):
         """ Make sure we always filter results by namespace and apply the
@@ -145,34 +351,44 @@ class ContactSearchClient(object):
 
         return result_ids
 
-    # Note that our API constrains 'limit' to a max of 1000, which is safe to
-    # pass through to cloudsearch.
     def search_contacts(self, db_session, search_query, offset=0, limit=40):
-        if search_service_url and doc_service_url:
-            result_ids = self.fetch_matching_ids_page(
-                query=search_query, start=offset, size=limit)
-            log.info('received result IDs', result_ids=result_ids)
-
-            if result_ids:
-                return db_session.query(Contact).filter(
-                    Contact.namespace_id == self.namespace_id,
-                    Contact.id.in_(result_ids)).options(
-                        joinedload("phone_numbers")).all()
-            else:
-                return []
-        else:
-            log.warning('cloudsearch not configured; returning no results')
+        contact_ids = rank_contacts(db_session, self.namespace_id,
+                                    search_query)[offset:offset + limit]
+        if not contact_ids:
             return []
+        contacts = {contact.id: contact for contact in
+                    db_session.query(Contact).filter(
+                        Contact.namespace_id == self.namespace_id,
+                        Contact.id.in_(contact_ids)).options(
+                        joinedload("phone_numbers"))}
+        return [contacts[id_] for id_ in contact_ids if id_ in contacts]
 
 
 def index_namespace(namespace_id):
     """ Backfill function to index a namespace from current db data Not used
-    for incremental indexing.
+    for incremental indexing. Builds the local index, and the CloudSearch
+    index too if it's configured.
 
     """
-    if not search_service_url or not doc_service_url:
-        raise Exception('CloudSearch not configured; cannot index')
-    else:
+    indexed = 0
+    with session_scope(namespace_id) as db_session:
+        query = db_session.query(Contact).options(
+            joinedload("phone_numbers")).filter_by(
+                namespace_id=namespace_id)
+        contacts = []
+        for contact in safer_yield_per(query, Contact.id, 0,
+                                       INDEX_CHUNK_SIZE):
+            contacts.append(contact)
+            if len(contacts) >= INDEX_CHUNK_SIZE:
+                indexed += index_contacts(db_session, contacts)
+                db_session.commit()
+                contacts = []
+        indexed += index_contacts(db_session, contacts)
+        db_session.commit()
+    log.info("namespace local index complete", namespace_id=namespace_id,
+             total_contacts_indexed=indexed)
+
+    if cloudsearch_configured():
         search_client = ContactSearchClient(namespace_id)
         doc_service = get_doc_service()
 
@@ -223,9 +439,14 @@ def index_namespace(namespace_id):
 
 
 def delete_namespace_indexes(namespace_ids):
-    if not search_service_url or not doc_service_url:
-        raise Exception('CloudSearch not configured; cannot update index')
-    else:
+    for namespace_id in namespace_ids:
+        with session_scope(namespace_id) as db_session:
+            db_session.query(ContactSearchTerm).filter(
+                ContactSearchTerm.namespace_id == namespace_id).delete(
+                synchronize_session=False)
+            db_session.commit()
+
+    if cloudsearch_configured():
         doc_service = get_doc_service()
 
         for namespace_id in namespace_ids:
@@ -87,6 +87,10 @@ class DraftDeletionException(Exception):
     pass
 
 
+# Default number of connections in an account's connection pool.
+CONNECTION_POOL_SIZE = 3
+
+
 def _get_connection_pool(account_id, pool_size, pool_map, readonly):
     with _lock_map[account_id]:
         if account_id not in pool_map:
@@ -96,7 +100,8 @@ def _get_connection_pool(account_id, pool_size, pool_map, readonly):
         return pool_map[account_id]
 
 
-def connection_pool(account_id, pool_size=3, pool_map=dict()):
+def connection_pool(account_id, pool_size=CONNECTION_POOL_SIZE,
+                    pool_map=dict()):
     """ Per-account crispin connection pool.
 
     Use like this:
@@ -297,6 +302,9 @@ class CrispinClient(object):
         self._folder_names = None
         self.conn = conn
         self.readonly = readonly
+        # Whether the server accepts UID FETCH commands for multiple UIDs at
+        # once. Flipped off the first time a batched fetch gets rejected.
+        self._multi_uid_fetch_supported = True
 
     def _fetch_folder_list(self):
         """ NOTE: XLIST is deprecated, so we just use LIST.
@@ -658,27 +666,28 @@ class CrispinClient(object):
         return sorted([long(uid) for uid in fetch_result])
 
     def uids(self, uids):
+        """
+        Download the given UIDs from the currently selected folder.
+
+        If more than one UID is requested, they're fetched with a single
+        UID FETCH command. Servers which reject multi-UID fetches (or which
+        fail the whole command because one of the messages is unavailable)
+        are handled by falling back to fetching UIDs one at a time.
+
+        Returns
+        -------
+        list
+            RawMessage objects, sorted by ascending UID.
+        """
         uid_set = set(uids)
         messages = []
-        raw_messages = {}
+        raw_messages = None
 
-        for uid in uid_set:
-            try:
-                raw_messages.update(self.conn.fetch(
-                    uid, ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS']))
-            except imapclient.IMAPClient.Error as e:
-                if ('[UNAVAILABLE] UID FETCH Server error '
-                        'while fetching messages') in str(e):
-                    log.info('Got an exception while requesting an UID',
-                             uid=uid, error=e,
-                             logstash_tag='imap_download_exception')
-                    continue
-                else:
-                    log.info(('Got an unhandled exception while '
-                              'requesting an UID'),
-                             uid=uid, error=e,
-                             logstash_tag='imap_download_exception')
-                    raise
+        if len(uid_set) > 1 and self._multi_uid_fetch_supported:
+            raw_messages = self._fetch_multiple_uids(uid_set)
+
+        if raw_messages is None:
+            raw_messages = self._fetch_uids_one_at_a_time(uid_set)
 
         for uid in sorted(raw_messages.iterkeys(), key=long):
             # Skip handling unsolicited FETCH responses
@@ -699,6 +708,65 @@ class CrispinClient(object):
                                        g_labels=None))
         return messages
 
+    def _fetch_multiple_uids(self, uid_set):
+        # Returns None if the batched fetch failed and the caller should fall
+        # back to fetching UIDs individually.
+        try:
+            return self.conn.fetch(sorted(uid_set),
+                                   ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS'])
+        except imaplib.IMAP4.abort:
+            # The connection is unusable, falling back won't help.
+            raise
+        except imapclient.IMAPClient.Error as e:
+            if '[UNAVAILABLE]' not in str(e):
+                # Some servers choke on multi-UID fetches altogether. Don't
+                # bother trying again on this connection.
+                self._multi_uid_fetch_supported = False
+            log.info('Batched UID FETCH failed, falling back to fetching '
+                     'UIDs one at a time', uid_count=len(uid_set), error=e,
+                     logstash_tag='imap_download_exception')
+            return None
+
+    def _fetch_uids_one_at_a_time(self, uid_set):
+        raw_messages = {}
+        for uid in uid_set:
+            try:
+                raw_messages.update(self.conn.fetch(
+                    uid, ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS']))
+            except imapclient.IMAPClient.Error as e:
+                if ('[UNAVAILABLE] UID FETCH Server error '
+                        'while fetching messages') in str(e):
+                    log.info('Got an exception while requesting an UID',
+                             uid=uid, error=e,
+                             logstash_tag='imap_download_exception')
+                    continue
+                else:
+                    log.info(('Got an unhandled exception while '
+                              'requesting an UID'),
+                             uid=uid, error=e,
+                             logstash_tag='imap_download_exception')
+                    raise
+        return raw_messages
+
+    def sizes(self, uids):
+        """
+        Fetch message sizes for the given uids.
+
+        Parameters
+        ----------
+        uids : list
+            UIDs to fetch data for. Must be from the selected folder.
+
+        Returns
+        -------
+        dict
+            uid: RFC822.SIZE
+        """
+        data = self.conn.fetch(uids, ['RFC822.SIZE'])
+        uid_set = set(uids)
+        return {uid: ret['RFC822.SIZE'] for uid, ret in data.items()
+                if uid in uid_set and 'RFC822.SIZE' in ret}
+
     def flags(self, uids):
         if len(uids) > 100:
             # Some backends abort the connection if you give them a really
@@ -1,8 +1,12 @@
 import arrow
+from datetime import timedelta
 from dateutil.rrule import (rrulestr, rrule, rruleset,
                             MO, TU, WE, TH, FR, SA, SU)
+from sqlalchemy import or_
+from sqlalchemy.orm.attributes import set_committed_value
 
-from inbox.models.event import RecurringEvent, RecurringEventOverride
+from inbox.models.event import (RecurringEvent, RecurringEventOverride,
+                                RecurringEventOccurrence)
 from inbox.events.util import parse_rrule_datetime
 from timezones import timezones_table
 
@@ -11,6 +15,9 @@ log = get_logger()
 
 # How far in the future to expand recurring events
 EXPAND_RECURRING_YEARS = 1
+# RecurringEventOccurrences are generated this much further ahead, so that
+# they only need to be regenerated every so often as the horizon moves on.
+OCCURRENCE_HORIZON_MARGIN = timedelta(days=30)
 
 
 def link_events(db_session, event):
@@ -152,6 +159,81 @@ def get_start_times(event, start=None, end=None):
     return [event.start]
 
 
+def occurrence_horizon():
+    # How far ahead occurrences are generated, as a naive UTC datetime.
+    return arrow.utcnow().replace(years=+EXPAND_RECURRING_YEARS).naive + \
+        OCCURRENCE_HORIZON_MARGIN
+
+
+def generate_occurrences(db_session, event, until):
+    """
+    Replace the RecurringEventOccurrences of a recurring event by its
+    instances up to `until` (a naive UTC datetime): the start times of its
+    RRULE, except those that have been overridden, and its non-cancelled
+    overrides. These are the instances RecurringEvent.all_events returns.
+
+    """
+    table = RecurringEventOccurrence.__table__
+    db_session.execute(table.delete().where(
+        table.c.master_event_id == event.id))
+
+    # See RecurringEvent.all_events. Read the latest overrides (see
+    # update_occurrences) rather than the transaction's snapshot.
+    overrides = event.overrides.filter(
+        RecurringEventOverride.calendar_id == event.calendar_id). \
+        with_for_update(read=True).all()
+    overridden_starts = [o.original_start_time for o in overrides]
+    occurrences = [{'start': o.start, 'end': o.end, 'override_id': o.id}
+                   for o in overrides if not o.cancelled]
+    length = event.length
+    for start in get_start_times(event, end=until):
+        if start not in overridden_starts:
+            occurrences.append({'start': start, 'end': start + length,
+                                'override_id': None})
+    for occurrence in occurrences:
+        occurrence.update(namespace_id=event.namespace_id,
+                          master_event_id=event.id)
+    if occurrences:
+        db_session.execute(table.insert(), occurrences)
+
+    # Not a change to the event itself; see invalidate_occurrences.
+    event_table = RecurringEvent.__table__
+    db_session.execute(event_table.update().where(
+        event_table.c.id == event.id).values(occurrences_until=until))
+    set_committed_value(event, 'occurrences_until', until)
+    return len(occurrences)
+
+
+def update_occurrences(db_session, recur_query, until):
+    """
+    Make sure the occurrences of the recurring events `recur_query` selects
+    have been generated up to `until`, which mustn't be after
+    occurrence_horizon(). Occurrences are generated when first needed, and
+    again after the event or its overrides change or once the horizon has
+    moved on.
+
+    """
+    until = arrow.get(until).to('utc').naive
+    stale = recur_query.filter(or_(
+        RecurringEvent.occurrences_until == None,  # noqa
+        RecurringEvent.occurrences_until < until))
+    horizon = occurrence_horizon()
+    for event_id, in stale.with_entities(RecurringEvent.id).all():
+        # Lock the event until the occurrences are committed, so that a
+        # concurrent change can't invalidate them (see
+        # invalidate_occurrences) before they're marked as generated; and
+        # reload it, since it may have changed since we selected it.
+        event = db_session.query(RecurringEvent). \
+            filter(RecurringEvent.id == event_id). \
+            with_for_update().populate_existing().first()
+        if event is None or (event.occurrences_until is not None and
+                             event.occurrences_until >= until):
+            continue
+        count = generate_occurrences(db_session, event, horizon)
+        log.info('Generated recurring event occurrences', event_id=event.id,
+                 count=count)
+
+
 # rrule constant values
 freq_map = ('YEARLY',
             'MONTHLY',
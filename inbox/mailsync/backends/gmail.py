@@ -27,6 +27,7 @@ from sqlalchemy.orm import joinedload, load_only
 
 from inbox.util.itert import chunk
 from inbox.util.debug import bind_context
+from inbox.util.stats import statsd_client
 
 from nylas.logging import get_logger
 from gevent.lock import Semaphore
@@ -34,6 +35,7 @@ from inbox.models import Message, Folder, Namespace, Account, Label, Category
 from inbox.models.category import EPOCH
 from inbox.models.backends.imap import ImapFolderInfo, ImapUid, ImapThread
 from inbox.models.session import session_scope
+from inbox.crispin import CONN_RETRY_EXC_CLASSES, RawMessage
 from inbox.mailsync.backends.imap.generic import FolderSyncEngine
 from inbox.mailsync.backends.imap.monitor import ImapSyncMonitor
 from inbox.mailsync.backends.imap import common
@@ -45,9 +47,13 @@ PROVIDER = 'gmail'
 SYNC_MONITOR_CLS = 'GmailSyncMonitor'
 
 
+# Bounds for the batches of messages we download with a single UID FETCH.
+# Within them, the number of messages per batch adapts to how fast Gmail
+# responds (see DownloadBatchSize).
 MAX_DOWNLOAD_BYTES = 2 ** 20
-# USE MAX_DOWNLOAD_COUNT = 1 instead of 30 until N1 launch herding dies.
-MAX_DOWNLOAD_COUNT = 1
+MAX_DOWNLOAD_COUNT = 30
+# Batches which take longer than this to download and commit are too big.
+DOWNLOAD_LATENCY_TARGET = timedelta(seconds=10)
 
 
 class GmailSyncMonitor(ImapSyncMonitor):
@@ -203,11 +209,45 @@ class GmailSyncMonitor(ImapSyncMonitor):
         db_session.commit()
 
 
+class DownloadBatchSize(object):
+    """
+    The number of messages to download per UID FETCH.
+
+    Starts at a single message, so that lots of accounts starting initial
+    sync at once don't hammer Gmail, and doubles after each batch which is
+    downloaded and committed within DOWNLOAD_LATENCY_TARGET, up to
+    `maximum`. Once a batch is too slow or fails, the count is halved and
+    from then on only grows by one message at a time.
+
+    """
+
+    def __init__(self, maximum=MAX_DOWNLOAD_COUNT):
+        self.maximum = maximum
+        self.count = 1
+        self.slow_start = True
+
+    def succeeded(self, latency):
+        if latency > DOWNLOAD_LATENCY_TARGET:
+            self._decrease()
+        elif self.slow_start:
+            self.count = min(self.maximum, self.count * 2)
+        else:
+            self.count = min(self.maximum, self.count + 1)
+
+    def failed(self):
+        self._decrease()
+
+    def _decrease(self):
+        self.slow_start = False
+        self.count = max(1, self.count // 2)
+
+
 class GmailFolderSyncEngine(FolderSyncEngine):
 
     def __init__(self, *args, **kwargs):
         FolderSyncEngine.__init__(self, *args, **kwargs)
         self.saved_uids = set()
+        self.download_batch_size = DownloadBatchSize()
 
     def is_all_mail(self, crispin_client):
         if not hasattr(self, '_is_all_mail'):
@@ -225,13 +265,10 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         try:
             remote_uids = sorted(crispin_client.all_uids(), key=int)
             with self.syncmanager_lock:
-                with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
-                common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids) - set(remote_uids))
-                unknown_uids = set(remote_uids) - local_uids
+                self.uid_snapshot.load()
+                expunged_uids, unknown_uids = self.uid_snapshot.compare(
+                    remote_uids)
+                self.remove_deleted_uids(expunged_uids)
                 with session_scope(self.namespace_id) as db_session:
                     self.update_uid_counts(
                         db_session, remote_uid_count=len(remote_uids),
@@ -316,6 +353,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             imap_folder_info_entry.uidvalidity = uidvalidity
             imap_folder_info_entry.highestmodseq = None
             db_session.commit()
+        self.uid_snapshot.invalidate()
 
     def __deduplicate_message_object_creation(self, db_session, raw_messages,
                                               account):
@@ -324,11 +362,9 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         Message object for this raw message, we don't create a new one. But we
         do create a new ImapUid, associate it to the message, and update flags
         and categories accordingly.
-        Note: we could do this prior to downloading the actual message
-        body, but that's really more complicated than it's worth. This
-        operation is not super common unless you're regularly moving lots
-        of messages to trash or spam, and even then the overhead of just
-        downloading the body is generally not that high.
+        Note: fetch_raw_messages already skips downloading the bodies of
+        messages we've saved before, so `raw_messages` may include messages
+        without a body.
 
         """
         new_g_msgids = {msg.g_msgid for msg in raw_messages}
@@ -371,6 +407,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 common.update_message_metadata(
                     db_session, account, message_obj, uid.is_draft)
                 db_session.commit()
+                self.uid_snapshot.add([raw_message.uid])
 
         return brand_new_messages
 
@@ -387,9 +424,43 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             message_obj.thread = ImapThread.from_gmail_message(
                 db_session, self.namespace_id, message_obj)
 
-    def download_and_commit_uids(self, crispin_client, uids):
+    def fetch_raw_messages(self, crispin_client, uids, metadata=None):
+        """
+        Download the messages for `uids`. Only messages we haven't already
+        saved (from another folder, or under another UID) are downloaded in
+        full; for the others, which only need a new ImapUid, we just fetch
+        their flags and labels and return RawMessages without bodies.
+
+        """
+        if metadata is not None and all(uid in metadata for uid in uids):
+            uid_g_msgids = {uid: metadata[uid].g_msgid for uid in uids}
+        else:
+            uid_g_msgids = crispin_client.g_msgids(uids)
+        with session_scope(self.namespace_id) as db_session:
+            existing_g_msgids = g_msgids(self.namespace_id, db_session,
+                                         in_=set(uid_g_msgids.values()))
+        known_uids = [uid for uid in uids
+                      if uid_g_msgids.get(uid) in existing_g_msgids]
+        raw_messages = []
+        if known_uids:
+            flags = crispin_client.flags(known_uids)
+            raw_messages.extend(
+                RawMessage(uid=long(uid), internaldate=None,
+                           flags=flags[uid].flags, body=None, g_thrid=None,
+                           g_msgid=long(uid_g_msgids[uid]),
+                           g_labels=flags[uid].labels)
+                for uid in known_uids if uid in flags)
+            statsd_client.incr('mailsync.gmail.body_downloads_skipped',
+                               len(known_uids))
+        unknown_uids = [uid for uid in uids if uid not in known_uids]
+        if unknown_uids:
+            raw_messages.extend(crispin_client.uids(unknown_uids))
+        return raw_messages
+
+    def download_and_commit_uids(self, crispin_client, uids, metadata=None):
         start = datetime.utcnow()
-        raw_messages = crispin_client.uids(uids)
+        raw_messages = self.fetch_raw_messages(crispin_client, uids,
+                                               metadata)
         if not raw_messages:
             return
         new_uids = set()
@@ -402,6 +473,15 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 if not raw_messages:
                     return 0
 
+                missing_bodies = [m.uid for m in raw_messages
+                                  if m.body is None]
+                if missing_bodies:
+                    # The messages we didn't download because we'd already
+                    # saved them have since been deleted.
+                    raw_messages = [m for m in raw_messages
+                                    if m.body is not None]
+                    raw_messages.extend(crispin_client.uids(missing_bodies))
+
                 for msg in raw_messages:
                     uid = self.create_message(db_session, account, folder,
                                               msg)
@@ -409,6 +489,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                         db_session.add(uid)
                         db_session.commit()
                         new_uids.add(uid)
+                        self.uid_snapshot.add([uid.msg_uid])
 
         log.debug('Committed new UIDs',
                   new_committed_message_count=len(new_uids))
@@ -450,26 +531,38 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 yield uid
 
     def batch_download_uids(self, crispin_client, uids, metadata,
-                            max_download_bytes=MAX_DOWNLOAD_BYTES,
-                            max_download_count=MAX_DOWNLOAD_COUNT):
+                            max_download_bytes=MAX_DOWNLOAD_BYTES):
         expanded_pending_uids = self.expand_uids_to_download(
             crispin_client, uids, metadata)
+        # A UID which didn't fit in the previous batch.
+        held_uid = None
         count = 0
         while True:
             dl_size = 0
             batch = []
-            while (dl_size < max_download_bytes and
-                   len(batch) < max_download_count):
-                try:
-                    uid = expanded_pending_uids.next()
-                except StopIteration:
+            while len(batch) < self.download_batch_size.count:
+                if held_uid is not None:
+                    uid, held_uid = held_uid, None
+                else:
+                    uid = next(expanded_pending_uids, None)
+                    if uid is None:
+                        break
+                size = metadata[uid].size if uid in metadata else 0
+                if batch and dl_size + size > max_download_bytes:
+                    held_uid = uid
                     break
                 batch.append(uid)
-                if uid in metadata:
-                    dl_size += metadata[uid].size
+                dl_size += size
             if not batch:
                 return
-            self.download_and_commit_uids(crispin_client, batch)
+            start = datetime.utcnow()
+            try:
+                self.download_and_commit_uids(crispin_client, batch,
+                                              metadata)
+            except CONN_RETRY_EXC_CLASSES:
+                self.download_batch_size.failed()
+                raise
+            self.download_batch_size.succeeded(datetime.utcnow() - start)
             self.heartbeat_status.publish()
             count += len(batch)
             if self.throttled and count >= THROTTLE_COUNT:
@@ -478,7 +571,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 # messages for this batch are synced.
                 # Note this is an approx. limit since we use the #(uids),
                 # not the #(messages).
-                gevent.sleep(THROTTLE_WAIT)
+                gevent.sleep(THROTTLE_WAIT * len(batch))
 
     @property
     def throttled(self):
@@ -11,22 +11,36 @@ Eventually we're going to want a better way of ACLing functions that operate on
 accounts.
 
 """
+import json
+from collections import defaultdict, namedtuple
 from datetime import datetime
 
 from sqlalchemy import bindparam, desc
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import func
 
 from inbox.contacts.process_mail import update_contacts_from_message
 from inbox.models import Account, Message, Folder, ActionLog
-from inbox.models.backends.imap import ImapUid, ImapFolderInfo
+from inbox.models import Label
+from inbox.models.backends.imap import (ImapUid, ImapFolderInfo, LabelItem,
+                                        flag_column_values, label_keys)
 from inbox.models.session import session_scope
 from inbox.models.util import reconcile_message
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.util.itert import chunk
 from nylas.logging import get_logger
 
 log = get_logger()
 
+# Number of expunged UIDs handled per database transaction in
+# remove_deleted_uids.
+EXPUNGE_CHUNK_SIZE = 200
+
+# Number of changed UIDs handled per database transaction in
+# update_metadata.
+METADATA_CHUNK_SIZE = 500
+
 
 def local_uids(account_id, session, folder_id, limit=None):
     q = bakery(lambda session: session.query(ImapUid.msg_uid))
@@ -52,6 +66,22 @@ def lastseenuid(account_id, session, folder_id):
     return res or 0
 
 
+def uid_checksum(account_id, session, folder_id):
+    """
+    The number and sum of the saved UIDs for the folder, to check the sync
+    engine's in-memory UID snapshot against.
+
+    """
+    q = bakery(lambda session: session.query(func.count(ImapUid.msg_uid),
+                                             func.sum(ImapUid.msg_uid)))
+    q += lambda q: q.filter(
+        ImapUid.account_id == bindparam('account_id'),
+        ImapUid.folder_id == bindparam('folder_id'))
+    count, total = q(session).params(account_id=account_id,
+                                     folder_id=folder_id).one()
+    return count or 0, int(total or 0)
+
+
 def update_message_metadata(session, account, message, is_draft):
     # Update the message's metadata.
     uids = message.imapuids
@@ -80,6 +110,13 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
     """
     Update flags and labels (the only metadata that can change).
 
+    Only the UIDs whose flags or labels changed are updated: their ImapUid
+    rows with one UPDATE per distinct set of flag values, and their labels
+    with bulk deletes and inserts. Their messages' metadata is then
+    recomputed through the ORM, so that the flush hooks record the changes
+    (Transaction rows, thread summaries and category counters). Changes are
+    committed every METADATA_CHUNK_SIZE UIDs.
+
     Make sure you're holding a db write lock on the account. (We don't try
     to grab the lock in here in case the caller needs to put higher-level
     functionality in the lock.)
@@ -88,31 +125,118 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
     if not new_flags:
         return
 
-    account = Account.get(account_id, session)
-    change_count = 0
-    for item in session.query(ImapUid).filter(
-            ImapUid.account_id == account_id,
-            ImapUid.msg_uid.in_(new_flags.keys()),
-            ImapUid.folder_id == folder_id):
-        flags = new_flags[item.msg_uid].flags
-        labels = getattr(new_flags[item.msg_uid], 'labels', None)
-
-        # TODO(emfree) refactor so this is only ever relevant for Gmail.
-        changed = item.update_flags(flags)
-        if labels is not None:
-            item.update_labels(labels)
-            changed = True
-
-        if changed:
-            change_count += 1
-            is_draft = item.is_draft and (folder_role == 'drafts' or
-                                          folder_role == 'all')
-            update_message_metadata(session, account, item.message, is_draft)
+    changes = _imapuid_changes(account_id, folder_id, folder_role, new_flags,
+                               session)
+    if changes:
+        account = Account.get(account_id, session)
+        for change_chunk in chunk(changes, METADATA_CHUNK_SIZE):
+            _apply_imapuid_changes(session, account, change_chunk)
+            is_draft = {change.message_id: change.message_is_draft
+                        for change in change_chunk}
+            # The UIDs were updated behind the session's back.
+            messages = session.query(Message).filter(
+                Message.id.in_(is_draft)).populate_existing().options(
+                subqueryload(Message.imapuids).
+                subqueryload(ImapUid.labelitems).
+                joinedload(LabelItem.label))
+            for message in messages:
+                update_message_metadata(session, account, message,
+                                        is_draft[message.id])
             session.commit()
-    log.info('Updated UID metadata', changed=change_count,
+    log.info('Updated UID metadata', changed=len(changes),
              out_of=len(new_flags))
 
 
+# A change to a UID's metadata: the new values of its flag columns (None if
+# they're unchanged), the (name, canonical_name) keys of the labels to add
+# to it, the ids of the LabelItems to remove from it, and whether its
+# message is now a draft.
+ImapUidChange = namedtuple('ImapUidChange', [
+    'imapuid_id', 'message_id', 'values', 'add_labels', 'remove_labelitems',
+    'message_is_draft'])
+
+
+def _imapuid_changes(account_id, folder_id, folder_role, new_flags, session):
+    # Compare the new flags and labels against a projection of the stored
+    # ones, so that only the rows which actually changed are updated and
+    # have their message metadata recomputed.
+    flag_columns = ['is_draft', 'is_seen', 'is_recent', 'is_answered',
+                    'is_flagged', 'extra_flags']
+    rows = session.query(ImapUid.id, ImapUid.msg_uid, ImapUid.message_id,
+                         Message.is_draft.label('message_is_draft'),
+                         *[getattr(ImapUid, col) for col in flag_columns]). \
+        join(Message). \
+        filter(ImapUid.account_id == account_id,
+               ImapUid.msg_uid.in_(new_flags.keys()),
+               ImapUid.folder_id == folder_id).all()
+
+    local_labels = defaultdict(dict)
+    if any(getattr(f, 'labels', None) is not None for f in
+           new_flags.itervalues()) and rows:
+        for imapuid_id, labelitem_id, name, canonical_name in session.query(
+                LabelItem.imapuid_id, LabelItem.id, Label.name,
+                Label.canonical_name). \
+                join(Label). \
+                filter(LabelItem.imapuid_id.in_([r.id for r in rows])):
+            local_labels[imapuid_id][name, canonical_name] = labelitem_id
+
+    changes = []
+    for row in rows:
+        flags = new_flags[row.msg_uid].flags
+        labels = getattr(new_flags[row.msg_uid], 'labels', None)
+        values = flag_column_values(flags)
+        add_labels = set()
+        remove_labelitems = []
+        if labels is not None:
+            # Gmail IMAP doesn't use the normal IMAP \\Draft flag.
+            values['is_draft'] = '\\Draft' in labels
+            remote = label_keys(labels)
+            local = local_labels[row.id]
+            add_labels = remote.difference(local)
+            remove_labelitems = [labelitem_id for key, labelitem_id in
+                                 local.iteritems() if key not in remote]
+        message_is_draft = values['is_draft'] and (folder_role == 'drafts' or
+                                                   folder_role == 'all')
+        if not any(getattr(row, col) != values[col] for col in flag_columns):
+            values = None
+        if (values is not None or add_labels or remove_labelitems or
+                row.message_is_draft != message_is_draft):
+            changes.append(ImapUidChange(row.id, row.message_id, values,
+                                         add_labels, remove_labelitems,
+                                         message_is_draft))
+    return changes
+
+
+def _apply_imapuid_changes(session, account, changes):
+    table = ImapUid.__table__
+    groups = defaultdict(list)
+    for change in changes:
+        if change.values is not None:
+            groups[json.dumps(change.values, sort_keys=True)].append(
+                change.imapuid_id)
+    for values, imapuid_ids in sorted(groups.iteritems()):
+        session.execute(table.update().where(
+            table.c.id.in_(imapuid_ids)).values(json.loads(values)))
+
+    remove_labelitems = [labelitem_id for change in changes
+                         for labelitem_id in change.remove_labelitems]
+    if remove_labelitems:
+        session.execute(LabelItem.__table__.delete().where(
+            LabelItem.__table__.c.id.in_(remove_labelitems)))
+
+    add_labels = {key for change in changes for key in change.add_labels}
+    if add_labels:
+        with session.no_autoflush:
+            labels = {(name, canonical_name): Label.find_or_create(
+                session, account, name, canonical_name)
+                for name, canonical_name in add_labels}
+        # Assign ids to new labels.
+        session.flush()
+        session.bulk_insert_mappings(LabelItem, [
+            dict(imapuid_id=change.imapuid_id, label_id=labels[key].id)
+            for change in changes for key in change.add_labels])
+
+
 def remove_deleted_uids(account_id, folder_id, uids):
     """
     Make sure you're holding a db write lock on the account. (We don't try
@@ -123,27 +247,33 @@ def remove_deleted_uids(account_id, folder_id, uids):
     if not uids:
         return
     deleted_uid_count = 0
-    for uid in uids:
-        # We do this one-uid-at-a-time because issuing many deletes within a
-        # single database transaction is problematic. But loading many
-        # objects into a session and then frequently calling commit() is also
-        # bad, because expiring objects and checking for revisions is O(number
-        # of objects in session), resulting in quadratic runtimes.
-        # Performance could perhaps be additionally improved by choosing a
-        # sane balance, e.g., operating on 10 or 100 uids or something at once.
+    # Issuing many deletes within a single database transaction is
+    # problematic, but so is loading many objects into a session and then
+    # frequently calling commit(), because expiring objects and checking for
+    # revisions is O(number of objects in session). So we work in chunks: for
+    # each chunk, the ImapUid rows are deleted with a single statement, and
+    # the affected messages are then loaded together to update their
+    # metadata, all in one transaction.
+    for uid_chunk in chunk(sorted(uids), EXPUNGE_CHUNK_SIZE):
         with session_scope(account_id) as db_session:
-            imapuid = db_session.query(ImapUid).filter(
-                ImapUid.account_id == account_id,
-                ImapUid.folder_id == folder_id,
-                ImapUid.msg_uid == uid).first()
-            if imapuid is None:
+            imapuids = db_session.query(ImapUid.id, ImapUid.message_id). \
+                filter(ImapUid.account_id == account_id,
+                       ImapUid.folder_id == folder_id,
+                       ImapUid.msg_uid.in_(uid_chunk)).all()
+            if not imapuids:
                 continue
-            deleted_uid_count += 1
-            message = imapuid.message
-
-            db_session.delete(imapuid)
-
-            if message is not None:
+            deleted_uid_count += len(imapuids)
+
+            # LabelItems are removed by the database's ON DELETE CASCADE.
+            db_session.query(ImapUid).filter(
+                ImapUid.id.in_([id_ for id_, _ in imapuids])). \
+                delete(synchronize_session=False)
+
+            account = Account.get(account_id, db_session)
+            messages = db_session.query(Message).filter(
+                Message.id.in_({message_id for _, message_id in imapuids})). \
+                options(subqueryload(Message.imapuids))
+            for message in messages:
                 if not message.imapuids and message.is_draft:
                     # Synchronously delete drafts.
                     thread = message.thread
@@ -153,7 +283,6 @@ def remove_deleted_uids(account_id, folder_id, uids):
                     if thread is not None and not thread.messages:
                         db_session.delete(thread)
                 else:
-                    account = Account.get(account_id, db_session)
                     update_message_metadata(db_session, account, message,
                                             message.is_draft)
                     if not message.imapuids:
@@ -0,0 +1,86 @@
+"""
+How many connections an account's initial sync downloads mail on at once.
+
+Providers whose servers handle concurrent sessions well set a
+"sync_concurrency" (see inbox.providers). The sync monitor then runs initial
+sync for that many folders at once, and folder sync engines use any
+connections left over to download further ranges of UIDs of their folder
+concurrently. If the server starts rejecting or dropping the additional
+connections, we take that as throttling: the limit is halved, and then raised
+again by one connection every BACKOFF_RECOVERY_INTERVAL without errors.
+
+"""
+from datetime import datetime, timedelta
+
+from inbox.providers import sync_concurrency
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+
+log = get_logger()
+
+BACKOFF_RECOVERY_INTERVAL = timedelta(minutes=10)
+
+
+def download_concurrency(account_id, provider, concurrency_map=dict()):
+    """ Per-account download concurrency, shared by the account's sync
+    monitor and folder sync engines. """
+    if account_id not in concurrency_map:
+        concurrency_map[account_id] = DownloadConcurrency(account_id,
+                                                          provider)
+    return concurrency_map[account_id]
+
+
+class DownloadConcurrency(object):
+    """
+    Limit on the number of connections downloading an account's mail.
+
+    Parameters
+    ----------
+    account_id : int
+        The account.
+    provider : str
+        The account's provider, whose "sync_concurrency" is the limit when
+        the server isn't throttling us.
+    """
+
+    def __init__(self, account_id, provider):
+        self.account_id = account_id
+        self.maximum = sync_concurrency(provider)
+        self._limit = self.maximum
+        self._last_change = None
+        self.in_use = 0
+
+    @property
+    def limit(self):
+        if self._limit < self.maximum and \
+                datetime.utcnow() > self._last_change + \
+                BACKOFF_RECOVERY_INTERVAL:
+            self._limit += 1
+            self._last_change = datetime.utcnow()
+            log.info('Raising download concurrency',
+                     account_id=self.account_id, limit=self._limit)
+        return self._limit
+
+    def add(self):
+        """Count a connection which is downloading regardless of the
+        limit."""
+        self.in_use += 1
+
+    def acquire(self):
+        """Count an additional download connection, if the limit allows
+        one. Returns True if it does."""
+        if self.in_use >= self.limit:
+            return False
+        self.in_use += 1
+        return True
+
+    def release(self, count=1):
+        self.in_use -= count
+
+    def backoff(self):
+        """The server rejected or dropped a download connection."""
+        self._limit = max(1, self._limit // 2)
+        self._last_change = datetime.utcnow()
+        log.warning('Server throttling concurrent downloads, backing off',
+                    account_id=self.account_id, limit=self._limit)
+        statsd_client.incr('mailsync.download_concurrency.backoff')
@@ -11,7 +11,10 @@ The IMAP sync engine runs per-folder on each account.
 
 Only one initial sync can be running per-account at a time, to avoid
 hammering the IMAP backend too hard (Gmail shards per-user, so parallelizing
-folder download won't actually increase our throughput anyway).
+folder download won't actually increase our throughput anyway), unless the
+provider's "sync_concurrency" allows more. Then several folders' initial syncs
+run at once, and a folder's initial sync can download on several connections
+(see inbox.mailsync.backends.imap.concurrency).
 
 Any time we reconnect, we have to make sure the folder's uidvalidity hasn't
 changed, and if it has, we need to update the UIDs for any messages we've
@@ -62,8 +65,10 @@ sessions reduce scalability.
 """
 from __future__ import division
 
+from collections import deque
 from datetime import datetime, timedelta
 from gevent import Greenlet
+from gevent.queue import Queue
 import gevent
 import imaplib
 from sqlalchemy import func
@@ -73,19 +78,24 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.basicauth import ValidationError
 from inbox.util.concurrency import retry_with_logging
+from inbox.util.blockstore import deferred_saves
 from inbox.util.debug import bind_context
-from inbox.util.itert import chunk
+from inbox.util.itert import chunk, chunk_by_size
 from inbox.util.misc import or_none
-from inbox.util.threading import fetch_corresponding_thread, MAX_THREAD_LENGTH
+from inbox.util.threading import (fetch_corresponding_thread,
+                                  add_to_threading_index, MAX_THREAD_LENGTH)
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 log = get_logger()
-from inbox.crispin import connection_pool, retry_crispin, FolderMissingError
+from inbox.crispin import (connection_pool, retry_crispin, FolderMissingError,
+                           CONN_RETRY_EXC_CLASSES)
 from inbox.models import Folder, Account, Message
 from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapThread,
                                         ImapUid, ImapFolderInfo)
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.imap import common
+from inbox.mailsync.backends.imap.concurrency import download_concurrency
+from inbox.mailsync.backends.imap.uids import UidSnapshot
 from inbox.mailsync.backends.base import (MailsyncDone, MailsyncError,
                                           THROTTLE_COUNT, THROTTLE_WAIT)
 from inbox.heartbeat.store import HeartbeatStatusProxy
@@ -109,6 +119,16 @@ MAX_UIDINVALID_RESYNCS = 5
 
 CONDSTORE_FLAGS_REFRESH_BATCH_SIZE = 200
 
+# Bounds for the batches of messages we download with a single UID FETCH
+# during initial sync. Message sizes are looked up in chunks of
+# SIZE_FETCH_CHUNK_SIZE UIDs beforehand.
+MAX_DOWNLOAD_BYTES = 2 ** 20
+MAX_DOWNLOAD_COUNT = 50
+SIZE_FETCH_CHUNK_SIZE = 1024
+# Maximum number of downloaded-but-uncommitted batches held in memory by the
+# initial sync download pipeline.
+DOWNLOAD_QUEUE_SIZE = 4
+
 
 class FolderSyncEngine(Greenlet):
     """Base class for a per-folder IMAP sync engine."""
@@ -147,7 +167,13 @@ class FolderSyncEngine(Greenlet):
         self.provider_name = provider_name
         self.last_fast_refresh = None
         self.flags_fetch_results = {}
+        # The UIDs saved for the folder, so that we don't have to load them
+        # all from the database every poll.
+        self.uid_snapshot = UidSnapshot(account_id, namespace_id,
+                                        self.folder_id)
         self.conn_pool = connection_pool(self.account_id)
+        self.download_concurrency = download_concurrency(
+            self.account_id, self.conn_pool.provider)
 
         self.state_handlers = {
             'initial': self.initial_sync,
@@ -339,14 +365,13 @@ class FolderSyncEngine(Greenlet):
             assert crispin_client.selected_folder_name == self.folder_name
             remote_uids = crispin_client.all_uids()
             with self.syncmanager_lock:
-                with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
-                common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids).difference(remote_uids))
+                # (Re)load the UID snapshot, in case another process synced
+                # this folder before us.
+                self.uid_snapshot.load()
+                expunged_uids, new_uids = self.uid_snapshot.compare(
+                    remote_uids)
+                self.remove_deleted_uids(expunged_uids)
 
-            new_uids = set(remote_uids).difference(local_uids)
             with session_scope(self.namespace_id) as db_session:
                 account = db_session.query(Account).get(self.account_id)
                 throttled = account.throttled
@@ -360,24 +385,140 @@ class FolderSyncEngine(Greenlet):
             bind_context(change_poller, 'changepoller', self.account_id,
                          self.folder_id)
             uids = sorted(new_uids, reverse=True)
+            self.pipelined_download_and_commit(crispin_client, uids,
+                                               throttled)
+        finally:
+            if change_poller is not None:
+                # schedule change_poller to die
+                gevent.kill(change_poller)
+
+    def _download_batches(self, crispin_client, uids):
+        # UIDs might have been expunged since we listed them, in which case
+        # the sizes call returns nothing for them and we can skip them.
+        sizes = crispin_client.sizes(uids)
+        uids = [u for u in uids if u in sizes]
+        # Group UIDs into byte-bounded batches, so that a single UID FETCH
+        # round trip and a single database transaction covers many small
+        # messages.
+        return chunk_by_size(uids, sizes.get, MAX_DOWNLOAD_BYTES,
+                             MAX_DOWNLOAD_COUNT)
+
+    def pipelined_download_and_commit(self, crispin_client, uids,
+                                      throttled=False):
+        """
+        Download and commit UIDs with a two-stage pipeline: network greenlets
+        keep issuing UID FETCHes while the calling greenlet parses and
+        commits what has already been downloaded. The bounded queue between
+        the stages provides backpressure, so at most DOWNLOAD_QUEUE_SIZE
+        downloaded batches are held in memory at any time.
+
+        The network greenlets take the UIDs SIZE_FETCH_CHUNK_SIZE at a time,
+        in order. One downloads on `crispin_client`, and if the account's
+        download concurrency allows, more download on connections of their
+        own.
+
+        """
+        queue = Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+        uid_chunks = deque(chunk(uids, SIZE_FETCH_CHUNK_SIZE))
+
+        def fetch(client):
+            while uid_chunks:
+                uid_chunk = uid_chunks.popleft()
+                fetched = set()
+                try:
+                    for batch in self._download_batches(client, uid_chunk):
+                        start = datetime.utcnow()
+                        raw_messages = client.uids(batch)
+                        self._report_pipeline_stage('fetch', start,
+                                                    len(raw_messages))
+                        queue.put((raw_messages, start))
+                        statsd_client.gauge('mailsync.pipeline.queue_depth',
+                                            queue.qsize())
+                        fetched.update(batch)
+                except Exception:
+                    # Leave the rest of the chunk for the other greenlets.
+                    uid_chunks.appendleft(
+                        tuple(u for u in uid_chunk if u not in fetched))
+                    raise
+
+        def fetch_on_new_connection():
+            try:
+                with self.conn_pool.get() as client:
+                    client.select_folder(self.folder_name,
+                                         self.uidvalidity_cb)
+                    fetch(client)
+            except CONN_RETRY_EXC_CLASSES:
+                # Probably the server limiting concurrent sessions. The
+                # other connections carry on with the remaining UIDs.
+                log.warning('Error on additional download connection',
+                            exc_info=True)
+                self.download_concurrency.backoff()
+
+        def run(func, *args):
+            try:
+                func(*args)
+            finally:
+                # Wake up the commit stage, so that it re-raises any error or
+                # finishes.
+                queue.put(None)
+
+        fetchers = []
+
+        def spawn(func, *args):
+            fetcher = gevent.spawn(run, func, *args)
+            bind_context(fetcher, 'downloader', self.account_id,
+                         self.folder_id)
+            fetchers.append(fetcher)
+
+        self.download_concurrency.add()
+        connections = 1
+        try:
+            spawn(fetch, crispin_client)
+            while not throttled and len(uid_chunks) > connections and \
+                    self.download_concurrency.acquire():
+                connections += 1
+                spawn(fetch_on_new_connection)
+
             count = 0
-            for uid in uids:
-                # The speedup from batching appears to be less clear for
-                # non-Gmail accounts, so for now just download one-at-a-time.
-                self.download_and_commit_uids(crispin_client, [uid])
+            finished = 0
+            while True:
+                item = queue.get()
+                if item is None:
+                    # Re-raises any exception from the network stage.
+                    for fetcher in fetchers:
+                        if fetcher.ready():
+                            fetcher.get()
+                    finished += 1
+                    if finished < len(fetchers):
+                        continue
+                    if not uid_chunks:
+                        return
+                    # Additional connections failed and left UIDs behind.
+                    spawn(fetch, crispin_client)
+                    continue
+                raw_messages, start = item
+                commit_start = datetime.utcnow()
+                committed = self.commit_raw_messages(raw_messages, start)
+                self._report_pipeline_stage('commit', commit_start, committed)
                 self.heartbeat_status.publish()
-                count += 1
+                count += len(raw_messages)
                 if throttled and count >= THROTTLE_COUNT:
                     # Throttled accounts' folders sync at a rate of
                     # 1 message/ minute, after the first approx. THROTTLE_COUNT
                     # messages per folder are synced.
                     # Note this is an approx. limit since we use the #(uids),
                     # not the #(messages).
-                    gevent.sleep(THROTTLE_WAIT)
+                    gevent.sleep(THROTTLE_WAIT * len(raw_messages))
         finally:
-            if change_poller is not None:
-                # schedule change_poller to die
-                gevent.kill(change_poller)
+            gevent.killall(fetchers)
+            self.download_concurrency.release(connections)
+
+    def _report_pipeline_stage(self, stage, start, message_count):
+        latency = (datetime.utcnow() - start).total_seconds() * 1000
+        statsd_client.timing('mailsync.pipeline.{}.latency'.format(stage),
+                             latency)
+        statsd_client.incr('mailsync.pipeline.{}.messages'.format(stage),
+                           message_count)
 
     def should_idle(self, crispin_client):
         if not hasattr(self, '_should_idle'):
@@ -442,6 +583,7 @@ class FolderSyncEngine(Greenlet):
         with self.syncmanager_lock:
             common.remove_deleted_uids(self.account_id, self.folder_id,
                                        invalid_uids)
+        self.uid_snapshot.invalidate()
         self.uidvalidity = remote_uidvalidity
         self.highestmodseq = None
         self.uidnext = remote_uidnext
@@ -473,7 +615,11 @@ class FolderSyncEngine(Greenlet):
             log.warning('Server returned a message with an empty body.')
             return None
 
-        new_uid = common.create_imap_message(db_session, acct, folder, msg)
+        # The raw message and its attachments are saved to the blockstore
+        # together.
+        with deferred_saves():
+            new_uid = common.create_imap_message(db_session, acct, folder,
+                                                 msg)
         self.add_message_to_thread(db_session, new_uid.message, msg)
 
         db_session.flush()
@@ -529,10 +675,16 @@ class FolderSyncEngine(Greenlet):
                     db_session, self.namespace_id, message_obj)
             else:
                 parent_thread.messages.append(message_obj)
+            add_to_threading_index(db_session, self.namespace_id, message_obj)
 
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
         raw_messages = crispin_client.uids(uids)
+        return self.commit_raw_messages(raw_messages, start)
+
+    def commit_raw_messages(self, raw_messages, start):
+        """Save downloaded messages in a single database transaction. `start`
+        is when their download began, for reporting message velocity."""
         if not raw_messages:
             return 0
 
@@ -541,14 +693,18 @@ class FolderSyncEngine(Greenlet):
             with session_scope(self.namespace_id) as db_session:
                 account = Account.get(self.account_id, db_session)
                 folder = Folder.get(self.folder_id, db_session)
-                for msg in raw_messages:
-                    uid = self.create_message(db_session, account,
-                                              folder, msg)
-                    if uid is not None:
-                        db_session.add(uid)
-                        db_session.flush()
-                        new_uids.add(uid)
+                # Save the whole batch's blobs concurrently, before the
+                # messages are committed.
+                with deferred_saves():
+                    for msg in raw_messages:
+                        uid = self.create_message(db_session, account,
+                                                  folder, msg)
+                        if uid is not None:
+                            db_session.add(uid)
+                            db_session.flush()
+                            new_uids.add(uid)
                 db_session.commit()
+            self.uid_snapshot.add(uid.msg_uid for uid in new_uids)
 
         log.debug('Committed new UIDs', new_committed_message_count=len(new_uids))
         # If we downloaded uids, record message velocity (#uid / latency)
@@ -627,9 +783,7 @@ class FolderSyncEngine(Greenlet):
                   remote_uidnext=remote_uidnext, saved_uidnext=self.uidnext)
 
         crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        with session_scope(self.namespace_id) as db_session:
-            lastseenuid = common.lastseenuid(self.account_id, db_session,
-                                             self.folder_id)
+        lastseenuid = self.uid_snapshot.last()
         latest_uids = crispin_client.conn.fetch('{}:*'.format(lastseenuid + 1),
                                                 ['UID']).keys()
         new_uids = set(latest_uids) - {lastseenuid}
@@ -686,25 +840,18 @@ class FolderSyncEngine(Greenlet):
                 interim_highestmodseq = max(v.modseq for k, v in flag_batch)
                 self.highestmodseq = interim_highestmodseq
 
-        with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(self.account_id, db_session,
-                                           self.folder_id)
-            expunged_uids = set(local_uids).difference(remote_uids)
+        expunged_uids = self.expunged_uids(remote_uids)
 
         if expunged_uids:
             # If new UIDs have appeared since we last checked in
             # get_new_uids, save them first. We want to always have the
             # latest UIDs before expunging anything, in order to properly
             # capture draft revisions.
-            with session_scope(self.namespace_id) as db_session:
-                lastseenuid = common.lastseenuid(self.account_id, db_session,
-                                                 self.folder_id)
-            if remote_uids and lastseenuid < max(remote_uids):
+            if remote_uids and self.uid_snapshot.last() < max(remote_uids):
                 log.info('Downloading new UIDs before expunging')
                 self.get_new_uids(crispin_client)
             with self.syncmanager_lock:
-                common.remove_deleted_uids(self.account_id, self.folder_id,
-                                           expunged_uids)
+                self.remove_deleted_uids(expunged_uids)
         self.highestmodseq = new_highestmodseq
 
     def generic_refresh_flags(self, crispin_client):
@@ -718,6 +865,9 @@ class FolderSyncEngine(Greenlet):
             now > self.last_fast_refresh + FAST_REFRESH_INTERVAL
         )
         if slow_refresh_due:
+            # Also a good time to check that the UID snapshot hasn't drifted
+            # from the database.
+            self.uid_snapshot.verify()
             self.refresh_flags_impl(crispin_client, SLOW_FLAGS_REFRESH_LIMIT)
             self.last_slow_refresh = datetime.utcnow()
         elif fast_refresh_due:
@@ -726,11 +876,7 @@ class FolderSyncEngine(Greenlet):
 
     def refresh_flags_impl(self, crispin_client, max_uids):
         crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(account_id=self.account_id,
-                                           session=db_session,
-                                           folder_id=self.folder_id,
-                                           limit=max_uids)
+        local_uids = self.uid_snapshot.highest(max_uids)
 
         flags = crispin_client.flags(local_uids)
         if (max_uids in self.flags_fetch_results and
@@ -744,14 +890,27 @@ class FolderSyncEngine(Greenlet):
                   max_uids=max_uids)
         expunged_uids = set(local_uids).difference(flags.keys())
         with self.syncmanager_lock:
-            common.remove_deleted_uids(self.account_id, self.folder_id,
-                                       expunged_uids)
+            self.remove_deleted_uids(expunged_uids)
         with self.syncmanager_lock:
             with session_scope(self.namespace_id) as db_session:
                 common.update_metadata(self.account_id, self.folder_id,
                                        self.folder_role, flags, db_session)
         self.flags_fetch_results[max_uids] = (local_uids, flags)
 
+    def expunged_uids(self, remote_uids):
+        """The saved UIDs which are no longer in the remote folder."""
+        expunged_uids, _ = self.uid_snapshot.compare(remote_uids)
+        if expunged_uids and not self.uid_snapshot.verify():
+            # Don't delete anything based on a stale snapshot.
+            expunged_uids, _ = self.uid_snapshot.compare(remote_uids)
+        return expunged_uids
+
+    def remove_deleted_uids(self, uids):
+        """Remove expunged UIDs from the database and the UID snapshot. Call
+        with the syncmanager lock held."""
+        common.remove_deleted_uids(self.account_id, self.folder_id, uids)
+        self.uid_snapshot.remove(uids)
+
     def check_uid_changes(self, crispin_client):
         self.get_new_uids(crispin_client)
         if crispin_client.condstore_supported():
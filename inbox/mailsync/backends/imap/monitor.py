@@ -3,12 +3,14 @@ from gevent.pool import Group
 from gevent.coros import BoundedSemaphore
 from inbox.basicauth import ValidationError
 from nylas.logging import get_logger
-from inbox.crispin import retry_crispin, connection_pool
+from inbox.crispin import (retry_crispin, connection_pool,
+                           CONNECTION_POOL_SIZE)
 from inbox.models import Account, Folder
 from inbox.models.category import Category, sanitize_name
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.base import BaseMailSyncMonitor
 from inbox.mailsync.backends.imap.generic import FolderSyncEngine
+from inbox.mailsync.backends.imap.concurrency import download_concurrency
 from inbox.mailsync.gc import DeleteHandler
 log = get_logger()
 
@@ -37,6 +39,8 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
         self.delete_handler = None
 
         BaseMailSyncMonitor.__init__(self, account, heartbeat)
+        self.download_concurrency = download_concurrency(self.account_id,
+                                                         account.provider)
 
     @retry_crispin
     def prepare_sync(self):
@@ -44,7 +48,13 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
         Gets and save Folder objects for folders on the IMAP backend. Returns a
         list of folder names for the folders we want to sync (in order).
         """
-        with connection_pool(self.account_id).get() as crispin_client:
+        # Make room in the account's connection pool for the additional
+        # connections initial sync may download on.
+        pool = connection_pool(
+            self.account_id,
+            pool_size=CONNECTION_POOL_SIZE +
+            self.download_concurrency.maximum - 1)
+        with pool.get() as crispin_client:
             # Get a fresh list of the folder names from the remote
             remote_folders = crispin_client.folders()
             # The folders we should be syncing
@@ -120,6 +130,7 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
         running_monitors = {monitor.folder_name: monitor for monitor in
                             self.folder_monitors}
 
+        syncing = []
         for folder_name in self.prepare_sync():
             if folder_name in running_monitors:
                 thread = running_monitors[folder_name]
@@ -134,15 +145,34 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                                                 self.provider_name,
                                                 self.syncmanager_lock)
                 self.folder_monitors.start(thread)
+            syncing.append((folder_name, thread))
 
-            while not thread.state == 'poll' and not thread.ready():
-                sleep(self.heartbeat)
+            # Only start the next folder's initial sync once fewer than the
+            # download concurrency's limit are running.
+            syncing = self.wait_for_initial_syncs(
+                syncing, self.download_concurrency.limit - 1)
+        self.wait_for_initial_syncs(syncing, 0)
 
-            if thread.ready():
-                log.info('Folder sync engine exited',
-                         account_id=self.account_id,
-                         folder_name=folder_name,
-                         error=thread.exception)
+    def wait_for_initial_syncs(self, syncing, max_running):
+        """
+        Wait until at most `max_running` of the (folder name, sync engine)
+        pairs in `syncing` haven't finished initial sync, and return those.
+
+        """
+        while True:
+            running = []
+            for folder_name, thread in syncing:
+                if thread.ready():
+                    log.info('Folder sync engine exited',
+                             account_id=self.account_id,
+                             folder_name=folder_name,
+                             error=thread.exception)
+                elif thread.state != 'poll':
+                    running.append((folder_name, thread))
+            if len(running) <= max_running:
+                return running
+            syncing = running
+            sleep(self.heartbeat)
 
     def start_delete_handler(self):
         if self.delete_handler is None:
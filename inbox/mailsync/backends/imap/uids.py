@@ -0,0 +1,174 @@
+"""
+In-memory snapshot of the UIDs saved for a folder.
+
+Every poll, the folder sync engines compare the UIDs on the remote folder with
+the UIDs we've saved, in order to find expunged messages. Loading the saved
+UIDs from the database each time means fetching every row of the folder, which
+for a large All Mail folder is a million-row query every poll. Instead, each
+engine keeps a sorted array of its folder's UIDs, loaded once and then updated
+as it saves and removes UIDs. It's reloaded from the database when the
+engine starts, after a UIDVALIDITY change, and when its count and sum no longer
+match the database's.
+
+"""
+from array import array
+from bisect import bisect_left
+
+from gevent.lock import BoundedSemaphore
+
+from inbox.mailsync.backends.imap import common
+from inbox.models.session import session_scope
+from nylas.logging import get_logger
+
+log = get_logger()
+
+# IMAP UIDs are unsigned 32-bit ints (RFC 3501 section 2.3.1.1), so 4 bytes
+# per UID rather than the ~30 each one takes in a Python set.
+UID_TYPECODE = 'I'
+
+# Above this many UIDs, adding or removing them rebuilds the array in one pass
+# rather than inserting or deleting them one by one.
+BULK_UPDATE_THRESHOLD = 100
+
+
+class UidSnapshot(object):
+    """
+    Sorted array of the UIDs saved for a folder. All methods load the
+    snapshot from the database first if necessary.
+
+    """
+
+    def __init__(self, account_id, namespace_id, folder_id):
+        self.account_id = account_id
+        self.namespace_id = namespace_id
+        self.folder_id = folder_id
+        self._uids = None
+        # Held while loading from the database, so that UIDs added or removed
+        # by another greenlet in the meantime are applied to the loaded
+        # snapshot rather than lost.
+        self._lock = BoundedSemaphore(1)
+
+    @property
+    def loaded(self):
+        return self._uids is not None
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        with session_scope(self.namespace_id) as db_session:
+            uids = common.local_uids(self.account_id, db_session,
+                                     self.folder_id)
+        self._uids = array(UID_TYPECODE, sorted(uids))
+        log.debug('Loaded UID snapshot', uid_count=len(self._uids))
+
+    def invalidate(self):
+        """Discard the snapshot, so that it's reloaded when next used."""
+        with self._lock:
+            self._uids = None
+
+    def _ensure_loaded(self):
+        if self._uids is None:
+            self._load()
+
+    def verify(self):
+        """
+        Check the snapshot against the database, reloading it if they
+        disagree. Returns False if it had to be reloaded.
+
+        """
+        with self._lock:
+            if self._uids is None:
+                self._load()
+                return True
+            with session_scope(self.namespace_id) as db_session:
+                checksum = common.uid_checksum(self.account_id, db_session,
+                                               self.folder_id)
+            if checksum == (len(self._uids), sum(self._uids)):
+                return True
+            log.warning('UID snapshot out of date, reloading',
+                        snapshot_count=len(self._uids),
+                        saved_count=checksum[0])
+            self._load()
+            return False
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._uids)
+
+    def highest(self, limit):
+        """The `limit` highest saved UIDs, as a set."""
+        with self._lock:
+            self._ensure_loaded()
+            return set(self._uids[-limit:]) if limit else set()
+
+    def last(self):
+        """The highest saved UID, or 0 if there are none."""
+        with self._lock:
+            self._ensure_loaded()
+            return self._uids[-1] if self._uids else 0
+
+    def add(self, uids):
+        with self._lock:
+            if self._uids is None:
+                # Will be loaded with them.
+                return
+            uids = sorted(set(uids))
+            if not uids:
+                return
+            snapshot = self._uids
+            if not snapshot or uids[0] > snapshot[-1]:
+                # The common case: new messages get higher UIDs.
+                snapshot.extend(uids)
+            elif len(uids) > BULK_UPDATE_THRESHOLD:
+                self._uids = array(UID_TYPECODE,
+                                   sorted(set(snapshot).union(uids)))
+            else:
+                for uid in uids:
+                    i = bisect_left(snapshot, uid)
+                    if i == len(snapshot) or snapshot[i] != uid:
+                        snapshot.insert(i, uid)
+
+    def remove(self, uids):
+        with self._lock:
+            if self._uids is None:
+                return
+            uids = set(uids)
+            if not uids:
+                return
+            snapshot = self._uids
+            if len(uids) > BULK_UPDATE_THRESHOLD:
+                self._uids = array(UID_TYPECODE,
+                                   (uid for uid in snapshot
+                                    if uid not in uids))
+            else:
+                for uid in uids:
+                    i = bisect_left(snapshot, uid)
+                    if i < len(snapshot) and snapshot[i] == uid:
+                        del snapshot[i]
+
+    def compare(self, remote_uids):
+        """
+        Compare the snapshot with the UIDs on the remote folder. Returns a
+        pair of sets: the saved UIDs which are no longer on the remote, and
+        the remote UIDs which haven't been saved.
+
+        """
+        remote = array(UID_TYPECODE, sorted(remote_uids))
+        with self._lock:
+            self._ensure_loaded()
+            snapshot = self._uids
+            # Between polls the folder usually hasn't changed, and comparing
+            # the arrays' raw bytes doesn't create an object per UID.
+            saved = snapshot.tostring()
+            if remote.tostring() == saved:
+                return set(), set()
+            if len(remote) > len(snapshot) and \
+                    remote[:len(snapshot)].tostring() == saved:
+                # Only new messages were added.
+                return set(), set(remote[len(snapshot):])
+            local = set(snapshot)
+        remote = set(remote)
+        return local.difference(remote), remote.difference(local)
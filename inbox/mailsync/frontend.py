@@ -74,9 +74,23 @@ class ProfilingHTTPFrontend(HTTPFrontend):
 
 
 class SyncbackHTTPFrontend(ProfilingHTTPFrontend):
+    def __init__(self, port, trace_greenlets, profile, syncback=None):
+        self.syncback = syncback
+        super(SyncbackHTTPFrontend, self).__init__(port, trace_greenlets,
+                                                   profile)
+
     def greenlet_tracer_cls(self):
         return KillerGreenletTracer
 
+    def _create_app_impl(self, app):
+        super(SyncbackHTTPFrontend, self)._create_app_impl(app)
+
+        @app.route('/syncback')
+        def syncback():
+            if self.syncback is None:
+                return 'Syncback stats unavailable\n', 404
+            return jsonify(self.syncback.stats())
+
 
 class SyncHTTPFrontend(ProfilingHTTPFrontend):
     def __init__(self, sync_service, port, trace_greenlets, profile):
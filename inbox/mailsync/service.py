@@ -31,6 +31,10 @@ PENDING_AVGS_THRESHOLD = 10
 
 MAX_ACCOUNTS_PER_PROCESS = config.get('MAX_ACCOUNTS_PER_PROCESS', 150)
 
+# How often (in seconds) the accounts to sync are reconciled in full with the
+# database, in case events about them were missed.
+ACCOUNT_RECONCILE_INTERVAL = 300
+
 SYNC_EVENT_QUEUE_NAME = 'sync:event_queue:{}'
 SHARED_SYNC_EVENT_QUEUE_NAME = 'sync:shared_event_queue:{}'
 
@@ -100,6 +104,7 @@ class SyncService(object):
         self.stealing_enabled = config.get('SYNC_STEAL_ACCOUNTS', True)
         self._pending_avgs_provider = None
         self.last_unloaded_account = time.time()
+        self.next_reconcile = 0
 
     def run(self):
         while True:
@@ -110,26 +115,26 @@ class SyncService(object):
         Waits for notifications about Account migrations and checks for start/stop commands.
 
         """
-        # When the service first starts we should check the state of the world.
-        self.poll({'queue_name': 'none'})
-        event = None
-        while event is None:
-            event = self.queue_group.receive_event(timeout=self.poll_interval)
+        # When the service first starts, and every so often in case events
+        # were missed, we should check the state of the world.
+        if time.time() >= self.next_reconcile:
+            self.poll({'queue_name': 'none'})
+            self.next_reconcile = time.time() + ACCOUNT_RECONCILE_INTERVAL
+
+        event = self.queue_group.receive_event(timeout=self.poll_interval)
+        if event is None:
+            return
 
         if shared_sync_event_queue_for_zone(self.zone).queue_name == event['queue_name']:
             self.poll_shared_queue(event)
             return
 
-        # We're going to re-evaluate the world so we don't need any of the
-        # other pending events in our private queue.
-        self._flush_private_queue()
-        self.poll(event)
-
-    def _flush_private_queue(self):
-        while True:
-            event = self.private_queue.receive_event(timeout=None)
-            if event is None:
-                break
+        # Events in our private queue are about a single Account, so only
+        # that Account needs to be re-evaluated.
+        if event.get('id') is None:
+            self.poll(event)
+        else:
+            self.poll_account(event['id'])
 
     def poll_shared_queue(self, event):
         # Conservatively, stop accepting accounts if the process pending averages
@@ -187,6 +192,36 @@ class SyncService(object):
                                exc_info=True)
                 log_uncaught_errors()
 
+    def poll_account(self, account_id):
+        """
+        Starts or stops syncing the account with the given account_id,
+        depending on whether it should be synced by this process.
+
+        """
+        with session_scope(account_id) as db_session:
+            acc = db_session.query(Account).get(account_id)
+            if acc is None:
+                return
+            should_sync = acc.sync_should_run and (
+                (acc.desired_sync_host in (None, self.process_identifier) and
+                 acc.sync_host == self.process_identifier) or
+                (acc.desired_sync_host == self.process_identifier and
+                 acc.sync_host is None))
+            owned = acc.sync_host == self.process_identifier
+
+        try:
+            if should_sync:
+                if account_id not in self.syncing_accounts:
+                    self.start_sync(account_id)
+            elif owned:
+                self.log.info('sync service stopping sync',
+                              account_id=account_id)
+                self.stop_sync(account_id)
+        except OperationalError:
+            self.log.error('Database error updating account sync',
+                           account_id=account_id, exc_info=True)
+            log_uncaught_errors()
+
     def account_ids_to_sync(self):
         with global_session_scope() as db_session:
             return {r[0] for r in db_session.query(Account.id).
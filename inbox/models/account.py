@@ -348,6 +348,7 @@ def update_listener_state(obj):
 @event.listens_for(Session, "after_flush")
 def after_flush(session, flush_context):
     from inbox.mailsync.service import shared_sync_event_queue_for_zone, SYNC_EVENT_QUEUE_NAME
+    from inbox.scheduling.queue import publish_account_event
 
     def send_migration_events(obj_state):
         def f(session):
@@ -359,6 +360,12 @@ def after_flush(session, flush_context):
             sync_host = obj_state['sync_host']
             desired_sync_host = obj_state['desired_sync_host']
 
+            try:
+                # Let the QueuePopulator know, whoever syncs the Account.
+                publish_account_event(id)
+            except:
+                log_uncaught_errors(log, account_id=id)
+
             try:
                 if sync_host is not None:
                     # Somebody is actively syncing this Account, so notify them if
@@ -19,6 +19,7 @@ from inbox.models.message import Message
 from inbox.models.folder import Folder
 from inbox.models.mixins import HasRunState, UpdatedAtMixin, DeletedAtMixin
 from inbox.models.label import Label
+from inbox.models.category import sanitize_name
 from inbox.util.misc import cleanup_subject
 
 PROVIDER = 'imap'
@@ -74,6 +75,60 @@ class ImapAccount(Account):
     __mapper_args__ = {'polymorphic_identity': 'imapaccount'}
 
 
+FLAG_COLUMNS = {
+    u'\\Draft': 'is_draft',
+    u'\\Seen': 'is_seen',
+    u'\\Recent': 'is_recent',
+    u'\\Answered': 'is_answered',
+    u'\\Flagged': 'is_flagged',
+}
+
+LABEL_CATEGORIES = {
+    '\\Inbox': 'inbox',
+    '\\Important': 'important',
+    '\\Sent': 'sent',
+    '\\Trash': 'trash',
+    '\\Spam': 'spam',
+    '\\All': 'all'
+}
+
+
+def flag_column_values(flags):
+    """
+    Map a set of IMAP flags to the values of the ImapUid flag columns
+    (including `extra_flags`) they correspond to.
+
+    """
+    flags = set(flags)
+    values = {col: flag in flags for flag, col in FLAG_COLUMNS.iteritems()}
+    extra_flags = sorted(flags.difference(FLAG_COLUMNS))
+    # Sadly, there's a limit of 255 chars for this
+    # column.
+    while len(json.dumps(extra_flags)) > 255:
+        extra_flags.pop()
+    values['extra_flags'] = extra_flags
+    return values
+
+
+def label_keys(labels):
+    """
+    Map Gmail X-GM-LABELS values to the (name, canonical_name) pairs of the
+    Label objects they correspond to.
+
+    """
+    keys = set()
+    for label in labels:
+        if label in ('\\Draft', '\\Starred'):
+            continue
+        elif label in LABEL_CATEGORIES:
+            keys.add((LABEL_CATEGORIES[label], LABEL_CATEGORIES[label]))
+        else:
+            # As stored: names are sanitized, and other labels don't have a
+            # canonical name.
+            keys.add((sanitize_name(label), ''))
+    return keys
+
+
 class ImapUid(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     """
     Maps UIDs to their IMAP folders and per-UID flag metadata.
@@ -125,33 +180,10 @@ class ImapUid(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
 
         """
         changed = False
-        new_flags = set(new_flags)
-        col_for_flag = {
-            u'\\Draft': 'is_draft',
-            u'\\Seen': 'is_seen',
-            u'\\Recent': 'is_recent',
-            u'\\Answered': 'is_answered',
-            u'\\Flagged': 'is_flagged',
-        }
-        for flag, col in col_for_flag.iteritems():
-            prior_flag_value = getattr(self, col)
-            new_flag_value = flag in new_flags
-            if prior_flag_value != new_flag_value:
+        for col, new_value in flag_column_values(new_flags).iteritems():
+            if getattr(self, col) != new_value:
                 changed = True
-                setattr(self, col, new_flag_value)
-            new_flags.discard(flag)
-
-        extra_flags = sorted(new_flags)
-
-        if extra_flags != self.extra_flags:
-            changed = True
-
-        # Sadly, there's a limit of 255 chars for this
-        # column.
-        while len(json.dumps(extra_flags)) > 255:
-            extra_flags.pop()
-
-        self.extra_flags = extra_flags
+                setattr(self, col, new_value)
         return changed
 
     def update_labels(self, new_labels):
@@ -162,24 +194,7 @@ class ImapUid(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
         self.is_draft = '\\Draft' in new_labels
         self.is_starred = '\\Starred' in new_labels
 
-        category_map = {
-            '\\Inbox': 'inbox',
-            '\\Important': 'important',
-            '\\Sent': 'sent',
-            '\\Trash': 'trash',
-            '\\Spam': 'spam',
-            '\\All': 'all'
-        }
-
-        remote_labels = set()
-        for label in new_labels:
-            if label in ('\\Draft', '\\Starred'):
-                continue
-            elif label in category_map:
-                remote_labels.add((category_map[label], category_map[label]))
-            else:
-                remote_labels.add((label, None))
-
+        remote_labels = label_keys(new_labels)
         local_labels = {(l.name, l.canonical_name): l for l in self.labels}
 
         remove = set(local_labels) - remote_labels
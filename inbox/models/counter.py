@@ -0,0 +1,481 @@
+"""
+Maintained thread and message counts per (namespace, category), so that
+view=count queries and unread badges don't have to scan the namespace's
+messages.
+
+Counters are adjusted by the same flush hooks that create Transaction rows:
+before a flush, track_counter_changes() works out how the changed messages
+and threads move the counts (threads are counted from Thread.summary), and
+after the flush apply_counter_changes() adds the differences to the counter
+rows. Only namespaces which already have counter rows are maintained; the
+rows are created, and any drift is corrected, by reconcile_counters().
+
+"""
+from collections import defaultdict
+
+from sqlalchemy import (Column, BigInteger, Integer, ForeignKey, event, func,
+                        inspect, and_, or_, case)
+from sqlalchemy.schema import UniqueConstraint
+
+from inbox.models.base import MailSyncBase
+from inbox.models.mixins import UpdatedAtMixin
+from inbox.models.namespace import Namespace
+from inbox.models.category import Category
+from inbox.models.message import Message, MessageCategory
+from inbox.models.thread import Thread, empty_summary
+from nylas.logging import get_logger
+log = get_logger()
+
+# Counter rows with this category_id count over the whole namespace.
+ALL_CATEGORIES = 0
+
+THREAD_FIELDS = ('threads', 'unread_threads', 'starred_threads')
+MESSAGE_FIELDS = ('messages', 'unread_messages', 'starred_messages')
+COUNTER_FIELDS = THREAD_FIELDS + MESSAGE_FIELDS
+
+
+class CategoryCounter(MailSyncBase, UpdatedAtMixin):
+    """
+    Number of threads and (non-draft) messages in a category, and how many
+    of them are unread or starred. Matches what the /threads and /messages
+    endpoints return for view=count&in=<category>, optionally with
+    unread=true or starred=true.
+
+    """
+    namespace_id = Column(ForeignKey(Namespace.id, ondelete='CASCADE'),
+                          nullable=False)
+    # A Category.id, or ALL_CATEGORIES.
+    category_id = Column(BigInteger, nullable=False)
+
+    threads = Column(Integer, nullable=False, default=0)
+    unread_threads = Column(Integer, nullable=False, default=0)
+    starred_threads = Column(Integer, nullable=False, default=0)
+    messages = Column(Integer, nullable=False, default=0)
+    unread_messages = Column(Integer, nullable=False, default=0)
+    starred_messages = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint('namespace_id', 'category_id'),)
+
+
+# Make SQLAlchemy load the previous value when these attributes are assigned
+# to, so that we know which counts the object used to contribute to.
+for _attribute in (Message.is_read, Message.is_starred, Message.is_draft,
+                   Thread.deleted_at):
+    event.listen(_attribute, 'set', lambda *args: None, active_history=True)
+
+
+def _previous_value(obj_state, attr):
+    history = getattr(obj_state.attrs, attr).history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj_state.attrs, attr).value
+
+
+def _message_counts(is_draft, is_read, is_starred, categories):
+    if is_draft:
+        return {}
+    counts = {'messages': 1, 'unread_messages': int(not is_read),
+              'starred_messages': int(bool(is_starred))}
+    # New categories don't have a public id until they're inserted.
+    keys = [ALL_CATEGORIES] + [c.public_id or c for c in categories
+                               if c is not None]
+    return dict.fromkeys(keys, counts)
+
+
+def _thread_counts(summary, deleted_at):
+    if deleted_at is not None:
+        return {}
+    summary = summary or empty_summary()
+    counts = {'threads': 1, 'unread_threads': int(summary['unread']),
+              'starred_threads': int(summary['starred'])}
+    return dict.fromkeys([ALL_CATEGORIES] + summary['category_ids'], counts)
+
+
+def _previous_categories(obj_state, obj):
+    history = obj_state.attrs.messagecategories.history
+    if not history.has_changes():
+        return obj.categories
+    return [mc.category for mc in
+            list(history.unchanged or ()) + list(history.deleted or ())]
+
+
+def _is_live(thread):
+    return thread is not None and thread.deleted_at is None
+
+
+def _message_contributions(obj, session):
+    # Messages of soft-deleted threads aren't counted. Both sides are counted
+    # as of the threads' current deleted_at; if that changed, the thread
+    # makes up the difference (see _thread_contributions()).
+    obj_state = inspect(obj)
+    if obj in session.new or \
+            not _is_live(_previous_value(obj_state, '_thread')):
+        before = {}
+    else:
+        before = _message_counts(_previous_value(obj_state, 'is_draft'),
+                                 _previous_value(obj_state, 'is_read'),
+                                 _previous_value(obj_state, 'is_starred'),
+                                 _previous_categories(obj_state, obj))
+    if obj in session.deleted or not _is_live(obj.thread):
+        after = {}
+    else:
+        after = _message_counts(obj.is_draft, obj.is_read, obj.is_starred,
+                                obj.categories)
+    return before, after
+
+
+def _stored_summary(session, thread_id):
+    """
+    The parts of Thread.summary which the counters use, computed from the
+    thread's messages as they're stored, for threads which don't have a
+    summary yet.
+
+    """
+    unread, starred = session.query(
+        func.max(case([(Message.is_read == False, 1)], else_=0)),
+        func.max(case([(Message.is_starred == True, 1)], else_=0))). \
+        filter(Message.thread_id == thread_id,
+               Message.is_draft == False).one()
+    category_ids = sorted(
+        public_id for public_id, in session.query(Category.public_id).
+        join(MessageCategory, MessageCategory.category_id == Category.id).
+        join(Message, MessageCategory.message_id == Message.id).
+        filter(Message.thread_id == thread_id).distinct())
+    return {'unread': bool(unread), 'starred': bool(starred),
+            'category_ids': category_ids}
+
+
+def _stored_message_counts(session, thread_id):
+    """
+    The counts which the thread's messages, as they're stored, contribute
+    to, in the form returned by _message_counts().
+
+    """
+    counts = [func.count(Message.id),
+              func.coalesce(func.sum(case([(Message.is_read == False, 1)],
+                                          else_=0)), 0),
+              func.coalesce(func.sum(case([(Message.is_starred == True, 1)],
+                                          else_=0)), 0)]
+    filters = [Message.thread_id == thread_id, Message.is_draft == False]
+    rows = [(ALL_CATEGORIES,) + tuple(session.query(*counts).
+                                      filter(*filters).one())]
+    rows.extend(session.query(Category.public_id, *counts).
+                join(MessageCategory, MessageCategory.category_id ==
+                     Category.id).
+                join(Message, MessageCategory.message_id == Message.id).
+                filter(*filters).group_by(Category.public_id))
+    return {row[0]: dict(zip(MESSAGE_FIELDS, map(int, row[1:])))
+            for row in rows if row[1]}
+
+
+def _merge_contributions(*contributions):
+    merged = defaultdict(dict)
+    for counts in contributions:
+        for key, fields in counts.iteritems():
+            merged[key].update(fields)
+    return dict(merged)
+
+
+def _thread_contributions(obj, session):
+    obj_state = inspect(obj)
+    if obj in session.new:
+        previous_deleted_at = previous_summary = None
+    else:
+        previous_deleted_at = _previous_value(obj_state, 'deleted_at')
+        previous_summary = _previous_value(obj_state, 'summary')
+    deleted_changed = obj not in session.new and \
+        (previous_deleted_at is None) != (obj.deleted_at is None)
+    if previous_summary is None and obj not in session.new and \
+            (obj.summary is not None or deleted_changed):
+        # Threads from before summaries were introduced are counted by
+        # reconcile_counters() from their messages; so must they be here.
+        # Only needed if the counts can change.
+        previous_summary = _stored_summary(session, obj.id)
+
+    if obj in session.new:
+        before = {}
+    else:
+        before = _thread_counts(previous_summary, previous_deleted_at)
+    if obj in session.deleted:
+        after = {}
+    else:
+        after = _thread_counts(obj.summary or previous_summary,
+                               obj.deleted_at)
+
+    if deleted_changed:
+        # (Un)deleting a thread also removes (or adds) its messages. Changed
+        # messages count as of the thread's current state (see
+        # _message_contributions()), so this is based on their stored one.
+        message_counts = _stored_message_counts(session, obj.id)
+        if obj.deleted_at is None:
+            after = _merge_contributions(after, message_counts)
+        else:
+            before = _merge_contributions(before, message_counts)
+    return before, after
+
+
+def track_counter_changes(session):
+    """
+    Work out how the pending changes to messages and threads affect the
+    counters. Must run after update_thread_summaries(). The category public
+    ids of new categories aren't known yet, so the changes are only resolved
+    to counter rows by apply_counter_changes().
+
+    """
+    changes = []
+    with session.no_autoflush:
+        for obj in session.new | session.dirty | session.deleted:
+            if isinstance(obj, Message):
+                before, after = _message_contributions(obj, session)
+            elif isinstance(obj, Thread):
+                before, after = _thread_contributions(obj, session)
+            else:
+                continue
+            if before != after:
+                changes.append((obj, obj.namespace_id, before, after))
+    session.info['counter_changes'] = changes
+
+
+def apply_counter_changes(session):
+    changes = session.info.pop('counter_changes', None) or []
+    new_categories = [obj for obj in session.new
+                      if isinstance(obj, Category)]
+    deleted_categories = [obj for obj in session.deleted
+                          if isinstance(obj, Category)]
+    if not changes and not new_categories and not deleted_categories:
+        return
+
+    deltas = defaultdict(lambda: defaultdict(int))
+    for obj, namespace_id, before, after in changes:
+        namespace_id = namespace_id or obj.namespace_id
+        for sign, contributions in ((-1, before), (1, after)):
+            for key, counts in contributions.iteritems():
+                if not isinstance(key, basestring) and key != ALL_CATEGORIES:
+                    # A category which was new before the flush.
+                    key = key.public_id
+                for field, count in counts.iteritems():
+                    deltas[namespace_id, key][field] += sign * count
+
+    with session.no_autoflush:
+        category_ids = _resolve_category_ids(session, deltas)
+        _create_counters_for_new_categories(session, new_categories)
+        table = CategoryCounter.__table__
+        for category in deleted_categories:
+            session.execute(table.delete().where(and_(
+                table.c.namespace_id == category.namespace_id,
+                table.c.category_id == category.id)))
+        # Always update counter rows in the same order, to avoid deadlocks
+        # between concurrent transactions.
+        for namespace_id, category_id, delta in sorted(
+                (namespace_id, category_ids.get((namespace_id, key)), delta)
+                for (namespace_id, key), delta in deltas.iteritems()):
+            values = {field: getattr(table.c, field) + count
+                      for field, count in delta.iteritems() if count}
+            if category_id is None or not values:
+                continue
+            session.execute(table.update().where(and_(
+                table.c.namespace_id == namespace_id,
+                table.c.category_id == category_id)).values(values))
+
+
+def _resolve_category_ids(session, deltas):
+    public_ids = defaultdict(set)
+    for namespace_id, key in deltas:
+        if key != ALL_CATEGORIES:
+            public_ids[namespace_id].add(key)
+    category_ids = {(namespace_id, ALL_CATEGORIES): ALL_CATEGORIES
+                    for namespace_id, _ in deltas}
+    for namespace_id, ids in public_ids.iteritems():
+        for public_id, id_ in session.query(
+                Category.public_id, Category.id).filter(
+                Category.namespace_id == namespace_id,
+                Category.public_id.in_(ids)):
+            category_ids[namespace_id, public_id] = id_
+    return category_ids
+
+
+def _create_counters_for_new_categories(session, categories):
+    # New categories are empty except for the changes in this flush, so if
+    # the namespace's counters are maintained, we can start counting them
+    # straight away.
+    for category in categories:
+        maintained = session.query(CategoryCounter.id).filter(
+            CategoryCounter.namespace_id == category.namespace_id,
+            CategoryCounter.category_id == ALL_CATEGORIES).first()
+        if maintained is not None:
+            session.execute(CategoryCounter.__table__.insert().values(
+                namespace_id=category.namespace_id, category_id=category.id,
+                **dict.fromkeys(COUNTER_FIELDS, 0)))
+
+
+def get_count(db_session, namespace_id, object_type, in_=None, unread=None,
+              starred=None):
+    """
+    Look up a /threads or /messages count in the counters. Returns None if
+    the counters can't answer the query, in which case the caller should
+    count the matching rows.
+
+    """
+    if unread is not None and starred is not None:
+        return None
+    if object_type == 'thread':
+        if unread is False or starred is False:
+            # Threads with a read (or unstarred) message aren't counted.
+            return None
+        total, unread_field, starred_field = THREAD_FIELDS
+    else:
+        total, unread_field, starred_field = MESSAGE_FIELDS
+
+    category_id = ALL_CATEGORIES
+    if in_ is not None:
+        from inbox.api.err import InputError
+        from inbox.api.validation import valid_public_id
+        category_filters = [Category.name == in_,
+                            Category.display_name == in_]
+        try:
+            valid_public_id(in_)
+            category_filters.append(Category.public_id == in_)
+        except InputError:
+            pass
+        matches = db_session.query(Category.id).filter(
+            Category.namespace_id == namespace_id,
+            or_(*category_filters)).limit(2).all()
+        if len(matches) != 1:
+            return None
+        category_id = matches[0][0]
+
+    counter = db_session.query(CategoryCounter).filter(
+        CategoryCounter.namespace_id == namespace_id,
+        CategoryCounter.category_id == category_id).first()
+    if counter is None:
+        return None
+    if unread is not None:
+        field = unread_field
+        negate = not unread
+    elif starred is not None:
+        field = starred_field
+        negate = not starred
+    else:
+        field, negate = total, False
+    count = getattr(counter, field)
+    if negate:
+        count = getattr(counter, total) - count
+    return max(count, 0)
+
+
+def count_categories(db_session, namespace_id):
+    """
+    Count the namespace's threads and messages per category from scratch.
+    Returns a dict mapping category ids (and ALL_CATEGORIES) to dicts of
+    counts. Categories without messages are included.
+
+    """
+    counts = {category_id: dict.fromkeys(COUNTER_FIELDS, 0)
+              for category_id, in db_session.query(Category.id).filter(
+                  Category.namespace_id == namespace_id)}
+    counts[ALL_CATEGORIES] = dict.fromkeys(COUNTER_FIELDS, 0)
+
+    def total(condition):
+        return func.coalesce(func.sum(case([(condition, 1)], else_=0)), 0)
+
+    # Messages, as counted by filtering.messages_or_drafts().
+    message_counts = [func.count(Message.id), total(Message.is_read == False),
+                      total(Message.is_starred == True)]
+    message_filters = [Message.namespace_id == namespace_id,
+                       Message.is_draft == False,
+                       Thread.deleted_at == None]
+    rows = [(ALL_CATEGORIES,) + tuple(db_session.query(*message_counts).
+                                      select_from(Message).
+                                      join(Thread, Message.thread_id ==
+                                           Thread.id).
+                                      filter(*message_filters).one())]
+    rows.extend(db_session.query(MessageCategory.category_id,
+                                 *message_counts).
+                join(Message, MessageCategory.message_id == Message.id).
+                join(Thread, Message.thread_id == Thread.id).
+                filter(*message_filters).
+                group_by(MessageCategory.category_id))
+    for row in rows:
+        counts.setdefault(row[0], dict.fromkeys(COUNTER_FIELDS, 0)).update(
+            zip(MESSAGE_FIELDS, row[1:]))
+
+    # Threads are unread or starred if any of their messages are. This is
+    # what Thread.summary records; the flags of drafts are ignored.
+    flags = db_session.query(
+        Message.thread_id.label('thread_id'),
+        func.max(case([(Message.is_read == False, 1)], else_=0)).
+        label('unread'),
+        func.max(case([(Message.is_starred == True, 1)], else_=0)).
+        label('starred')). \
+        filter(Message.namespace_id == namespace_id,
+               Message.is_draft == False). \
+        group_by(Message.thread_id).subquery()
+    thread_counts = [func.count(Thread.id),
+                     total(flags.c.unread == 1),
+                     total(flags.c.starred == 1)]
+    thread_filters = [Thread.namespace_id == namespace_id,
+                      Thread.deleted_at == None]
+    rows = [(ALL_CATEGORIES,) + tuple(db_session.query(*thread_counts).
+                                      select_from(Thread).
+                                      outerjoin(flags, flags.c.thread_id ==
+                                                Thread.id).
+                                      filter(*thread_filters).one())]
+    thread_categories = db_session.query(
+        Message.thread_id.label('thread_id'),
+        MessageCategory.category_id.label('category_id')). \
+        join(MessageCategory, MessageCategory.message_id == Message.id). \
+        filter(Message.namespace_id == namespace_id). \
+        distinct().subquery()
+    rows.extend(db_session.query(thread_categories.c.category_id,
+                                 *thread_counts).
+                select_from(thread_categories).
+                join(Thread, thread_categories.c.thread_id == Thread.id).
+                outerjoin(flags, flags.c.thread_id == Thread.id).
+                filter(*thread_filters).
+                group_by(thread_categories.c.category_id))
+    for row in rows:
+        counts.setdefault(row[0], dict.fromkeys(COUNTER_FIELDS, 0)).update(
+            zip(THREAD_FIELDS, row[1:]))
+
+    return {category_id: {field: int(count) for field, count in
+                          category_counts.iteritems()}
+            for category_id, category_counts in counts.iteritems()}
+
+
+def reconcile_counters(db_session, namespace_id):
+    """
+    Recount the namespace's categories and correct its counter rows,
+    creating them if necessary. Commits. Returns the number of counter rows
+    which had drifted.
+
+    """
+    # Lock the existing counters first, so that concurrent changes either
+    # are visible to the recount or are applied on top of its results.
+    counters = {counter.category_id: counter for counter in
+                db_session.query(CategoryCounter).filter(
+                    CategoryCounter.namespace_id == namespace_id).
+                with_for_update()}
+    counts = count_categories(db_session, namespace_id)
+
+    drifted = 0
+    for category_id, category_counts in counts.iteritems():
+        counter = counters.pop(category_id, None)
+        if counter is None:
+            counter = CategoryCounter(namespace_id=namespace_id,
+                                      category_id=category_id)
+            db_session.add(counter)
+        elif any(getattr(counter, field) != count
+                 for field, count in category_counts.iteritems()):
+            log.warning('Correcting drifted counter',
+                        namespace_id=namespace_id, category_id=category_id,
+                        counts=category_counts,
+                        previous={field: getattr(counter, field)
+                                  for field in COUNTER_FIELDS})
+            drifted += 1
+        for field, count in category_counts.iteritems():
+            setattr(counter, field, count)
+    # Counters for deleted categories.
+    for counter in counters.itervalues():
+        db_session.delete(counter)
+    db_session.commit()
+    return drifted
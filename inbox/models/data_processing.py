@@ -1,7 +1,7 @@
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.dialects.mysql import MEDIUMBLOB
-from sqlalchemy import DateTime
+from sqlalchemy import BigInteger, DateTime
 
 from inbox.models.base import MailSyncBase
 from inbox.models.namespace import Namespace
@@ -14,6 +14,10 @@ import zlib
 
 class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     """Cached data used in data processing
+
+    Contact rankings and groups are stored relative to
+    inbox.contacts.algorithms.SCORE_EPOCH, and kept up to date by
+    inbox.contacts.scores.update_scores.
     """
     namespace_id = Column(ForeignKey(Namespace.id, ondelete='CASCADE'),
                           nullable=False)
@@ -21,6 +25,12 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     _contact_groups = Column('contact_groups', MEDIUMBLOB)
     contact_rankings_last_updated = Column(DateTime)
     contact_groups_last_updated = Column(DateTime)
+    _group_cooccurrences = Column('group_cooccurrences', MEDIUMBLOB)
+    # The newest sent message counted in the stored scores, by id and by
+    # date, and when they were last recomputed from scratch.
+    scores_last_message_id = Column(BigInteger)
+    scores_last_message_date = Column(DateTime)
+    scores_rebuilt_at = Column(DateTime)
 
     @property
     def contact_rankings(self):
@@ -47,4 +57,16 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
         self._contact_groups = zlib.compress(json.dumps(value).encode('utf-8'))
         self.contact_groups_last_updated = datetime.datetime.now()
 
+    @property
+    def group_cooccurrences(self):
+        if self._group_cooccurrences is None:
+            return None
+        else:
+            return json.loads(zlib.decompress(self._group_cooccurrences))
+
+    @group_cooccurrences.setter
+    def group_cooccurrences(self, value):
+        self._group_cooccurrences = \
+            zlib.compress(json.dumps(value).encode('utf-8'))
+
     __table_args__ = (UniqueConstraint('namespace_id'),)
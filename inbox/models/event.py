@@ -4,8 +4,9 @@ from dateutil.parser import parse as date_parse
 import ast
 
 from sqlalchemy import (Column, String, ForeignKey, Text, Boolean, Integer,
-                        DateTime, Enum, Index, event)
+                        BigInteger, DateTime, Enum, Index, event)
 from sqlalchemy.orm import relationship, backref, validates, reconstructor
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy.dialects.mysql import LONGTEXT
 
@@ -380,6 +381,11 @@ class RecurringEvent(Event):
     exdate = Column(Text)  # There can be a lot of exception dates
     until = Column(FlexibleDateTime, nullable=True)
     start_timezone = Column(String(35))
+    # How far ahead the event's RecurringEventOccurrences have been
+    # generated. Reset when the event or its overrides change, so that
+    # they're generated again. Only ever updated directly in the database
+    # (see invalidate_occurrences), so changing it doesn't create a revision.
+    occurrences_until = Column(DateTime, nullable=True)
 
     def __init__(self, **kwargs):
         self.start_timezone = kwargs.pop('original_start_tz', None)
@@ -529,6 +535,76 @@ class InflatedEvent(Event):
         self.message = None
 
 
+class RecurringEventOccurrence(MailSyncBase):
+    """
+    An instance of a recurring event, materialized so that queries which
+    expand recurring events can filter, sort and paginate instances in SQL.
+    Either an instance generated from the master event's RRULE, or a
+    (non-cancelled) override of one. See
+    inbox.events.recurring.update_occurrences.
+
+    """
+    namespace_id = Column(BigInteger, nullable=False)
+    master_event_id = Column(ForeignKey(RecurringEvent.id, ondelete='CASCADE'),
+                             nullable=False, index=True)
+    override_id = Column(ForeignKey(RecurringEventOverride.id,
+                                    ondelete='CASCADE'), nullable=True)
+    start = Column(FlexibleDateTime, nullable=False)
+    end = Column(FlexibleDateTime, nullable=True)
+
+Index('ix_recurringeventoccurrence_namespace_id_start',
+      RecurringEventOccurrence.namespace_id, RecurringEventOccurrence.start)
+
+# Changes to these fields change a recurring event's occurrences.
+MASTER_OCCURRENCE_FIELDS = ('start', 'end', 'all_day', 'recurrence', 'rrule',
+                            'exdate', 'until', 'start_timezone')
+OVERRIDE_OCCURRENCE_FIELDS = ('start', 'end', 'status', 'original_start_time',
+                              'master_event_id', 'calendar_id', 'deleted_at')
+
+
+def invalidate_occurrences(session):
+    """
+    Reset the occurrences of recurring events whose recurrence or overrides
+    are about to change, so that they're generated again when next queried.
+
+    """
+    masters = set()
+    master_ids = set()
+    with session.no_autoflush:
+        for obj in session.new | session.dirty | session.deleted:
+            if isinstance(obj, RecurringEvent):
+                if obj in session.dirty and not any(
+                        get_history(obj, field).has_changes()
+                        for field in MASTER_OCCURRENCE_FIELDS):
+                    continue
+                masters.add(obj)
+            elif isinstance(obj, RecurringEventOverride):
+                if obj in session.dirty and not any(
+                        get_history(obj, field).has_changes()
+                        for field in OVERRIDE_OCCURRENCE_FIELDS):
+                    continue
+                if obj.master is not None:
+                    masters.add(obj.master)
+                # Its previous master, if it changed.
+                master_ids.update(
+                    id_ for id_ in get_history(obj, 'master_event_id').deleted
+                    if id_ is not None)
+        for master_id in master_ids:
+            master = session.query(RecurringEvent).get(master_id)
+            if master is not None:
+                masters.add(master)
+        # Updated directly rather than through the session, since this isn't
+        # a change to the event that API clients need to know about.
+        table = RecurringEvent.__table__
+        for master in masters:
+            if master.id is None or master in session.deleted or \
+                    master.occurrences_until is None:
+                continue
+            session.execute(table.update().where(
+                table.c.id == master.id).values(occurrences_until=None))
+            set_committed_value(master, 'occurrences_until', None)
+
+
 def insert_warning(mapper, connection, target):
     log.warn("InflatedEvent {} shouldn't be committed".format(target))
     raise Exception("InflatedEvent should not be committed")
@@ -21,6 +21,7 @@ from inbox.sqlalchemy_ext.util import JSON, json_field_too_long, bakery
 from inbox.util.addr import parse_mimepart_address_header
 from inbox.util.misc import parse_references, get_internaldate
 from inbox.util.blockstore import save_to_blockstore
+from inbox.util.mime_parser import parse_message, MimeParseError
 from inbox.security.blobstorage import encode_blob, decode_blob
 from inbox.models.mixins import (HasPublicID, HasRevisions, UpdatedAtMixin,
                                  DeletedAtMixin)
@@ -260,13 +261,13 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         msg.namespace_id = account.namespace.id
 
         try:
-            parsed = mime.from_string(body_string)
+            parsed = parse_message(body_string, msg.data_sha256)
             # Non-persisted instance attribute used by EAS.
             msg.parsed_body = parsed
             msg._parse_metadata(parsed, body_string, received_date, account.id,
                                 folder_name, mid)
-        except (mime.DecodingError, AttributeError, RuntimeError,
-                TypeError) as e:
+        except (MimeParseError, mime.DecodingError, AttributeError,
+                RuntimeError, TypeError) as e:
             parsed = None
             # Non-persisted instance attribute used by EAS.
             msg.parsed_body = ''
@@ -277,18 +278,21 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         if parsed is not None:
             plain_parts = []
             html_parts = []
-            for mimepart in parsed.walk(
-                    with_self=parsed.content_type.is_singlepart()):
-                try:
-                    if mimepart.content_type.is_multipart():
-                        continue  # TODO should we store relations?
-                    msg._parse_mimepart(mid, mimepart, account.namespace.id,
-                                        html_parts, plain_parts)
-                except (mime.DecodingError, AttributeError, RuntimeError,
-                        TypeError, binascii.Error, UnicodeDecodeError) as e:
+            for part, data in parsed.parts:
+                error = part.error
+                if error is None:
+                    try:
+                        msg._parse_mimepart(mid, part, data,
+                                            account.namespace.id, html_parts,
+                                            plain_parts)
+                    except (mime.DecodingError, AttributeError, RuntimeError,
+                            TypeError, binascii.Error,
+                            UnicodeDecodeError) as e:
+                        error = e
+                if error is not None:
                     log.error('Error parsing message MIME parts',
                               folder_name=folder_name, account_id=account.id,
-                              error=e)
+                              error=error)
                     msg._mark_error()
             msg.calculate_body(html_parts, plain_parts)
 
@@ -355,23 +359,18 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
 
         self.size = len(body_string)  # includes headers text
 
-    def _parse_mimepart(self, mid, mimepart, namespace_id, html_parts,
+    def _parse_mimepart(self, mid, part, data, namespace_id, html_parts,
                         plain_parts):
-        disposition, _ = mimepart.content_disposition
-        content_id = mimepart.headers.get('Content-Id')
-        content_type, params = mimepart.content_type
-
-        filename = mimepart.detected_file_name
-        if filename == '':
-            filename = None
-
-        data = mimepart.body
+        disposition = part.disposition
+        content_id = part.content_id
+        content_type = part.content_type
+        filename = part.filename
 
         is_text = content_type.startswith('text')
         if disposition not in (None, 'inline', 'attachment'):
             log.error('Unknown Content-Disposition',
                       message_public_id=self.public_id,
-                      bad_content_disposition=mimepart.content_disposition)
+                      bad_content_disposition=disposition)
             self._mark_error()
             return
 
@@ -11,22 +11,30 @@ def load_models():
                                       PhoneNumber)
     from inbox.models.calendar import Calendar
     from inbox.models.data_processing import DataProcessingCache
-    from inbox.models.event import Event
+    from inbox.models.event import Event, RecurringEventOccurrence
     from inbox.models.folder import Folder
     from inbox.models.message import Message, MessageCategory
     from inbox.models.namespace import Namespace
-    from inbox.models.search import ContactSearchIndexCursor
+    from inbox.models.search import (ContactSearchIndexCursor,
+                                     ContactSearchTerm,
+                                     MessageSearchIndexCursor,
+                                     MessageSearchIndex, MessageSearchDocument,
+                                     MessageSearchTerm)
     from inbox.models.secret import Secret
-    from inbox.models.thread import Thread
+    from inbox.models.thread import Thread, ThreadReference
     from inbox.models.transaction import Transaction, AccountTransaction
     from inbox.models.when import When, Time, TimeSpan, Date, DateSpan
     from inbox.models.label import Label
     from inbox.models.category import Category
     from inbox.models.metadata import Metadata
+    from inbox.models.counter import CategoryCounter
     exports = [Account, MailSyncBase, ActionLog, Block, Part,
                MessageContactAssociation, Contact, PhoneNumber, Calendar,
                DataProcessingCache, Event, Folder,
                Message, Namespace, ContactSearchIndexCursor, Secret,
                Thread, Transaction, When, Time, TimeSpan, Date, DateSpan,
-               Label, Category, MessageCategory, Metadata, AccountTransaction]
+               Label, Category, MessageCategory, Metadata, AccountTransaction,
+               CategoryCounter, ThreadReference, RecurringEventOccurrence,
+               ContactSearchTerm, MessageSearchIndexCursor, MessageSearchIndex,
+               MessageSearchDocument, MessageSearchTerm]
     return exports
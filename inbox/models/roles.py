@@ -1,11 +1,11 @@
 from hashlib import sha256
-from flanker import mime
 from sqlalchemy import Column, Integer, String
 
 from nylas.logging import get_logger
 log = get_logger()
 from inbox.config import config
 from inbox.util import blockstore
+from inbox.util.mime_parser import find_part, MimeParseError
 from inbox.s3.base import get_raw_from_provider
 from inbox.util.stats import statsd_client
 
@@ -77,30 +77,24 @@ class Blob(object):
                                   .format(message.data_sha256))
                         return None
 
-                    parsed = mime.from_string(raw_mime)
-                    if parsed is not None:
-                        for mimepart in parsed.walk(
-                                with_self=parsed.content_type.is_singlepart()):
-                            if mimepart.content_type.is_multipart():
-                                continue  # TODO should we store relations?
+                    # Only the part we need is parsed if the message's
+                    # manifest is stored.
+                    try:
+                        data = find_part(raw_mime, self.data_sha256)
+                    except MimeParseError as e:
+                        log.error('Error parsing raw message',
+                                  message_id=message.id, error=e)
+                        data = None
 
-                            data = mimepart.body
+                    # Found it!
+                    if data is not None:
+                        log.info('Found subpart with hash {}'.format(
+                            self.data_sha256))
 
-                            if isinstance(data, unicode):
-                                data = data.encode('utf-8', 'strict')
-
-                            if data is None:
-                                continue
-
-                            # Found it!
-                            if sha256(data).hexdigest() == self.data_sha256:
-                                log.info('Found subpart with hash {}'.format(
-                                    self.data_sha256))
-
-                                with statsd_client.timer('{}.blockstore_save_latency'.format(
-                                                         statsd_string)):
-                                    blockstore.save_to_blockstore(self.data_sha256, data)
-                                    return data
+                        with statsd_client.timer('{}.blockstore_save_latency'.format(
+                                                 statsd_string)):
+                            blockstore.save_to_blockstore(self.data_sha256, data)
+                            return data
                     log.error("Couldn't find the attachment in the raw message", message_id=message.id)
 
             log.error('No data returned!')
@@ -110,6 +104,19 @@ class Blob(object):
             "Returned data doesn't match stored hash!"
         return value
 
+    def stream(self, start=0, stop=None):
+        """
+        Stream the bytes [start, stop) of the blob from the blockstore.
+
+        Returns None if the data isn't available from the blockstore, in
+        which case callers should fall back to `data`, which knows how to
+        recover missing blobs.
+
+        """
+        if self.size == 0 or hasattr(self, '_data'):
+            return None
+        return blockstore.stream_from_blockstore(self.data_sha256, start, stop)
+
     @data.setter
     def data(self, value):
         assert value is not None
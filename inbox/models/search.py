@@ -1,7 +1,10 @@
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import (Column, ForeignKey, BigInteger, Integer, String,
+                        DateTime, Index)
 
 from inbox.models.base import MailSyncBase
 from inbox.models.mixins import UpdatedAtMixin, DeletedAtMixin
+from inbox.models.contact import Contact
+from inbox.models.message import Message
 from inbox.models.transaction import Transaction
 
 
@@ -14,3 +17,70 @@ class ContactSearchIndexCursor(MailSyncBase, UpdatedAtMixin,
     """
     transaction_id = Column(ForeignKey(Transaction.id), nullable=True,
                             index=True)
+
+
+class ContactSearchTerm(MailSyncBase):
+    """
+    Entry of the local contact search index (see inbox.contacts.search): a
+    term which queries match contacts by prefixes of.
+
+    """
+    namespace_id = Column(BigInteger, nullable=False)
+    term = Column(String(64, collation='utf8mb4_bin'), nullable=False)
+    contact_id = Column(ForeignKey(Contact.id, ondelete='CASCADE'),
+                        nullable=False, index=True)
+
+Index('ix_contactsearchterm_namespace_id_term',
+      ContactSearchTerm.namespace_id, ContactSearchTerm.term)
+
+
+class MessageSearchIndexCursor(MailSyncBase, UpdatedAtMixin,
+                               DeletedAtMixin):
+    """
+    Store the id of the last Transaction indexed into the local message
+    search index. Is namespace-agnostic.
+
+    """
+    transaction_id = Column(ForeignKey(Transaction.id), nullable=True,
+                            index=True)
+
+
+class MessageSearchIndex(MailSyncBase, UpdatedAtMixin):
+    """
+    A namespace's local message search index (see inbox.search.index).
+    Created when the namespace's first message is indexed; `backfilled_at`
+    is set once all of its existing messages have been indexed too.
+
+    """
+    namespace_id = Column(BigInteger, nullable=False, unique=True)
+    backfilled_at = Column(DateTime, nullable=True)
+
+
+class MessageSearchDocument(MailSyncBase):
+    """An indexed message, and its length in (weighted) terms."""
+    namespace_id = Column(BigInteger, nullable=False)
+    message_id = Column(ForeignKey(Message.id, ondelete='CASCADE'),
+                        nullable=False, unique=True)
+    length = Column(Integer, nullable=False)
+
+Index('ix_messagesearchdocument_namespace_id_length',
+      MessageSearchDocument.namespace_id, MessageSearchDocument.length)
+
+
+class MessageSearchTerm(MailSyncBase):
+    """
+    Posting of the search index: the (weighted) number of occurrences of
+    a term in a message, and the message's length, so that ranking a
+    query's matches doesn't need to look up their documents.
+
+    """
+    namespace_id = Column(BigInteger, nullable=False)
+    term = Column(String(64, collation='utf8mb4_bin'), nullable=False)
+    message_id = Column(ForeignKey(Message.id, ondelete='CASCADE'),
+                        nullable=False, index=True)
+    frequency = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+
+Index('ix_messagesearchterm_namespace_id_term_message_id',
+      MessageSearchTerm.namespace_id, MessageSearchTerm.term,
+      MessageSearchTerm.message_id)
@@ -84,11 +84,20 @@ def new_session(engine, versioned=True):
 
 def configure_versioning(session):
     from inbox.models.transaction import (create_revisions, propagate_changes,
-                                          increment_versions)
+                                          increment_versions,
+                                          track_new_transactions,
+                                          update_thread_summaries)
+    from inbox.models.counter import (track_counter_changes,
+                                      apply_counter_changes)
+    from inbox.models.event import invalidate_occurrences
+    from inbox.transactions.notify import publish
 
     @event.listens_for(session, 'before_flush')
     def before_flush(session, flush_context, instances):
         propagate_changes(session)
+        update_thread_summaries(session)
+        track_counter_changes(session)
+        invalidate_occurrences(session)
         increment_versions(session)
 
     @event.listens_for(session, 'after_flush')
@@ -98,8 +107,25 @@ def configure_versioning(session):
         grab object IDs on new objects.
 
         """
+        track_new_transactions(session)
+        apply_counter_changes(session)
         create_revisions(session)
 
+    @event.listens_for(session, 'after_commit')
+    def after_commit(session):
+        """
+        Announce new transactions to delta streaming/longpoll waiters.
+
+        """
+        latest = session.info.pop('new_transaction_ids', None)
+        if latest:
+            publish(latest)
+
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop('new_transaction_ids', None)
+        session.info.pop('counter_changes', None)
+
     return session
 
 
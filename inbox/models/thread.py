@@ -1,20 +1,99 @@
+import copy
+import bisect
 import datetime
 import itertools
 from collections import defaultdict
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+import arrow
+from sqlalchemy import (Column, Integer, BigInteger, String, DateTime,
+                        ForeignKey, Index, inspect)
 from sqlalchemy.orm import (relationship, backref, validates, object_session,
                             subqueryload)
 
 from nylas.logging import get_logger
 log = get_logger()
+from inbox.config import config
 from inbox.models.mixins import (HasPublicID, HasRevisions, UpdatedAtMixin,
                                  DeletedAtMixin)
 from inbox.models.base import MailSyncBase
 from inbox.models.namespace import Namespace
+from inbox.sqlalchemy_ext.util import BigJSON, generate_public_id
 from inbox.util.misc import cleanup_subject
 
 
+def _timestamp(dt):
+    if dt is None:
+        return None
+    return arrow.get(dt).timestamp
+
+
+def _datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+def empty_summary():
+    return {
+        'unread': False,
+        'starred': False,
+        'has_attachments': False,
+        # address -> list of phrases it occurs with.
+        'participants': {},
+        'category_ids': [],
+        # Sorted lists of (received timestamp, public id) pairs.
+        'messages': [],
+        'drafts': [],
+        'received_recent_date': None,
+        'sent_recent_date': None,
+        'last_date': None,
+    }
+
+
+def add_message_to_summary(summary, message):
+    """
+    Update a thread summary (see Thread.summary) with a new message.
+
+    """
+    # These are normally only assigned on insert.
+    if message.public_id is None:
+        message.public_id = generate_public_id()
+    categories = [c for c in message.categories if c is not None]
+    for category in categories:
+        if category.public_id is None:
+            category.public_id = generate_public_id()
+
+    received = _timestamp(message.received_date)
+    entry = [received, message.public_id]
+    summary['category_ids'] = sorted(
+        set(summary['category_ids']) | {c.public_id for c in categories})
+    summary['last_date'] = max(summary['last_date'], received)
+
+    in_sent = any(c.name == 'sent' for c in categories)
+    if in_sent or (message.is_draft and message.is_sent):
+        summary['sent_recent_date'] = max(summary['sent_recent_date'],
+                                          received)
+
+    if message.is_draft:
+        bisect.insort(summary['drafts'], entry)
+        return
+
+    bisect.insort(summary['messages'], entry)
+    summary['unread'] = summary['unread'] or not message.is_read
+    summary['starred'] = summary['starred'] or message.is_starred
+    summary['has_attachments'] = \
+        summary['has_attachments'] or bool(message.attachments)
+    if not in_sent and not message.is_sent:
+        summary['received_recent_date'] = max(
+            summary['received_recent_date'], received)
+    for phrase, address in itertools.chain(message.from_addr,
+                                           message.to_addr, message.cc_addr,
+                                           message.bcc_addr):
+        phrases = summary['participants'].setdefault(address, [])
+        if phrase.strip() not in phrases:
+            phrases.append(phrase.strip())
+
+
 class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
              DeletedAtMixin):
     """
@@ -45,6 +124,40 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
     snippet = Column(String(191), nullable=True, default='')
     version = Column(Integer, nullable=True, server_default='0')
 
+    # Aggregates over the thread's messages (see empty_summary()), so that
+    # threads can be rendered without loading their messages. Kept up to date
+    # on flush by inbox.models.transaction.update_thread_summaries(). NULL
+    # for threads which haven't been updated since this was introduced and
+    # haven't been backfilled (bin/backfill-thread-summaries) yet; the
+    # properties below then fall back to looking at the messages.
+    summary = Column(BigJSON, nullable=True)
+
+    @property
+    def _use_summary(self):
+        # If the messages are loaded anyway, use them instead: they reflect
+        # changes which haven't been flushed into the summary yet.
+        return self.summary is not None and \
+            'messages' in inspect(self).unloaded
+
+    def add_to_summary(self, message):
+        summary = self.summary
+        if summary is None:
+            summary = empty_summary()
+        else:
+            # Copy deeply, so that the change is picked up on flush even if
+            # only the nested lists and dicts change.
+            summary = copy.deepcopy(summary)
+        add_message_to_summary(summary, message)
+        self.summary = summary
+
+    def refresh_summary(self, exclude=()):
+        summary = empty_summary()
+        for message in self.messages:
+            if message not in exclude:
+                add_message_to_summary(summary, message)
+        if summary != self.summary:
+            self.summary = summary
+
     @validates('subject')
     def compute_cleaned_up_subject(self, key, value):
         self._cleaned_subject = cleanup_subject(value)
@@ -70,6 +183,9 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
 
     @property
     def most_recent_received_date(self):
+        if self._use_summary:
+            return _datetime(self.summary['received_recent_date'] or
+                             self.summary['last_date'])
         received_recent_date = None
         for m in self.messages:
             if all(category.name != "sent" for category in m.categories if category is not None) and \
@@ -95,6 +211,8 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
             thread, as decided by whether the message is in the sent folder or
             not. Clients can use this to properly sort the Sent view.
             """
+        if self._use_summary:
+            return _datetime(self.summary['sent_recent_date'])
         sent_recent_date = None
         sorted_messages = sorted(self.messages,
                                  key=lambda m: m.received_date, reverse=True)
@@ -106,16 +224,34 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
 
     @property
     def unread(self):
+        if self._use_summary:
+            return self.summary['unread']
         return not all(m.is_read for m in self.messages if not m.is_draft)
 
     @property
     def starred(self):
+        if self._use_summary:
+            return self.summary['starred']
         return any(m.is_starred for m in self.messages if not m.is_draft)
 
     @property
     def has_attachments(self):
+        if self._use_summary:
+            return self.summary['has_attachments']
         return any(m.attachments for m in self.messages if not m.is_draft)
 
+    @property
+    def message_public_ids(self):
+        if self._use_summary:
+            return [public_id for _, public_id in self.summary['messages']]
+        return [m.public_id for m in self.messages if not m.is_draft]
+
+    @property
+    def draft_public_ids(self):
+        if self._use_summary:
+            return [public_id for _, public_id in self.summary['drafts']]
+        return [m.public_id for m in self.drafts]
+
     @property
     def versioned_relationships(self):
         return ['messages']
@@ -130,13 +266,17 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
 
         """
         deduped_participants = defaultdict(set)
-        for m in self.messages:
-            if m.is_draft:
-                # Don't use drafts to compute participants.
-                continue
-            for phrase, address in itertools.chain(m.from_addr, m.to_addr,
-                                                   m.cc_addr, m.bcc_addr):
-                deduped_participants[address].add(phrase.strip())
+        if self._use_summary:
+            for address, phrases in self.summary['participants'].iteritems():
+                deduped_participants[address].update(phrases)
+        else:
+            for m in self.messages:
+                if m.is_draft:
+                    # Don't use drafts to compute participants.
+                    continue
+                for phrase, address in itertools.chain(m.from_addr, m.to_addr,
+                                                       m.cc_addr, m.bcc_addr):
+                    deduped_participants[address].add(phrase.strip())
         p = []
         for address, phrases in deduped_participants.iteritems():
             for phrase in phrases:
@@ -162,13 +302,36 @@ class Thread(MailSyncBase, HasPublicID, HasRevisions, UpdatedAtMixin,
 
     @property
     def categories(self):
+        if self._use_summary:
+            return self._categories_by_public_id(self.summary['category_ids'])
         categories = set()
         for m in self.messages:
             categories.update(m.categories)
         return categories
 
+    def _categories_by_public_id(self, public_ids):
+        # Look categories up in a per-session map of the namespace's
+        # categories, so that rendering a page of threads takes at most one
+        # query for them.
+        from inbox.models.category import Category
+        session = object_session(self)
+        cache = session.info.setdefault('categories_by_public_id', {})
+        categories = cache.get(self.namespace_id)
+        if categories is None or \
+                any(public_id not in categories for public_id in public_ids):
+            categories = {c.public_id: c for c in session.query(Category).
+                          filter(Category.namespace_id == self.namespace_id)}
+            cache[self.namespace_id] = categories
+        return {categories[public_id] for public_id in public_ids
+                if public_id in categories}
+
     @classmethod
     def api_loading_options(cls, expand=False):
+        if not expand and config.get('THREAD_SUMMARIES_BACKFILLED', False):
+            # Threads with a summary don't need their messages. Only once
+            # bin/backfill-thread-summaries has run are there few enough
+            # threads without one for lazy-loading their messages to be OK.
+            return ()
         message_columns = ['public_id', 'is_draft', 'from_addr', 'to_addr',
                            'cc_addr', 'bcc_addr', 'is_read', 'is_starred',
                            'received_date', 'is_sent']
@@ -204,3 +367,20 @@ Index('ix_cleaned_subject', Thread._cleaned_subject, mysql_length=191)
 # For async deletion.
 Index('ix_thread_namespace_id_deleted_at', Thread.namespace_id,
       Thread.deleted_at)
+
+
+class ThreadReference(MailSyncBase):
+    """
+    Threading index for accounts which we thread ourselves: maps hashes of
+    the Message-Ids of a thread's messages, and of the Message-Ids they
+    reference, to the thread. See inbox.util.threading.
+
+    """
+    namespace_id = Column(BigInteger, nullable=False)
+    message_id_hash = Column(BigInteger, nullable=False)
+    thread_id = Column(ForeignKey(Thread.id, ondelete='CASCADE'),
+                       nullable=False, index=True)
+    thread = relationship(Thread, load_on_pending=True)
+
+Index('ix_threadreference_namespace_id_message_id_hash',
+      ThreadReference.namespace_id, ThreadReference.message_id_hash)
@@ -72,6 +72,19 @@ def create_revisions(session):
             create_revision(obj, session, 'delete')
 
 
+def track_new_transactions(session):
+    """
+    Record the latest transaction id per namespace flushed in this session, so
+    that they can be announced once the session commits.
+
+    """
+    latest = session.info.setdefault('new_transaction_ids', {})
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            latest[obj.namespace_id] = max(obj.id,
+                                           latest.get(obj.namespace_id, 0))
+
+
 def create_revision(obj, session, revision_type):
     assert revision_type in ('insert', 'update', 'delete')
 
@@ -112,6 +125,53 @@ def propagate_changes(session):
                         obj.thread.dirty = True
 
 
+# Message attributes which feed into Thread.summary.
+THREAD_SUMMARY_ATTRIBUTES = ['is_read', 'is_starred', 'is_draft', 'is_sent',
+                             'received_date', 'from_addr', 'to_addr',
+                             'cc_addr', 'bcc_addr', 'messagecategories',
+                             'parts', '_thread']
+
+
+def update_thread_summaries(session):
+    """
+    Keep Thread.summary up to date with changes to the threads' messages.
+    New messages are merged into their thread's summary; other changes
+    recompute the summary from the thread's messages.
+
+    """
+    from inbox.models.message import Message
+    from inbox.models.thread import Thread
+    stale = set()
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Message) and obj.thread is not None:
+                thread = obj.thread
+                if thread.summary is None and thread not in session.new:
+                    # Build the summary from scratch the first time an
+                    # existing thread changes.
+                    stale.add(thread)
+                else:
+                    thread.add_to_summary(obj)
+        for obj in session.dirty:
+            obj_state = inspect(obj)
+            if isinstance(obj, Message):
+                if any(getattr(obj_state.attrs, attr).history.has_changes()
+                       for attr in THREAD_SUMMARY_ATTRIBUTES):
+                    stale.add(obj.thread)
+                    # If the message moved, update its old thread too.
+                    stale.update(obj_state.attrs._thread.history.deleted)
+            elif isinstance(obj, Thread):
+                if obj_state.attrs.messages.history.has_changes():
+                    stale.add(obj)
+        for obj in session.deleted:
+            if isinstance(obj, Message):
+                stale.add(obj.thread)
+
+        for thread in stale:
+            if thread is not None and thread not in session.deleted:
+                thread.refresh_summary(exclude=session.deleted)
+
+
 def increment_versions(session):
     from inbox.models.thread import Thread
     from inbox.models.metadata import Metadata
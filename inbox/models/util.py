@@ -166,8 +166,10 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     # we include here for simplicity anyway.
 
     filters = OrderedDict()
-    for table in ['message', 'block', 'thread', 'transaction', 'actionlog',
-                  'contact', 'event', 'dataprocessingcache']:
+    for table in ['messagesearchterm', 'messagesearchdocument', 'message',
+                  'block', 'thread', 'transaction', 'actionlog',
+                  'contactsearchterm', 'contact', 'event',
+                  'dataprocessingcache']:
         filters[table] = ('namespace_id', namespace_id)
 
     if account_discriminator == 'easaccount':
@@ -198,7 +200,7 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     query = 'DELETE FROM {} WHERE {}={};'
 
     filters = OrderedDict()
-    for table in ('category', 'calendar'):
+    for table in ('category', 'calendar', 'messagesearchindex'):
         filters[table] = ('namespace_id', namespace_id)
     for table in ('folder', 'label'):
         filters[table] = ('account_id', account_id)
@@ -2,7 +2,12 @@ from __future__ import absolute_import, division, print_function
 
 from inbox.basicauth import NotSupportedError
 
-__all__ = ['provider_info', 'providers']
+__all__ = ['provider_info', 'providers', 'sync_concurrency']
+
+# How many IMAP connections an account's initial sync downloads mail on at
+# once, unless its provider's "sync_concurrency" says otherwise. Gmail shards
+# per user, so more connections don't make its downloads any faster.
+DEFAULT_SYNC_CONCURRENCY = 1
 
 
 def provider_info(provider_name):
@@ -19,6 +24,17 @@ def provider_info(provider_name):
     return providers[provider_name]
 
 
+def sync_concurrency(provider_name):
+    """
+    The maximum number of connections to download an account's mail on
+    concurrently during initial sync: several folders at once, or several
+    ranges of UIDs of one large folder.
+
+    """
+    return providers.get(provider_name, {}).get('sync_concurrency',
+                                                 DEFAULT_SYNC_CONCURRENCY)
+
+
 providers = dict([
     ("aol", {
         "type": "generic",
@@ -106,6 +122,8 @@ providers = dict([
                        "INBOX.Trash": "trash"},
         "domains": ["fastmail.fm", "fastmail.com"],
         "mx_servers": ["in[12]-smtp.messagingengine.com"],
+        # number of connections to download mail on concurrently
+        "sync_concurrency": 4,
         # exact string matches
         "ns_servers": ["ns1.messagingengine.com.",
                        "ns2.messagingengine.com."],
@@ -323,6 +341,9 @@ providers = dict([
     ("custom", {
         "type": "generic",
         "auth": "password",
+        # Dovecot, Exchange and most other self-hosted servers handle a few
+        # concurrent sessions per user fine.
+        "sync_concurrency": 3,
         "folder_map": {"INBOX.Archive": "archive",
                        "INBOX.Drafts": "drafts", "INBOX.Junk Mail": "spam",
                        "INBOX.Trash": "trash", "INBOX.Sent Items": "sent",
@@ -17,14 +17,23 @@ not currently being synced. Individual sync processes pull account ids off of
 this queue, and claim ownership by updating a Redis hash that maps account
 ids to process identifiers. We use a bit of Redis Lua scripting to ensure that
 this happens atomically.
+
+Rather than polling the database, the QueuePopulator follows the changes of
+accounts' sync_should_run, sync_host and desired_sync_host, which are
+published to a per-zone event queue when they're committed (see
+inbox.models.account), and only looks up the accounts which changed. All
+syncable accounts are reconciled with the queue every RECONCILE_INTERVAL
+seconds, in case events were lost.
 """
 
-import gevent
+import time
 import itertools
+from collections import defaultdict
 from inbox.config import config
 from inbox.ignition import engine_manager
 from inbox.models.session import session_scope_by_shard_id
 from inbox.models import Account
+from inbox.scheduling.event_queue import EventQueue
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
@@ -34,6 +43,28 @@ log = get_logger()
 SOCKET_CONNECT_TIMEOUT = 5
 SOCKET_TIMEOUT = 5
 
+ACCOUNT_EVENT_QUEUE_NAME = 'sync:account_events:{}'
+
+# How often (in seconds) all syncable accounts are reconciled with the queue.
+RECONCILE_INTERVAL = 300
+
+# At most this many account events are handled at a time.
+MAX_EVENTS_PER_BATCH = 1000
+
+
+def account_event_queue_for_zone(zone):
+    return EventQueue(ACCOUNT_EVENT_QUEUE_NAME.format(zone))
+
+
+def publish_account_event(account_id):
+    """
+    Notify the QueuePopulator of the account's zone that the account's
+    sync_should_run, sync_host or desired_sync_host changed.
+    """
+    zone = engine_manager.zone_for_id(account_id)
+    account_event_queue_for_zone(zone).send_event({'event': 'account_changed',
+                                                   'id': account_id})
+
 
 class QueueClient(object):
     """Interface to a Redis queue/hashmap combo for managing account sync
@@ -124,14 +155,18 @@ class QueueClient(object):
 
 class QueuePopulator(object):
     """
-    Polls the database for account ids to sync and queues them. Run one of
-    these per zone.
+    Follows the changes of accounts and queues the account ids to sync. Run
+    one of these per zone.
     """
 
-    def __init__(self, zone, poll_interval=1):
+    def __init__(self, zone, poll_interval=1,
+                 reconcile_interval=RECONCILE_INTERVAL):
         self.zone = zone
         self.poll_interval = poll_interval
+        self.reconcile_interval = reconcile_interval
+        self.next_reconcile = 0
         self.queue_client = QueueClient(zone)
+        self.event_queue = account_event_queue_for_zone(zone)
         self.shards = []
         for database in config['DATABASE_HOSTS']:
             if database.get('ZONE') == self.zone:
@@ -145,28 +180,64 @@ class QueuePopulator(object):
             retry_with_logging(self._run_impl)
 
     def _run_impl(self):
-        self.enqueue_new_accounts()
-        self.unassign_disabled_accounts()
+        if time.time() >= self.next_reconcile:
+            self.reconcile()
+            self.next_reconcile = time.time() + self.reconcile_interval
+        self.process_account_events()
         statsd_client.gauge('syncqueue.queue.{}.length'.format(self.zone),
                             self.queue_client.qsize())
         statsd_client.incr('syncqueue.service.{}.heartbeat'.
                            format(self.zone))
-        gevent.sleep(self.poll_interval)
 
-    def enqueue_new_accounts(self):
+    def reconcile(self):
+        runnable_accounts = self.runnable_accounts()
+        self.enqueue_new_accounts(runnable_accounts)
+        self.unassign_disabled_accounts(runnable_accounts)
+
+    def process_account_events(self):
+        """
+        Waits up to poll_interval seconds for account events, and updates
+        the queue for the accounts which changed.
+        """
+        account_ids = set()
+        event = self.event_queue.receive_event(timeout=self.poll_interval)
+        while event is not None:
+            if event.get('id') is not None:
+                account_ids.add(int(event['id']))
+            if len(account_ids) >= MAX_EVENTS_PER_BATCH:
+                break
+            event = self.event_queue.receive_event(timeout=None)
+        if not account_ids:
+            return
+
+        runnable_accounts = self.runnable_accounts(account_ids)
+        tracked_accounts = self.queue_client.all()
+        for account_id in runnable_accounts - tracked_accounts:
+            log.info('Enqueuing new account', account_id=account_id)
+            self.queue_client.enqueue(account_id)
+        for account_id, sync_host in self.queue_client.assigned().items():
+            if account_id in account_ids and \
+                    account_id not in runnable_accounts:
+                log.info('Removing disabled account', account_id=account_id)
+                self.queue_client.unassign(account_id, sync_host)
+
+    def enqueue_new_accounts(self, runnable_accounts=None):
         """
         Finds any account ids that should sync, but are not currently being
         tracked by the QueueClient. Enqueue them. (Note: it's okay to enqueue
         the same id twice. QueueClient.claim_next will identify and discard
         duplicates.)
         """
-        new_accounts = self.runnable_accounts() - self.queue_client.all()
+        if runnable_accounts is None:
+            runnable_accounts = self.runnable_accounts()
+        new_accounts = runnable_accounts - self.queue_client.all()
         for account_id in new_accounts:
             log.info('Enqueuing new account', account_id=account_id)
             self.queue_client.enqueue(account_id)
 
-    def unassign_disabled_accounts(self):
-        runnable_accounts = self.runnable_accounts()
+    def unassign_disabled_accounts(self, runnable_accounts=None):
+        if runnable_accounts is None:
+            runnable_accounts = self.runnable_accounts()
         disabled_accounts = {
             k: v for k, v in self.queue_client.assigned().items()
             if k not in runnable_accounts
@@ -175,11 +246,26 @@ class QueuePopulator(object):
             log.info('Removing disabled account', account_id=account_id)
             self.queue_client.unassign(account_id, sync_host)
 
-    def runnable_accounts(self):
+    def runnable_accounts(self, account_ids=None):
+        """
+        The ids of the zone's accounts which should sync, out of the given
+        ones if `account_ids` is set, or all of them.
+        """
+        if account_ids is None:
+            shard_account_ids = {key: None for key in self.shards}
+        else:
+            shard_account_ids = defaultdict(list)
+            for account_id in account_ids:
+                key = engine_manager.shard_key_for_id(account_id)
+                if key in self.shards:
+                    shard_account_ids[key].append(account_id)
+
         accounts = set()
-        for key in self.shards:
+        for key, ids in shard_account_ids.items():
             with session_scope_by_shard_id(key) as db_session:
-                accounts.update(
-                    id_ for id_, in db_session.query(Account.id).filter(
-                        Account.sync_should_run))
+                query = db_session.query(Account.id).filter(
+                    Account.sync_should_run)
+                if ids is not None:
+                    query = query.filter(Account.id.in_(ids))
+                accounts.update(id_ for id_, in query)
         return accounts
@@ -0,0 +1,127 @@
+from inbox.api.kellogs import APIEncoder
+from inbox.models import Message, Thread
+from inbox.models.session import session_scope
+from inbox.search.index import get_search_index, rank_messages
+from nylas.logging import get_logger
+
+PROVIDER = 'local'
+SEARCH_CLS = 'LocalSearchClient'
+
+# Messages are looked up in chunks of this many ranked ids, to find a page
+# of results which haven't been deleted since they were indexed.
+RESULT_CHUNK_SIZE = 500
+
+
+class LocalSearchClient(object):
+    """
+    Search client which answers queries from the local search index (see
+    inbox.search.index). Until a namespace's existing mail has been
+    indexed, queries the index can't fill a page of results for are passed
+    on to the provider's search client.
+
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.account_id = account.id
+        self.namespace_id = account.namespace.id
+        self.log = get_logger().new(account_id=account.id,
+                                    component='search')
+        self._provider_client = None
+
+    @property
+    def provider_client(self):
+        if self._provider_client is None:
+            from inbox.search.backends import module_registry
+
+            search_mod = module_registry.get(self.account.provider)
+            search_cls = getattr(search_mod, search_mod.SEARCH_CLS)
+            self._provider_client = search_cls(self.account)
+        return self._provider_client
+
+    def _should_fall_back(self, db_session, results, limit):
+        if limit and len(results) >= limit:
+            return False
+        search_index = get_search_index(db_session, self.namespace_id)
+        if search_index is not None and search_index.backfilled_at:
+            return False
+        self.log.info('Search index incomplete, searching provider',
+                      indexed=search_index is not None)
+        return True
+
+    def _ranked_messages(self, db_session, search_query):
+        """Yield the matching messages, best matches first."""
+        message_ids = rank_messages(db_session, self.namespace_id,
+                                    search_query)
+        for i in range(0, len(message_ids), RESULT_CHUNK_SIZE):
+            chunk = message_ids[i:i + RESULT_CHUNK_SIZE]
+            messages = {message.id: message for message in
+                        db_session.query(Message).filter(
+                            Message.namespace_id == self.namespace_id,
+                            Message.id.in_(chunk),
+                            Message.deleted_at.is_(None))}
+            for id_ in chunk:
+                if id_ in messages:
+                    yield messages[id_]
+
+    def _search_messages(self, db_session, search_query, offset, limit):
+        results = []
+        for message in self._ranked_messages(db_session, search_query):
+            if limit and len(results) >= offset + limit:
+                break
+            results.append(message)
+        return results[offset:]
+
+    def _search_threads(self, db_session, search_query, offset, limit):
+        thread_ids = []
+        for message in self._ranked_messages(db_session, search_query):
+            if limit and len(thread_ids) >= offset + limit:
+                break
+            if message.thread_id not in thread_ids:
+                thread_ids.append(message.thread_id)
+        thread_ids = thread_ids[offset:]
+        if not thread_ids:
+            return []
+        threads = {thread.id: thread for thread in
+                   db_session.query(Thread).filter(
+                       Thread.namespace_id == self.namespace_id,
+                       Thread.id.in_(thread_ids),
+                       Thread.deleted_at.is_(None))}
+        return [threads[id_] for id_ in thread_ids if id_ in threads]
+
+    def search_messages(self, db_session, search_query, offset=0, limit=40):
+        results = self._search_messages(db_session, search_query, offset,
+                                        limit)
+        if self._should_fall_back(db_session, results, limit):
+            return self.provider_client.search_messages(
+                db_session, search_query, offset=offset, limit=limit)
+        return results
+
+    def search_threads(self, db_session, search_query, offset=0, limit=40):
+        results = self._search_threads(db_session, search_query, offset,
+                                       limit)
+        if self._should_fall_back(db_session, results, limit):
+            return self.provider_client.search_threads(
+                db_session, search_query, offset=offset, limit=limit)
+        return results
+
+    # The index answers in a single query, so there's no need to stream it.
+    def stream_messages(self, search_query):
+        def g():
+            encoder = APIEncoder()
+
+            with session_scope(self.account_id) as db_session:
+                yield encoder.cereal(self.search_messages(
+                    db_session, search_query)) + '\n'
+
+        return g
+
+    def stream_threads(self, search_query):
+        def g():
+            encoder = APIEncoder()
+
+            with session_scope(self.account_id) as db_session:
+                yield encoder.cereal(self.search_threads(
+                    db_session, search_query)) + '\n'
+
+        return g
@@ -1,7 +1,15 @@
+from inbox.config import config
+
+
 def get_search_client(account):
     from inbox.search.backends import module_registry
 
-    search_mod = module_registry.get(account.provider)
+    # With the local search index enabled, its client falls back to the
+    # provider's own for searches it can't answer.
+    if config.get('LOCAL_SEARCH_INDEX', False):
+        search_mod = module_registry.get('local')
+    else:
+        search_mod = module_registry.get(account.provider)
     search_cls = getattr(search_mod, search_mod.SEARCH_CLS)
     search_client = search_cls(account)
     return search_client
@@ -0,0 +1,329 @@
+"""
+Local full-text search index of messages.
+
+Each namespace's messages are indexed into an inverted index on the
+namespace's shard: a MessageSearchTerm posting per distinct term of each
+message, with the term's weighted number of occurrences in the message's
+subject, participants, attachment filenames and body text. Messages are
+indexed as they're synced, by the message-search-index service, which
+follows the transaction log, and existing mail is indexed by
+bin/message-search-backfill.
+
+Queries match messages containing all of their terms, the last of which
+(the one being typed) may also be a prefix of a term of the message, and rank
+them with BM25. The search client in
+inbox.search.backends.local uses the index, and falls back to searching the
+provider while a namespace's history hasn't been backfilled.
+
+"""
+import re
+import time
+import datetime
+import unicodedata
+from collections import Counter, defaultdict
+from math import log as ln
+
+from sqlalchemy import desc, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import subqueryload
+
+from inbox.models import Message, Part
+from inbox.models.search import (MessageSearchIndex, MessageSearchDocument,
+                                 MessageSearchTerm)
+from inbox.models.session import session_scope
+from inbox.sqlalchemy_ext.util import safer_yield_per
+from inbox.util.html import strip_tags
+from nylas.logging import get_logger
+log = get_logger()
+
+# How much an occurrence of a term in each field counts for.
+FIELD_WEIGHTS = {
+    'subject': 3,
+    'participants': 2,
+    'filenames': 2,
+    'body': 1,
+}
+
+# Only this many characters of each message's body text are indexed.
+MAX_BODY_LENGTH = 20000
+
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+# Includes the reply and forward prefixes, which are in the subjects of
+# most messages.
+STOPWORDS = frozenset([
+    'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'fw', 'fwd',
+    'has', 'he', 'in', 'is', 'it', 'its', 'of', 'on', 're', 'that', 'the',
+    'to', 'was', 'were', 'will', 'with'])
+
+# The last query term only matches as a prefix if it's at least this long.
+# Matching prefixes can't use the index to find the most recent postings, so
+# all of the postings of every term with the prefix are read.
+MIN_PREFIX_LENGTH = 3
+
+# A query term matching more postings than this is treated like a stopword,
+# unless it's the only term, in which case only the most recent messages
+# containing it are ranked.
+MAX_TERM_POSTINGS = 20000
+
+# Matches of a query term as a proper prefix of a message's term count for
+# this much of an exact match.
+PREFIX_MATCH_WEIGHT = 0.5
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+# How long the number of documents and their average length, which only
+# drift slowly, are cached for, in seconds.
+STATS_CACHE_TTL = 600
+
+INDEX_CHUNK_SIZE = 100
+
+_term_re = re.compile(r'\w+', re.UNICODE)
+
+_stats_cache = {}
+
+
+def fold(text):
+    """`text` as lowercase unicode, without accents."""
+    if not text:
+        return u''
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'ignore')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """The index terms of `text`: lowercased words, without accents."""
+    return [term for term in _term_re.findall(fold(text))
+            if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH and
+            term not in STOPWORDS]
+
+
+def message_terms(message):
+    """The weighted number of occurrences of each term of the message."""
+    participants = []
+    for name, email_address in message.participants:
+        participants.extend([name, email_address])
+    filenames = [part.block.filename for part in message.attachments
+                 if part.block.filename]
+    body = strip_tags(message.body or '')[:MAX_BODY_LENGTH]
+
+    terms = Counter()
+    for field, texts in (('subject', [message.subject]),
+                         ('participants', participants),
+                         ('filenames', filenames),
+                         ('body', [body])):
+        weight = FIELD_WEIGHTS[field]
+        for text in texts:
+            for term in tokenize(text):
+                terms[term] += weight
+    return terms
+
+
+def get_search_index(db_session, namespace_id):
+    return db_session.query(MessageSearchIndex).filter(
+        MessageSearchIndex.namespace_id == namespace_id).first()
+
+
+def index_messages(db_session, namespace_id, message_ids, reindex=False):
+    """
+    Add the namespace's given messages to its search index, replacing
+    their postings if `reindex` is set and skipping them otherwise if
+    they're already indexed. Messages marked for deletion aren't indexed.
+
+    Returns the number of messages indexed. The caller commits.
+
+    """
+    message_ids = set(message_ids)
+    if not message_ids:
+        return 0
+    if get_search_index(db_session, namespace_id) is None:
+        db_session.add(MessageSearchIndex(namespace_id=namespace_id))
+
+    indexed = {id_ for id_, in db_session.query(
+        MessageSearchDocument.message_id).filter(
+        MessageSearchDocument.message_id.in_(message_ids))}
+    if reindex:
+        unindex_messages(db_session, indexed)
+    else:
+        message_ids -= indexed
+    if not message_ids:
+        return 0
+
+    messages = db_session.query(Message).filter(
+        Message.namespace_id == namespace_id,
+        Message.id.in_(message_ids),
+        Message.deleted_at.is_(None)).options(
+        subqueryload(Message.parts).joinedload(Part.block))
+    count = 0
+    for message in messages:
+        terms = message_terms(message)
+        length = sum(terms.itervalues())
+        db_session.add(MessageSearchDocument(
+            namespace_id=namespace_id, message_id=message.id,
+            length=length))
+        db_session.bulk_insert_mappings(MessageSearchTerm, [
+            dict(namespace_id=namespace_id, term=term, message_id=message.id,
+                 frequency=frequency, length=length)
+            for term, frequency in terms.iteritems()])
+        count += 1
+    return count
+
+
+def unindex_messages(db_session, message_ids):
+    """Remove the given messages from the search index."""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    db_session.query(MessageSearchTerm).filter(
+        MessageSearchTerm.message_id.in_(message_ids)).delete(
+        synchronize_session=False)
+    db_session.query(MessageSearchDocument).filter(
+        MessageSearchDocument.message_id.in_(message_ids)).delete(
+        synchronize_session=False)
+
+
+def _backfill_chunk(db_session, namespace_id, message_ids):
+    try:
+        count = index_messages(db_session, namespace_id, message_ids)
+        db_session.commit()
+    except IntegrityError:
+        # Some of the messages were just indexed by the search index
+        # service.
+        db_session.rollback()
+        count = index_messages(db_session, namespace_id, message_ids)
+        db_session.commit()
+    return count
+
+
+def index_namespace(namespace_id, chunk_size=INDEX_CHUNK_SIZE):
+    """
+    Backfill the search index of a namespace with the messages it doesn't
+    have yet, then mark it as complete. Idempotent.
+
+    """
+    with session_scope(namespace_id) as db_session:
+        query = db_session.query(Message.id).filter(
+            Message.namespace_id == namespace_id)
+        message_ids = []
+        indexed = 0
+        for message in safer_yield_per(query, Message.id, 0, 1000):
+            message_ids.append(message.id)
+            if len(message_ids) >= chunk_size:
+                indexed += _backfill_chunk(db_session, namespace_id,
+                                           message_ids)
+                message_ids = []
+        indexed += _backfill_chunk(db_session, namespace_id, message_ids)
+
+        search_index = get_search_index(db_session, namespace_id)
+        if search_index is None:
+            search_index = MessageSearchIndex(namespace_id=namespace_id)
+            db_session.add(search_index)
+        search_index.backfilled_at = datetime.datetime.utcnow()
+        db_session.commit()
+    log.info('namespace search index complete', namespace_id=namespace_id,
+             messages_indexed=indexed)
+
+
+def prefix_pattern(term):
+    """A LIKE pattern (escaped with backslashes) matching the strings
+    which start with `term`."""
+    return term.replace('\\', '\\\\').replace('%', '\\%'). \
+        replace('_', '\\_') + '%'
+
+
+def _index_stats(db_session, namespace_id):
+    """The number of indexed messages and their average length."""
+    cached = _stats_cache.get(namespace_id)
+    if cached is not None and cached[0] > time.time():
+        return cached[1:]
+    count, total_length = db_session.query(
+        func.count(MessageSearchDocument.id),
+        func.sum(MessageSearchDocument.length)).filter(
+        MessageSearchDocument.namespace_id == namespace_id).one()
+    count = count or 0
+    average_length = float(total_length or 0) / count if count else 1.0
+    _stats_cache[namespace_id] = (time.time() + STATS_CACHE_TTL, count,
+                                  average_length)
+    return count, average_length
+
+
+def _postings(db_session, namespace_id, query_term, prefix=False):
+    """(term, message_id, frequency, length) rows of the term, or of the
+    terms with the given prefix, most recent messages first."""
+    if prefix:
+        term_filter = MessageSearchTerm.term.like(prefix_pattern(query_term),
+                                                  escape='\\')
+    else:
+        term_filter = MessageSearchTerm.term == query_term
+    return db_session.query(
+        MessageSearchTerm.term, MessageSearchTerm.message_id,
+        MessageSearchTerm.frequency, MessageSearchTerm.length).filter(
+        MessageSearchTerm.namespace_id == namespace_id, term_filter). \
+        order_by(desc(MessageSearchTerm.message_id)). \
+        limit(MAX_TERM_POSTINGS + 1).all()
+
+
+def rank_messages(db_session, namespace_id, search_query):
+    """
+    The ids of the namespace's indexed messages which match the query,
+    best matches first.
+
+    """
+    query_terms = []
+    for term in tokenize(search_query):
+        if term not in query_terms:
+            query_terms.append(term)
+    if not query_terms:
+        return []
+
+    document_count, average_length = _index_stats(db_session, namespace_id)
+    # Only the last term may be incomplete.
+    last_term = query_terms[-1]
+    postings = [(term, _postings(db_session, namespace_id, term,
+                                 prefix=term == last_term and
+                                 len(term) >= MIN_PREFIX_LENGTH))
+                for term in query_terms]
+    common = [term for term, rows in postings
+              if len(rows) > MAX_TERM_POSTINGS]
+    if len(common) < len(postings):
+        postings = [(term, rows) for term, rows in postings
+                    if term not in common]
+    else:
+        # Only common terms: rank the most recent messages with them.
+        postings = [(term, rows[:MAX_TERM_POSTINGS])
+                    for term, rows in postings]
+
+    candidates = None
+    scores_by_term = []
+    for query_term, rows in postings:
+        frequencies = defaultdict(int)
+        for row in rows:
+            frequencies[row.term] += 1
+        scores = {}
+        for row in rows:
+            # The cached document count may be a little out of date.
+            count = max(document_count, frequencies[row.term])
+            idf = ln(1 + (count - frequencies[row.term] + 0.5) /
+                     (frequencies[row.term] + 0.5))
+            score = idf * row.frequency * (K1 + 1) / (
+                row.frequency + K1 * (1 - B + B * row.length /
+                                      average_length))
+            if row.term != query_term:
+                score *= PREFIX_MATCH_WEIGHT
+            scores[row.message_id] = max(score,
+                                         scores.get(row.message_id, 0))
+        scores_by_term.append(scores)
+        if candidates is None:
+            candidates = set(scores)
+        else:
+            candidates.intersection_update(scores)
+
+    ranked = [(sum(scores[id_] for scores in scores_by_term), id_)
+              for id_ in candidates]
+    ranked.sort(reverse=True)
+    return [id_ for _, id_ in ranked]
@@ -0,0 +1,109 @@
+from inbox.models import Category
+from inbox.models.counter import (CategoryCounter, COUNTER_FIELDS,
+                                  count_categories, reconcile_counters)
+from inbox.test.util.base import add_fake_message, add_fake_thread
+from inbox.test.api.base import api_client
+
+__all__ = ['api_client']
+
+
+def stored_counts(db, namespace_id):
+    return {c.category_id: {field: getattr(c, field)
+                            for field in COUNTER_FIELDS}
+            for c in db.session.query(CategoryCounter).filter(
+                CategoryCounter.namespace_id == namespace_id)}
+
+
+def test_counters_are_maintained(db, api_client, default_namespace):
+    namespace_id = default_namespace.id
+    inbox = Category.find_or_create(db.session, namespace_id, 'inbox',
+                                    'Inbox', 'folder')
+    thread = add_fake_thread(db.session, namespace_id)
+    first = add_fake_message(db.session, namespace_id, thread)
+    first.categories.add(inbox)
+    db.session.commit()
+    assert reconcile_counters(db.session, namespace_id) == 0
+    assert stored_counts(db, namespace_id) == \
+        count_categories(db.session, namespace_id)
+
+    second = add_fake_message(db.session, namespace_id, thread,
+                              add_sent_category=True)
+    second.is_read = True
+    other_thread = add_fake_thread(db.session, namespace_id)
+    third = add_fake_message(db.session, namespace_id, other_thread)
+    third.categories.add(inbox)
+    third.is_starred = True
+    db.session.commit()
+    first.is_read = True
+    db.session.commit()
+    assert stored_counts(db, namespace_id) == \
+        count_categories(db.session, namespace_id)
+
+    # The maintained counts match the listing queries.
+    for path in ('/threads', '/messages'):
+        for params in ('', '&in=inbox', '&in=inbox&unread=true',
+                       '&in=sent&starred=true', '&unread=false'):
+            url = '{}?view=count{}'.format(path, params)
+            count = api_client.get_data(url)['count']
+            assert count == len(api_client.get_data(
+                '{}?view=ids{}'.format(path, params)))
+
+    counts = {c['id']: c for c in api_client.get_data('/counts')}
+    assert counts[inbox.public_id]['threads'] == 2
+    assert counts[inbox.public_id]['unread_threads'] == 1
+    assert counts[inbox.public_id]['starred_messages'] == 1
+    assert counts[None]['messages'] == 3
+
+    # Drift is corrected.
+    db.session.query(CategoryCounter).update({'unread_messages': 100})
+    db.session.commit()
+    assert reconcile_counters(db.session, namespace_id) > 0
+    assert stored_counts(db, namespace_id) == \
+        count_categories(db.session, namespace_id)
+
+
+def test_counters_of_threads_without_summary(db, default_namespace):
+    from inbox.models import Thread
+    namespace_id = default_namespace.id
+    inbox = Category.find_or_create(db.session, namespace_id, 'inbox',
+                                    'Inbox', 'folder')
+    thread = add_fake_thread(db.session, namespace_id)
+    message = add_fake_message(db.session, namespace_id, thread)
+    message.categories.add(inbox)
+    db.session.commit()
+    # Threads from before summaries were introduced.
+    db.session.query(Thread).filter(Thread.id == thread.id). \
+        update({'summary': None})
+    db.session.commit()
+    db.session.expire_all()
+    reconcile_counters(db.session, namespace_id)
+
+    message.is_read = True
+    db.session.commit()
+    assert stored_counts(db, namespace_id) == \
+        count_categories(db.session, namespace_id)
+
+
+def test_counters_of_deleted_threads(db, default_namespace):
+    namespace_id = default_namespace.id
+    inbox = Category.find_or_create(db.session, namespace_id, 'inbox',
+                                    'Inbox', 'folder')
+    thread = add_fake_thread(db.session, namespace_id)
+    for _ in range(2):
+        message = add_fake_message(db.session, namespace_id, thread)
+        message.categories.add(inbox)
+    db.session.commit()
+    reconcile_counters(db.session, namespace_id)
+
+    # The thread's messages stop being counted along with it, even if they
+    # change at the same time.
+    thread.mark_for_deletion()
+    message.is_starred = True
+    db.session.commit()
+    assert stored_counts(db, namespace_id) == \
+        count_categories(db.session, namespace_id)
+
+    thread.deleted_at = None
+    db.session.commit()
+    assert stored_counts(db, namespace_id) == \
+        count_categories(db.session, namespace_id)
@@ -1,9 +1,11 @@
 import json
+import datetime
 from inbox.models import DataProcessingCache
 from sqlalchemy.orm.exc import NoResultFound
 from inbox.test.util.base import (add_fake_thread,
                              add_fake_message, default_namespace)
 from inbox.test.api.base import api_client
+from inbox.transactions.contact_scores import ContactScoresService
 
 
 __all__ = ['api_client', 'default_namespace']
@@ -146,3 +148,73 @@ def test_contact_groups(db, api_client, default_namespace):
         assert cached_data.contact_groups_last_updated is not None
     except (NoResultFound, AssertionError):
         assert False, "Contact groups not cached"
+
+
+def test_scores_updated_incrementally(db, api_client, default_namespace):
+    namespace_id = default_namespace.id
+    me = ('me', default_namespace.email_address)
+
+    def send(recipients):
+        fake_thread = add_fake_thread(db.session, namespace_id)
+        add_fake_message(db.session, namespace_id, fake_thread,
+                         subject='Froop', from_addr=[me], to_addr=recipients,
+                         add_sent_category=True)
+
+    for _ in range(3):
+        send([('x', 'x@nylas.com'), ('y', 'y@nylas.com')])
+    resp = api_client.get_raw('/contacts/rankings?force_recalculate=true')
+    assert resp.status_code == 200
+
+    for _ in range(3):
+        send([('y', 'y@nylas.com'), ('z', 'z@nylas.com')])
+    # New messages are counted once, however often the scores are updated.
+    service = ContactScoresService()
+    for _ in range(2):
+        service.update({namespace_id}, db.session)
+        db.session.commit()
+
+    rankings = dict(api_client.get_data('/contacts/rankings'))
+    groups = dict(api_client.get_data('/groups/intrinsic'))
+    assert 'z@nylas.com' in rankings
+    assert 'y@nylas.com, z@nylas.com' in groups
+
+    # And they match scores computed from scratch.
+    recalculated = dict(api_client.get_data(
+        '/contacts/rankings?force_recalculate=true'))
+    assert set(rankings) == set(recalculated)
+    for email, score in recalculated.items():
+        assert abs(rankings[email] - score) < 1e-6 * score
+    recalculated = dict(api_client.get_data(
+        '/groups/intrinsic?force_recalculate=true'))
+    assert set(groups) == set(recalculated)
+
+
+def test_future_dated_messages_ranked(db, api_client, default_namespace):
+    namespace_id = default_namespace.id
+    fake_thread = add_fake_thread(db.session, namespace_id)
+    add_fake_message(db.session, namespace_id, fake_thread,
+                     from_addr=[('me', default_namespace.email_address)],
+                     to_addr=[('x', 'x@nylas.com')],
+                     received_date=datetime.datetime(3000, 1, 1),
+                     add_sent_category=True)
+    resp = api_client.get_raw('/contacts/rankings?force_recalculate=true')
+    assert resp.status_code == 200
+    assert 'x@nylas.com' in dict(json.loads(resp.data))
+
+
+def test_stale_scores_rebuilt_by_service(db, api_client, default_namespace):
+    api_client.get_data('/contacts/rankings?force_recalculate=true')
+    dpcache = db.session.query(DataProcessingCache).filter(
+        DataProcessingCache.namespace_id == default_namespace.id).one()
+    dpcache.scores_rebuilt_at = datetime.datetime(2015, 1, 1)
+    db.session.commit()
+
+    # The endpoint serves the stored scores rather than rebuilding them.
+    api_client.get_data('/contacts/rankings')
+    db.session.refresh(dpcache)
+    assert dpcache.scores_rebuilt_at == datetime.datetime(2015, 1, 1)
+
+    service = ContactScoresService()
+    assert service.rebuild_stale(db.session)
+    db.session.commit()
+    assert dpcache.scores_rebuilt_at > datetime.datetime(2015, 1, 1)
@@ -2,7 +2,10 @@
 import arrow
 import urllib
 import pytest
+from datetime import timedelta
+from inbox.events.recurring import update_occurrences
 from inbox.models import Event, Calendar
+from inbox.models.event import RecurringEvent, RecurringEventOccurrence
 from inbox.test.api.base import api_client
 from inbox.test.util.base import message
 
@@ -128,6 +131,59 @@ def test_api_expand_recurring_before_after(db, api_client, recurring_event):
     assert len(all_events) == 1
 
 
+def test_api_expand_recurring_occurrences(db, api_client, default_namespace,
+                                         recurring_event):
+    event = recurring_event
+    recur = 'expand_recurring=true&starts_after={}&ends_before={}'.format(
+        urlsafe(event.start.replace(days=-1)),
+        urlsafe(event.start.replace(weeks=+30)))
+    all_events = api_client.get_data('/events?' + recur)
+    assert db.session.query(RecurringEventOccurrence).filter_by(
+        master_event_id=event.id).count() >= len(all_events)
+
+    # Cancelling an instance regenerates the event's occurrences.
+    # (The 2nd and 3rd weeks are EXDATEs.)
+    override = Event(original_start_time=event.start.replace(weeks=+3),
+                     master_event_uid=event.uid,
+                     namespace_id=default_namespace.id,
+                     calendar_id=event.calendar_id)
+    override.update(event)
+    ts_id = event.start.replace(weeks=+3).strftime("%Y%m%dT%H%M%SZ")
+    override.uid = event.uid + "_" + ts_id
+    override.master = event
+    override.master_event_uid = event.uid
+    override.cancelled = True
+    db.session.add(override)
+    db.session.commit()
+
+    events = api_client.get_data('/events?' + recur)
+    assert len(events) == len(all_events) - 1
+    cancelled_id = '{}_{}'.format(event.public_id, ts_id)
+    assert cancelled_id in [e['id'] for e in all_events]
+    assert cancelled_id not in [e['id'] for e in events]
+    assert api_client.get_data('/events?' + recur + '&view=count')[
+        'count'] == len(events)
+    page = api_client.get_data('/events?' + recur + '&offset=3&limit=4')
+    assert [e['id'] for e in page] == [e['id'] for e in events[3:7]]
+
+
+def test_occurrences_generated_from_current_event(db, recurring_event):
+    event = recurring_event
+    recur_query = db.session.query(RecurringEvent).filter(
+        RecurringEvent.id == event.id)
+    # The event changes behind the session's back, e.g. in a concurrent
+    # sync.
+    table = RecurringEvent.__table__
+    db.session.execute(table.update().where(table.c.id == event.id).values(
+        rrule='RRULE:FREQ=DAILY'))
+
+    update_occurrences(db.session, recur_query, event.start.replace(weeks=+1))
+    starts = [start for start, in db.session.query(
+        RecurringEventOccurrence.start).filter_by(master_event_id=event.id).
+        order_by(RecurringEventOccurrence.start).limit(2)]
+    assert starts[1] - starts[0] == timedelta(days=1)
+
+
 def test_api_override_serialization(db, api_client, default_namespace,
                                     recurring_event):
     event = recurring_event
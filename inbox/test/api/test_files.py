@@ -151,6 +151,34 @@ def test_download(api_client, uploaded_file_ids, filename):
     assert local_md5 == dl_md5
 
 
+def test_range_download(api_client, uploaded_file_ids):
+    in_file = api_client.get_data(u'/files?filename=muir.jpg')[0]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'data', 'muir.jpg')
+    local_data = open(path, 'rb').read()
+    url = '/files/{}/download'.format(in_file['id'])
+
+    r = api_client.get_raw(url, headers={'Range': 'bytes=10-99'})
+    assert r.status_code == 206
+    assert r.headers['Content-Range'] == 'bytes 10-99/{}'.format(
+        len(local_data))
+    assert r.data == local_data[10:100]
+
+    r = api_client.get_raw(url, headers={})
+    assert r.status_code == 200
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert r.data == local_data
+
+    r = api_client.get_raw(url, headers={
+        'Range': 'bytes={}-'.format(len(local_data) + 10)})
+    assert r.status_code == 416
+
+    # Multi-range requests get the whole file.
+    r = api_client.get_raw(url, headers={'Range': 'bytes=0-1,5-6'})
+    assert r.status_code == 200
+    assert r.data == local_data
+
+
 @pytest.fixture(scope='function')
 def fake_attachment(db, default_account, message):
     block = Block()
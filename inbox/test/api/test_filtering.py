@@ -245,6 +245,41 @@ def test_ordering(api_client, db, default_namespace):
     assert expected_public_ids == [r['id'] for r in ordered_results]
 
 
+def test_page_token_pagination(api_client, db, default_namespace):
+    # Include ties on the sort key, which the token has to break by id.
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    for i in range(5):
+        thr = add_fake_thread(db.session, default_namespace.id)
+        received_date = now - datetime.timedelta(seconds=22 * (i // 2))
+        add_fake_message(db.session, default_namespace.id, thr,
+                         received_date=received_date)
+        thr.recentdate = received_date
+    db.session.commit()
+
+    for endpoint in ('/messages', '/threads', '/messages?view=ids'):
+        separator = '&' if '?' in endpoint else '?'
+        expected = api_client.get_data(endpoint)
+        paged = []
+        url = '{}{}limit=2'.format(endpoint, separator)
+        while True:
+            r = api_client.get_raw(url, headers={})
+            assert r.status_code == 200
+            paged.extend(json.loads(r.data))
+            token = r.headers.get('Next-Page-Token')
+            if token is None:
+                break
+            url = '{}{}limit=2&page_token={}'.format(endpoint, separator,
+                                                       token)
+        assert paged == expected
+
+    r = api_client.get_raw('/messages?page_token=notatoken', headers={})
+    assert r.status_code == 400
+    r = api_client.get_raw('/messages?limit=2', headers={})
+    r = api_client.get_raw('/messages?offset=1&page_token={}'.format(
+        r.headers['Next-Page-Token']), headers={})
+    assert r.status_code == 400
+
+
 def test_strict_argument_parsing(api_client):
     r = api_client.get_raw('/threads?foo=bar')
     assert r.status_code == 400
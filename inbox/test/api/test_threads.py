@@ -147,3 +147,60 @@ def test_thread_label_updates(db, api_client, default_account, api_version,
         assert resp_data['labels'][0]['id'] == category.public_id
     else:
         assert resp_data['labels'] == []
+
+
+def test_thread_summary_matches_messages(db, api_client, default_account):
+    from inbox.models import Thread
+    namespace_id = default_account.namespace.id
+    thread = add_fake_thread(db.session, namespace_id)
+    add_fake_message(db.session, namespace_id, thread,
+                     from_addr=[('Alice', 'alice@example.com')],
+                     to_addr=[('', 'bob@example.com')],
+                     received_date=datetime.datetime(2015, 1, 1))
+    message = add_fake_message(db.session, namespace_id, thread,
+                               from_addr=[('Bob', 'bob@example.com')],
+                               received_date=datetime.datetime(2014, 1, 1),
+                               add_sent_category=True)
+    message.is_starred = True
+    db.session.commit()
+
+    db.session.expire_all()
+    assert db.session.query(Thread).get(thread.id).summary is not None
+    from_summary = api_client.get_data('/threads/{}'.format(thread.public_id))
+
+    # Threads without a summary fall back to looking at their messages.
+    db.session.query(Thread).filter(Thread.id == thread.id). \
+        update({'summary': None})
+    db.session.commit()
+    from_messages = api_client.get_data('/threads/{}'.format(thread.public_id))
+
+    assert from_summary == from_messages
+    assert from_summary['starred'] is True
+    assert from_summary['message_ids'] == [message.public_id,
+                                           thread.messages[1].public_id]
+    assert sorted(p['email'] for p in from_summary['participants']) == \
+        ['alice@example.com', 'bob@example.com']
+
+
+def test_thread_summary_updated_with_older_message(db, default_account):
+    from inbox.models import Thread
+    namespace_id = default_account.namespace.id
+    thread = add_fake_thread(db.session, namespace_id)
+    newer = add_fake_message(db.session, namespace_id, thread,
+                             from_addr=[('Alice', 'alice@example.com')],
+                             received_date=datetime.datetime(2015, 1, 1))
+    db.session.commit()
+    db.session.expire_all()
+
+    # Only the summary's nested lists and dicts change.
+    older = add_fake_message(db.session, namespace_id, thread,
+                             from_addr=[('Alice', 'alice@example.com')],
+                             to_addr=[('', 'bob@example.com')],
+                             received_date=datetime.datetime(2014, 1, 1))
+    db.session.commit()
+    db.session.expire_all()
+
+    summary = db.session.query(Thread).get(thread.id).summary
+    assert [public_id for _, public_id in summary['messages']] == \
+        [older.public_id, newer.public_id]
+    assert 'bob@example.com' in summary['participants']
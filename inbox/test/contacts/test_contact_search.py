@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import mock
+from pytest import fixture
+
+from inbox.contacts import search
+from inbox.contacts.search import (ContactSearchClient, query_terms,
+                                   rank_contacts, index_namespace,
+                                   delete_namespace_indexes)
+from inbox.models import Contact, PhoneNumber
+from inbox.models.search import ContactSearchTerm
+from inbox.contacts.scores import get_scores_cache
+from inbox.transactions.search import ContactSearchIndexService
+from inbox.util.blockcache import SizedLRU
+
+
+@fixture
+def contacts(db, default_namespace, monkeypatch):
+    monkeypatch.setattr(search, '_scores_cache', SizedLRU(1000))
+
+    def add(uid, name, email_address, phone_number=None):
+        contact = Contact(namespace_id=default_namespace.id, uid=uid,
+                          name=name, email_address=email_address)
+        if phone_number:
+            contact.phone_numbers.append(PhoneNumber(number=phone_number))
+        db.session.add(contact)
+        return contact
+
+    contacts = [
+        add('search1', u'Ben Bitdiddle', 'ben@example.com',
+            '+1 (555) 123-4567'),
+        add('search2', u'Alyssa P. Hacker', 'alyssa@example.com'),
+        add('search3', u'Benoît Dupont', 'bdupont@corp.fr'),
+        add('search4', None, 'benjamin.ortiz@example.org'),
+    ]
+    db.session.commit()
+    return contacts
+
+
+def test_query_terms():
+    assert query_terms(u'Benoît  D.') == [u'benoit', u'd']
+    assert query_terms('ben@exa') == ['ben@exa']
+    assert query_terms('(555) 123-45') == ['55512345']
+
+
+def test_rank_contacts(db, default_namespace, contacts):
+    ben, alyssa, benoit, benjamin = contacts
+    index_namespace(default_namespace.id)
+    namespace_id = default_namespace.id
+
+    # Without scores, exact matches come first, then contacts by name.
+    assert rank_contacts(db.session, namespace_id, 'ben') == \
+        [ben.id, benjamin.id, benoit.id]
+    assert rank_contacts(db.session, namespace_id, 'BEN dup') == [benoit.id]
+    assert rank_contacts(db.session, namespace_id, 'benoit') == [benoit.id]
+    assert rank_contacts(db.session, namespace_id, 'ben@') == [ben.id]
+    assert rank_contacts(db.session, namespace_id, 'ortiz') == [benjamin.id]
+    assert rank_contacts(db.session, namespace_id, '555-123') == [ben.id]
+    assert rank_contacts(db.session, namespace_id, '1234567') == []
+    assert rank_contacts(db.session, namespace_id, 'nobody') == []
+
+    dpcache = get_scores_cache(db.session, namespace_id)
+    dpcache.contact_rankings = {'BDupont@corp.fr': 2.0,
+                                'benjamin.ortiz@example.org': 1.0}
+    db.session.commit()
+    search._scores_cache.discard(namespace_id)
+    assert rank_contacts(db.session, namespace_id, 'ben') == \
+        [benoit.id, benjamin.id, ben.id]
+
+
+def test_rank_contacts_truncated(db, default_namespace, contacts,
+                                 monkeypatch):
+    ben, alyssa, benoit, benjamin = contacts
+    index_namespace(default_namespace.id)
+    namespace_id = default_namespace.id
+    dpcache = get_scores_cache(db.session, namespace_id)
+    dpcache.contact_rankings = {'benjamin.ortiz@example.org': 1.0}
+    db.session.commit()
+
+    # Too many matches: the closest ones and the highest-scored contacts
+    # are ranked.
+    monkeypatch.setattr(search, 'MAX_TERM_MATCHES', 1)
+    monkeypatch.setattr(search, 'TOP_SCORED_CANDIDATES', 1)
+    assert rank_contacts(db.session, namespace_id, 'ben') == \
+        [benjamin.id, ben.id]
+
+
+def test_search_contacts(db, default_namespace, contacts):
+    ben, alyssa, benoit, benjamin = contacts
+    index_namespace(default_namespace.id)
+    client = ContactSearchClient(default_namespace.id)
+
+    assert client.search_contacts(db.session, 'ben') == \
+        [ben, benjamin, benoit]
+    assert client.search_contacts(db.session, 'ben', offset=1, limit=1) == \
+        [benjamin]
+    assert client.search_contacts(db.session, 'hacker') == [alyssa]
+
+    delete_namespace_indexes([default_namespace.id])
+    assert client.search_contacts(db.session, 'ben') == []
+
+
+def test_index_service(db, default_namespace, contacts):
+    ben, alyssa, benoit, benjamin = contacts
+    transactions = [
+        mock.Mock(command='insert', record_id=contact.id,
+                  namespace_id=default_namespace.id)
+        for contact in contacts]
+    transactions.append(mock.Mock(command='delete', record_id=benjamin.id,
+                                  namespace_id=default_namespace.id))
+    ContactSearchIndexService().index(transactions, db.session)
+    db.session.commit()
+
+    assert rank_contacts(db.session, default_namespace.id, 'ben') == \
+        [ben.id, benoit.id]
+    assert db.session.query(ContactSearchTerm).filter(
+        ContactSearchTerm.contact_id == benjamin.id).count() == 0
+
+    # Updates replace the contact's terms.
+    ben.name = u'Benjamin Bitdiddle'
+    db.session.commit()
+    ContactSearchIndexService().index(
+        [mock.Mock(command='update', record_id=ben.id,
+                   namespace_id=default_namespace.id)], db.session)
+    db.session.commit()
+    assert rank_contacts(db.session, default_namespace.id, 'benjamin') == \
+        [ben.id]
+
+
+def test_delete_namespace_indexes(db, default_namespace, contacts):
+    index_namespace(default_namespace.id)
+    terms = db.session.query(ContactSearchTerm).filter(
+        ContactSearchTerm.namespace_id == default_namespace.id)
+    assert terms.count() > 0
+
+    delete_namespace_indexes((default_namespace.id,))
+    db.session.expire_all()
+    assert terms.count() == 0
+    assert rank_contacts(db.session, default_namespace.id, 'ben') == []
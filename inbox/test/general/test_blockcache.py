@@ -0,0 +1,94 @@
+from hashlib import sha256
+
+import gevent
+import pytest
+
+from inbox.util.blockcache import BlockCache, SizedLRU
+
+
+def _blob(contents):
+    return sha256(contents).hexdigest(), contents
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return BlockCache(directory=str(tmpdir), max_disk_bytes=100,
+                      max_memory_bytes=20, max_memory_blob_bytes=10)
+
+
+def test_sized_lru_eviction():
+    lru = SizedLRU(10)
+    assert lru.set('a', 'x', 4) == []
+    assert lru.set('b', 'y', 4) == []
+    # Touch 'a' so that 'b' is the least recently used entry.
+    assert lru.get('a') == 'x'
+    assert lru.set('c', 'z', 4) == ['b']
+    assert 'b' not in lru
+    assert lru.size == 8
+
+
+def test_cache_tiers(cache):
+    h, data = _blob('0123456789abcdef')
+    fills = []
+
+    def fill():
+        fills.append(h)
+        return data
+
+    assert cache.get(h, fill) == data
+    assert cache.get(h, fill) == data
+    assert fills == [h]
+    # Too big for the memory tier, so served from disk.
+    assert cache.stats['misses'] == 1
+    assert cache.stats['disk_hits'] == 1
+
+    small_h, small_data = _blob('tiny')
+    cache.get(small_h, lambda: small_data)
+    cache.get(small_h, lambda: small_data)
+    assert cache.stats['memory_hits'] == 1
+
+
+def test_cache_survives_restart(cache, tmpdir):
+    h, data = _blob('0123456789abcdef')
+    cache.get(h, lambda: data)
+
+    restarted = BlockCache(directory=str(tmpdir), max_disk_bytes=100,
+                           max_memory_bytes=20, max_memory_blob_bytes=10)
+    assert restarted.get(h, lambda: None) == data
+    assert restarted.stats['disk_hits'] == 1
+
+
+def test_disk_eviction(cache):
+    blobs = [_blob(str(i) * 40) for i in range(3)]
+    for h, data in blobs:
+        cache.get(h, lambda: data)
+    assert cache.stats['evictions'] == 1
+    # The oldest blob was evicted and has to be fetched again.
+    h, data = blobs[0]
+    cache.get(h, lambda: data)
+    assert cache.stats['misses'] == 4
+
+
+def test_corrupt_cached_blob_is_refetched(cache, tmpdir):
+    h, data = _blob('0123456789abcdef')
+    cache.get(h, lambda: data)
+    with open(cache._path(h), 'wb') as f:
+        f.write('garbage')
+    assert cache.get(h, lambda: data) == data
+    assert cache.stats['misses'] == 2
+
+
+def test_concurrent_fills_are_coalesced(cache):
+    h, data = _blob('0123456789abcdef')
+    fills = []
+
+    def fill():
+        fills.append(h)
+        gevent.sleep(0.01)
+        return data
+
+    greenlets = [gevent.spawn(cache.get, h, fill) for _ in range(5)]
+    gevent.joinall(greenlets)
+    assert [g.value for g in greenlets] == [data] * 5
+    assert fills == [h]
+    assert cache.stats['coalesced'] == 4
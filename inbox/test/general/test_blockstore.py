@@ -0,0 +1,103 @@
+from hashlib import sha256
+
+import mock
+import pytest
+
+from inbox.util import blockstore
+from inbox.util.blockcache import BlockCache, SizedLRU
+from inbox.util.blockstore import (save_to_blockstore, save_many_to_blockstore,
+                                   get_many_from_blockstore, deferred_saves)
+
+
+class FakeS3ResponseError(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.blobs = {}
+        self.get_key = mock.Mock(side_effect=self.blobs.get)
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name=None):
+        self.bucket = bucket
+        self.key = name
+
+    def set_contents_from_string(self, data):
+        self.bucket.blobs[self.key] = data
+
+    def get_contents_as_string(self):
+        if self.key not in self.bucket.blobs:
+            raise FakeS3ResponseError(404)
+        return self.bucket.blobs[self.key]
+
+
+@pytest.fixture
+def s3(monkeypatch, config):
+    bucket = FakeBucket()
+    connection = mock.Mock()
+    connection.get_bucket.return_value = bucket
+    S3Connection = mock.Mock(return_value=connection)
+    for name, value in (('STORE_MSG_ON_S3', True), ('boto', mock.Mock()),
+                        ('S3Connection', S3Connection), ('Key', FakeKey),
+                        ('S3ResponseError', FakeS3ResponseError),
+                        ('_s3_connection', None), ('_s3_buckets', {}),
+                        ('_known_present', SizedLRU(100)),
+                        ('_block_cache', BlockCache(None, 0, 2 ** 20,
+                                                    2 ** 10))):
+        monkeypatch.setattr(blockstore, name, value, raising=False)
+    for key, value in (('AWS_ACCESS_KEY_ID', 'key'),
+                       ('AWS_SECRET_ACCESS_KEY', 'secret'),
+                       ('TEMP_MESSAGE_STORE_BUCKET_NAME', 'bucket')):
+        monkeypatch.setitem(config, key, value)
+    return mock.Mock(bucket=bucket, S3Connection=S3Connection)
+
+
+def blobs(*datas):
+    return [(sha256(data).hexdigest(), data) for data in datas]
+
+
+def test_save_and_get_many():
+    saved = blobs('first blob', 'second blob', 'third blob')
+    save_many_to_blockstore(saved)
+
+    missing = sha256('never saved').hexdigest()
+    result = get_many_from_blockstore([h for h, _ in saved] + [missing])
+    assert result == dict(saved, **{missing: None})
+
+
+def test_save_and_get_many_on_s3(s3):
+    saved = blobs('first blob', 'second blob', 'third blob')
+    save_many_to_blockstore(saved)
+    assert s3.bucket.blobs == dict(saved)
+    # One connection is shared by all requests.
+    assert s3.S3Connection.call_count == 1
+
+    # Blobs known to be stored aren't checked for again.
+    s3.bucket.get_key.reset_mock()
+    save_many_to_blockstore(saved)
+    assert s3.bucket.get_key.call_count == 0
+
+    missing = sha256('never saved').hexdigest()
+    result = get_many_from_blockstore([h for h, _ in saved] + [missing])
+    assert result == dict(saved, **{missing: None})
+    assert s3.S3Connection.call_count == 1
+
+
+def test_deferred_saves(s3):
+    first, second = blobs('first blob', 'second blob')
+    with deferred_saves():
+        save_to_blockstore(*first)
+        with deferred_saves():
+            save_to_blockstore(*second)
+        save_to_blockstore(*first)
+        assert s3.bucket.blobs == {}
+    assert s3.bucket.blobs == dict([first, second])
+
+    with pytest.raises(ValueError):
+        with deferred_saves():
+            save_to_blockstore(*blobs('third blob')[0])
+            raise ValueError
+    assert len(s3.bucket.blobs) == 2
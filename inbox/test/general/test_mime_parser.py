@@ -0,0 +1,82 @@
+from hashlib import sha256
+
+import pytest
+from flanker import mime
+
+from inbox.util import mime_parser
+from inbox.util.mime_parser import (parse_message, find_part, get_manifest,
+                                    InlineParser, ProcessParser,
+                                    MimeParseError)
+
+
+@pytest.fixture
+def raw_message():
+    msg = mime.create.multipart('mixed')
+    msg.append(
+        mime.create.text('plain', 'This is a message with attachments'),
+        mime.create.attachment('image/png', 'filler', 'attached_image.png',
+                               'attachment'),
+        mime.create.attachment('application/pdf', 'more filler',
+                               'attached_file.pdf', 'attachment')
+    )
+    return msg.to_string()
+
+
+@pytest.fixture
+def parsed_sizes(monkeypatch):
+    sizes = []
+
+    class RecordingParser(InlineParser):
+        def parse(self, body_string):
+            sizes.append(len(body_string))
+            return InlineParser.parse(self, body_string)
+
+    monkeypatch.setattr(mime_parser, 'get_parser', RecordingParser)
+    return sizes
+
+
+def test_manifest(raw_message):
+    message_sha256 = sha256(raw_message).hexdigest()
+    parsed = parse_message(raw_message, message_sha256)
+    assert [(part.content_type, part.disposition, part.filename)
+            for part in parsed.manifest] == [
+        ('text/plain', None, None),
+        ('image/png', 'attachment', 'attached_image.png'),
+        ('application/pdf', 'attachment', 'attached_file.pdf')]
+    assert get_manifest(message_sha256) == parsed.manifest
+
+    for part, data in parsed.parts[1:]:
+        assert part.data_sha256 == sha256(data).hexdigest()
+        # Each part can be parsed on its own from its slice of the message.
+        part_string = raw_message[part.start:part.end + 1]
+        assert parse_message(part_string).parts[0][1] == data
+
+
+def test_find_part(raw_message, parsed_sizes):
+    # The message's boundary is random, so it has no stored manifest yet.
+    data_sha256 = sha256('more filler').hexdigest()
+    assert find_part(raw_message, data_sha256) == 'more filler'
+    assert parsed_sizes == [len(raw_message)]
+    # The manifest is stored by the first lookup and used by the next, which
+    # only parses the part's slice of the message.
+    assert get_manifest(sha256(raw_message).hexdigest()) is not None
+    assert find_part(raw_message, data_sha256) == 'more filler'
+    assert parsed_sizes[1] < len(raw_message)
+    assert find_part(raw_message, sha256('missing').hexdigest()) is None
+
+
+def test_process_parser(raw_message):
+    parser = ProcessParser(processes=2, timeout=30, memory_limit=2 ** 30)
+    assert parser.parse(raw_message) == InlineParser().parse(raw_message)
+    # The worker is reused for the next message.
+    assert len(parser._idle) == 1
+    assert parser.parse(raw_message) == InlineParser().parse(raw_message)
+    assert len(parser._idle) == 1
+
+
+def test_process_parser_timeout(raw_message):
+    parser = ProcessParser(processes=1, timeout=0, memory_limit=2 ** 30)
+    with pytest.raises(MimeParseError):
+        parser.parse(raw_message)
+    # The worker was killed rather than reused.
+    assert not parser._idle
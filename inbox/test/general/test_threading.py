@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 # flake8: noqa: F401
 import pytest
-from inbox.util.threading import fetch_corresponding_thread
+from sqlalchemy import event
+from inbox.models import Message
+from inbox.util.threading import (fetch_corresponding_thread,
+                                  add_to_threading_index,
+                                  MAX_SUBJECT_MATCHES)
 from inbox.util.misc import cleanup_subject
 from inbox.test.util.base import (add_fake_message, add_fake_thread,
                              add_fake_imapuid)
@@ -77,5 +81,94 @@ def test_self_send(db, default_namespace):
     assert matched_thread is first_thread, "Should match on self-send"
 
 
+def add_indexed_message(db, namespace_id, thread, message_id,
+                        references=(), subject='Invoice'):
+    thread.subject = subject
+    message = add_fake_message(db.session, namespace_id, thread=thread,
+                               subject=subject,
+                               from_addr=[('', 'sender@example.com')],
+                               to_addr=[('', 'someone@example.com')])
+    message.message_id_header = message_id
+    message.references = list(references)
+    add_to_threading_index(db.session, namespace_id, message)
+    db.session.commit()
+    return message
+
+
+def test_threading_by_references(db, default_namespace):
+    namespace_id = default_namespace.id
+    thread = add_fake_thread(db.session, namespace_id)
+    add_indexed_message(db, namespace_id, thread, '<a@example.com>')
+
+    # Replies are threaded by their References/In-Reply-To headers, even if
+    # the subject and participants differ.
+    reply = add_fake_message(db.session, namespace_id, thread=None,
+                             subject='Something else entirely')
+    reply.message_id_header = '<b@example.com>'
+    reply.references = ['<a@example.com>']
+    assert fetch_corresponding_thread(db.session, namespace_id,
+                                      reply) is thread
+
+    # So are messages which arrive before the message they reply to.
+    other_thread = add_fake_thread(db.session, namespace_id)
+    add_indexed_message(db, namespace_id, other_thread, '<d@example.com>',
+                        references=['<c@example.com>'],
+                        subject='Re: Other')
+    parent = add_fake_message(db.session, namespace_id, thread=None,
+                              subject='Other')
+    parent.message_id_header = '<c@example.com>'
+    assert fetch_corresponding_thread(db.session, namespace_id,
+                                      parent) is other_thread
+
+
+def test_threading_cost_is_flat(db, default_namespace):
+    # Benchmark: the number of queries and of messages loaded to thread a
+    # message shouldn't grow with the number of threads with the same
+    # subject.
+    namespace_id = default_namespace.id
+    stats = {'queries': 0, 'messages': 0}
+
+    def count_query(*args):
+        stats['queries'] += 1
+
+    def count_message(*args):
+        stats['messages'] += 1
+
+    def threading_cost(message):
+        stats.update(queries=0, messages=0)
+        fetch_corresponding_thread(db.session, namespace_id, message)
+        return dict(stats)
+
+    engine = db.session.get_bind()
+    event.listen(engine, 'before_cursor_execute', count_query)
+    event.listen(Message, 'load', count_message, propagate=True)
+    try:
+        costs = []
+        for i in range(2):
+            for j in range(5 * MAX_SUBJECT_MATCHES):
+                thread = add_fake_thread(db.session, namespace_id)
+                add_indexed_message(db, namespace_id, thread,
+                                    '<{}-{}@example.com>'.format(i, j))
+            reply = add_fake_message(db.session, namespace_id, thread=None,
+                                     subject='Re: Invoice')
+            reply.references = ['<{}-0@example.com>'.format(i)]
+            unrelated = add_fake_message(
+                db.session, namespace_id, thread=None, subject='Re: Invoice',
+                from_addr=[('', 'a@example.org')],
+                to_addr=[('', 'b@example.org')])
+            db.session.expire_all()
+            costs.append((threading_cost(reply), threading_cost(unrelated)))
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_query)
+        event.remove(Message, 'load', count_message)
+
+    (reply_cost, fallback_cost), (later_reply_cost, later_fallback_cost) = \
+        costs
+    assert reply_cost == later_reply_cost
+    assert reply_cost['messages'] == 0
+    assert fallback_cost == later_fallback_cost
+    assert fallback_cost['messages'] == MAX_SUBJECT_MATCHES
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
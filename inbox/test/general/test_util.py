@@ -1,6 +1,7 @@
 # test_util.py --- test various utility functions.
 import socket
 from inbox.util.url import naked_domain, matching_subdomains
+from inbox.util.itert import chunk_by_size
 
 
 def test_naked_domain():
@@ -54,3 +55,12 @@ def test_matching_subdomains(monkeypatch):
     # Check that if the domains are the same, we're not doing an
     # IP address resolution.
     assert matching_subdomains('nylas.com', 'nylas.com') is True
+
+
+def test_chunk_by_size():
+    sizes = {1: 10, 2: 10, 3: 50, 4: 5, 5: 5, 6: 5}
+    assert list(chunk_by_size([1, 2, 3, 4, 5, 6], sizes.get, 20, 2)) == \
+        [(1, 2), (3,), (4, 5), (6,)]
+    assert list(chunk_by_size([1, 2, 4, 5, 6], sizes.get, 100, 10)) == \
+        [(1, 2, 4, 5, 6)]
+    assert list(chunk_by_size([], sizes.get, 100, 10)) == []
@@ -225,6 +225,58 @@ def test_body(generic_client, constants):
     ]
 
 
+def test_multi_uid_body(generic_client, constants):
+    resps = []
+    for uid in (1764, 1765):
+        constants['uid'] = uid
+        resps.append(('{seq} (UID {uid} MODSEQ ({modseq}) '
+                      'INTERNALDATE "{internaldate}" FLAGS {flags} '
+                      'BODY[] {{{body_size}}}'.format(**constants),
+                      constants['body']))
+        resps.append(')')
+    patch_imap4(generic_client, resps)
+
+    messages = generic_client.uids([1764, 1765])
+    assert [m.uid for m in messages] == [1764, 1765]
+    assert all(m.body == constants['body'] for m in messages)
+
+
+def test_multi_uid_fetch_fallback(monkeypatch, generic_client, constants):
+    fetched = []
+
+    def fetch(items, data, modifiers=None):
+        fetched.append(items)
+        if isinstance(items, list):
+            raise imapclient.IMAPClient.Error('BAD Could not parse command')
+        if items == 1:
+            raise imapclient.IMAPClient.Error(
+                '[UNAVAILABLE] UID FETCH Server error while fetching messages')
+        return {items: {'SEQ': items,
+                        'INTERNALDATE': datetime(2015, 3, 2, 23, 36, 20),
+                        'FLAGS': (),
+                        'BODY[]': constants['body']}}
+
+    monkeypatch.setattr(generic_client.conn, 'fetch', fetch)
+    messages = generic_client.uids([1, 2, 3])
+    # Unavailable UIDs are still skipped individually.
+    assert [m.uid for m in messages] == [2, 3]
+    assert fetched[0] == [1, 2, 3]
+    assert sorted(fetched[1:]) == [1, 2, 3]
+
+    # Once a server rejects a multi-UID fetch we don't retry it.
+    del fetched[:]
+    generic_client.uids([2, 3])
+    assert sorted(fetched) == [2, 3]
+
+
+def test_sizes(generic_client, constants):
+    expected_resp = '{seq} (UID {uid} RFC822.SIZE {size})'.format(**constants)
+    unsolicited_resp = '1198 (UID 1731 MODSEQ (95244) FLAGS (\\Seen))'
+    patch_imap4(generic_client, [expected_resp, unsolicited_resp])
+    uid = constants['uid']
+    assert generic_client.sizes([uid]) == {uid: constants['size']}
+
+
 def test_internaldate(generic_client, constants):
     """ Test that our monkeypatched imaplib works through imapclient """
     dates_to_test = [
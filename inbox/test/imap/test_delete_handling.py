@@ -75,6 +75,31 @@ def test_deleting_from_a_message_with_multiple_uids(db, default_account,
         "The message should have only one imapuid."
 
 
+def test_bulk_expunge_across_chunks(db, default_account, default_namespace,
+                                   thread, folder, monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.common.EXPUNGE_CHUNK_SIZE', 2)
+    messages = []
+    for msg_uid in range(100, 105):
+        message = add_fake_message(db.session, default_namespace.id, thread)
+        add_fake_imapuid(db.session, default_account.id, message, folder,
+                         msg_uid)
+        messages.append(message)
+    # UIDs that are already gone locally are ignored.
+    remove_deleted_uids(default_account.id, folder.id, range(100, 110))
+    db.session.expire_all()
+
+    for message in messages:
+        assert message.imapuids == []
+        assert message.deleted_at is not None
+        latest_message_transaction = db.session.query(Transaction). \
+            filter(Transaction.record_id == message.id,
+                   Transaction.object_type == 'message',
+                   Transaction.namespace_id == default_namespace.id). \
+            order_by(desc(Transaction.id)).first()
+        assert latest_message_transaction.command == 'update'
+
+
 def test_deletion_with_short_ttl(db, default_account, default_namespace,
                                  marked_deleted_message, thread, folder):
     handler = DeleteHandler(account_id=default_account.id,
@@ -1,5 +1,7 @@
 # flake8: noqa: F401, F811
+import socket
 import pytest
+from datetime import timedelta
 from hashlib import sha256
 from gevent.lock import BoundedSemaphore
 from sqlalchemy.orm.exc import ObjectDeletedError
@@ -8,7 +10,12 @@ from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapUid,
                                         ImapFolderInfo)
 from inbox.mailsync.backends.imap.generic import (FolderSyncEngine, UidInvalid,
                                                   MAX_UIDINVALID_RESYNCS)
-from inbox.mailsync.backends.gmail import GmailFolderSyncEngine
+from inbox.mailsync.backends.imap.concurrency import DownloadConcurrency
+from inbox.mailsync.backends.gmail import (GmailFolderSyncEngine,
+                                           DownloadBatchSize,
+                                           DOWNLOAD_LATENCY_TARGET,
+                                           MAX_DOWNLOAD_BYTES)
+from inbox.crispin import GMetadata
 from inbox.mailsync.backends.base import MailsyncDone
 from inbox.test.imap.data import uids, uid_data # noqa
 from inbox.util.testutils import mock_imapclient  # noqa
@@ -71,6 +78,112 @@ def test_initial_sync(db, generic_account, inbox_folder, mock_imapclient):
                                     uid_dict.values()}
 
 
+def test_initial_sync_small_batches(db, generic_account, inbox_folder,
+                                   mock_imapclient, monkeypatch):
+    # Force many batches through a tiny pipeline queue to exercise
+    # backpressure between the download and commit stages.
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.MAX_DOWNLOAD_COUNT', 2)
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.DOWNLOAD_QUEUE_SIZE', 1)
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+
+
+def test_initial_sync_concurrent_downloads(db, generic_account, inbox_folder,
+                                           mock_imapclient, monkeypatch):
+    # Hand out the UIDs one at a time, so that the additional download
+    # connections get some of them.
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.SIZE_FETCH_CHUNK_SIZE', 1)
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    concurrency = DownloadConcurrency(generic_account.id, 'custom')
+    assert concurrency.limit > 1
+    folder_sync_engine.download_concurrency = concurrency
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    assert concurrency.in_use == 0
+
+
+def test_concurrent_downloads_back_off(db, generic_account, inbox_folder,
+                                       mock_imapclient, monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.SIZE_FETCH_CHUNK_SIZE', 1)
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    concurrency = DownloadConcurrency(generic_account.id, 'custom')
+    folder_sync_engine.download_concurrency = concurrency
+
+    # The server only allows one connection.
+    get_connection = folder_sync_engine.conn_pool.get
+    connections = []
+
+    def get_one_connection():
+        connections.append(1)
+        if len(connections) > 1:
+            raise socket.error('Too many connections')
+        return get_connection()
+    monkeypatch.setattr(folder_sync_engine.conn_pool, 'get',
+                        get_one_connection)
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    assert concurrency.limit < concurrency.maximum
+    assert concurrency.in_use == 0
+
+
+def test_download_pipeline_propagates_fetch_errors(db, generic_account,
+                                                   inbox_folder):
+    class FailingCrispinClient(object):
+        def sizes(self, uids):
+            return {uid: 1024 for uid in uids}
+
+        def uids(self, uids):
+            raise ValueError('fetch failed')
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    with pytest.raises(ValueError):
+        folder_sync_engine.pipelined_download_and_commit(
+            FailingCrispinClient(), [22, 23])
+
+
 def test_new_uids_synced_when_polling(db, generic_account, inbox_folder,
                                       mock_imapclient):
     uid_dict = uids.example()
@@ -161,6 +274,45 @@ def test_generic_flags_refresh_expunges_transient_uids(
         transient_uid.id
 
 
+def test_uid_snapshot_kept_up_to_date(db, generic_account, inbox_folder,
+                                      mock_imapclient, monkeypatch):
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+    inbox_folder.imapfolderinfo = ImapFolderInfo(account=generic_account,
+                                                 uidvalidity=1,
+                                                 uidnext=1)
+    db.session.commit()
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+    # Don't sleep at the end of poll_impl before returning.
+    folder_sync_engine.poll_frequency = 0
+    folder_sync_engine.poll_impl()
+
+    def saved_uids():
+        return {uid for uid, in db.session.query(ImapUid.msg_uid).filter(
+            ImapUid.folder_id == inbox_folder.id)}
+
+    # Polling doesn't load the folder's UIDs from the database again.
+    def fail(*args, **kwargs):
+        raise AssertionError('local_uids called')
+    monkeypatch.setattr('inbox.mailsync.backends.imap.common.local_uids',
+                        fail)
+
+    del uid_dict[min(uid_dict)]
+    uid_dict[max(uid_dict) + 1] = uid_data.example()
+    folder_sync_engine.last_slow_refresh = None
+    folder_sync_engine.poll_impl()
+    assert saved_uids() == set(uid_dict)
+    assert folder_sync_engine.uid_snapshot.highest(len(uid_dict)) == \
+        set(uid_dict)
+    assert folder_sync_engine.uid_snapshot.verify()
+
+
 def test_handle_uidinvalid(db, generic_account, inbox_folder, mock_imapclient):
     uid_dict = uids.example()
     mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
@@ -253,6 +405,38 @@ def test_gmail_initial_sync(db, default_account, all_mail_folder,
     assert {u.msg_uid for u in saved_uids} == set(uid_dict)
 
 
+def test_gmail_download_batches(db, default_account, all_mail_folder,
+                                mock_imapclient, monkeypatch):
+    folder_sync_engine = GmailFolderSyncEngine(default_account.id,
+                                               default_account.namespace.id,
+                                               all_mail_folder.name,
+                                               default_account.email_address,
+                                               'gmail',
+                                               BoundedSemaphore(1))
+    batches = []
+    monkeypatch.setattr(folder_sync_engine, 'download_and_commit_uids',
+                        lambda crispin_client, uids, metadata=None:
+                        batches.append(uids))
+    folder_sync_engine.download_batch_size = DownloadBatchSize(maximum=4)
+    metadata = {uid: GMetadata(uid, uid, 1000) for uid in range(1, 21)}
+    # A message bigger than a batch is downloaded on its own.
+    metadata[10] = GMetadata(10, 10, MAX_DOWNLOAD_BYTES + 1)
+    folder_sync_engine.batch_download_uids(None, list(metadata), metadata)
+
+    # Batches grow while they're fast, and UIDs are downloaded newest first.
+    assert batches == [[20], [19, 18], [17, 16, 15, 14], [13, 12, 11],
+                       [10], [9, 8, 7, 6], [5, 4, 3, 2], [1]]
+
+    batch_size = DownloadBatchSize(maximum=4)
+    batch_size.failed()
+    assert batch_size.count == 1
+    batch_size.succeeded(timedelta(seconds=1))
+    batch_size.succeeded(timedelta(seconds=1))
+    assert batch_size.count == 3
+    batch_size.succeeded(DOWNLOAD_LATENCY_TARGET + timedelta(seconds=1))
+    assert batch_size.count == 1
+
+
 def test_gmail_message_deduplication(db, default_account, all_mail_folder,
                                      trash_folder, mock_imapclient):
     uid = 22
@@ -273,11 +457,22 @@ def test_gmail_message_deduplication(db, default_account, all_mail_folder,
         BoundedSemaphore(1))
     all_folder_sync_engine.initial_sync()
 
+    # The message's body isn't downloaded again for the trash folder.
+    fetch = mock_imapclient.fetch
+    body_fetches = []
+
+    def recording_fetch(items, data, modifiers=None):
+        if 'BODY.PEEK[]' in data:
+            body_fetches.append(items)
+        return fetch(items, data, modifiers)
+    mock_imapclient.fetch = recording_fetch
+
     trash_folder_sync_engine = GmailFolderSyncEngine(
         default_account.id, default_account.namespace.id, trash_folder.name,
         default_account.email_address, 'gmail',
         BoundedSemaphore(1))
     trash_folder_sync_engine.initial_sync()
+    assert body_fetches == []
 
     # Check that we have two uids, but just one message.
     assert [(uid,)] == db.session.query(ImapUid.msg_uid).filter(
@@ -76,3 +76,64 @@ def test_truncate_imapuid_extra_flags(db, default_account, message, folder):
                           'United', 'States', 'of', 'America'])
 
     assert len(json.dumps(imapuid.extra_flags)) < 255
+
+
+def test_unchanged_metadata_is_skipped(db, default_account, message, folder,
+                                       imapuid, monkeypatch):
+    new_flags = {
+        imapuid.msg_uid: GmailFlags(('\\Seen',), (u'\\Important', u'foo'),
+                                    None)
+    }
+    update_metadata(default_account.id, folder.id, folder.canonical_name,
+                    new_flags, db.session)
+    assert message.is_read
+
+    updated = []
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.common.update_message_metadata',
+        lambda session, account, message, is_draft: updated.append(message))
+    update_metadata(default_account.id, folder.id, folder.canonical_name,
+                    new_flags, db.session)
+    assert updated == []
+
+    new_flags[imapuid.msg_uid] = GmailFlags((), (u'\\Important', u'foo'),
+                                            None)
+    update_metadata(default_account.id, folder.id, folder.canonical_name,
+                    new_flags, db.session)
+    assert updated == [message]
+
+
+def test_metadata_changes_applied_in_chunks(db, default_account, folder,
+                                            monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.common.METADATA_CHUNK_SIZE', 2)
+    messages = {}
+    for msg_uid in range(1, 6):
+        thread = add_fake_thread(db.session, default_account.namespace.id)
+        messages[msg_uid] = add_fake_message(
+            db.session, default_account.namespace.id, thread)
+        add_fake_imapuid(db.session, default_account.id, messages[msg_uid],
+                         folder, msg_uid)
+
+    new_flags = {msg_uid: GmailFlags(('\\Seen',), (u'\\Important', u'foo'),
+                                     None)
+                 for msg_uid in messages}
+    new_flags[3] = GmailFlags(('\\Flagged',), (u'foo',), None)
+    update_metadata(default_account.id, folder.id, folder.canonical_name,
+                    new_flags, db.session)
+    for msg_uid, message in messages.items():
+        assert message.is_read == (msg_uid != 3)
+        assert message.is_starred == (msg_uid == 3)
+        assert 'foo' in {c.display_name for c in message.categories}
+        assert ('important' in {c.name for c in message.categories}) == \
+            (msg_uid != 3)
+
+    new_flags = {msg_uid: GmailFlags((), (u'\\Important',), None)
+                 for msg_uid in messages}
+    update_metadata(default_account.id, folder.id, folder.canonical_name,
+                    new_flags, db.session)
+    for message in messages.values():
+        assert not message.is_read
+        assert not message.is_starred
+        assert 'foo' not in {c.display_name for c in message.categories}
+        assert 'important' in {c.name for c in message.categories}
@@ -0,0 +1,40 @@
+import mock
+from pytest import fixture
+
+from inbox.scheduling.queue import QueuePopulator
+from inbox.test.util.base import add_generic_imap_account
+
+
+@fixture
+def populator(redis_client, monkeypatch):
+    monkeypatch.setattr('inbox.scheduling.queue.StrictRedis',
+                        lambda *args, **kwargs: redis_client)
+    return QueuePopulator('testzone')
+
+
+def test_account_changes_update_queue(db, populator):
+    account = add_generic_imap_account(db.session,
+                                       email_address='queued@example.com')
+    populator.process_account_events()
+    assert account.id in populator.queue_client.all()
+
+    populator.queue_client.redis.hset(populator.queue_client._hash,
+                                      account.id, 'host:0')
+    populator.queue_client.unassign = mock.Mock()
+    account.disable_sync('account deleted')
+    db.session.commit()
+    populator.process_account_events()
+    populator.queue_client.unassign.assert_called_once_with(account.id,
+                                                            'host:0')
+
+
+def test_reconcile_queues_missed_accounts(db, populator):
+    account = add_generic_imap_account(db.session,
+                                       email_address='missed@example.com')
+    # Drop the account's event.
+    populator.event_queue.receive_event(timeout=None)
+    populator.process_account_events()
+    assert account.id not in populator.queue_client.all()
+
+    populator.reconcile()
+    assert account.id in populator.queue_client.all()
@@ -147,6 +147,27 @@ def test_external_sync_disabling(monkeypatch, db):
     assert s.syncing_accounts == {other_account.id}
 
 
+def test_accounts_started_and_stopped_on_events(db, default_account):
+    purge_other_accounts(default_account)
+    s = patched_sync_service(db)
+    default_account.desired_sync_host = s.process_identifier
+    default_account.sync_host = None
+    db.session.commit()
+
+    s.poll_account(default_account.id)
+    assert s.start_sync.call_count == 1
+    assert default_account.sync_host == s.process_identifier
+    s.poll_account(default_account.id)
+    assert s.start_sync.call_count == 1
+
+    default_account.desired_sync_host = 'otherhost:0'
+    db.session.commit()
+    s.poll_account(default_account.id)
+    assert s.syncing_accounts == set()
+    db.session.expire_all()
+    assert default_account.sync_host is None
+
+
 def test_http_frontend(db, default_account, monkeypatch):
     s = patched_sync_service(db)
     s.poll({'queue_name': 'foo'})
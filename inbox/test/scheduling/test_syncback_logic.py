@@ -1,12 +1,15 @@
 import random
 
+import mock
 import pytest
 import gevent
+from gevent.lock import BoundedSemaphore
 
 from inbox.ignition import engine_manager
 from inbox.models.session import session_scope, session_scope_by_shard_id
 from inbox.models.action_log import ActionLog, schedule_action
-from inbox.transactions.actions import SyncbackService
+from inbox.transactions.actions import SyncbackService, SyncbackTask
+from inbox.transactions.syncback_queue import SyncbackQueue, PRIORITY_LANE
 
 from inbox.test.util.base import add_generic_imap_account
 
@@ -177,3 +180,117 @@ def test_actions_for_invalid_accounts_are_skipped(purge_accounts_and_actions,
             ActionLog.namespace_id == another_namespace_id)
         assert q.filter(ActionLog.status == 'pending').count() == 0
         assert q.filter(ActionLog.status == 'successful').count() == another_count
+
+
+class FakeRecord(object):
+    __tablename__ = 'message'
+
+    def __init__(self, id_):
+        self.id = id_
+
+
+def test_syncback_queue_is_fair():
+    queue = SyncbackQueue()
+
+    def task(account_id, num_actions):
+        return mock.Mock(account_id=account_id,
+                         action_log_ids=range(num_actions), cost=num_actions)
+
+    # An account which has had batches of 10 actions synced back waits for
+    # others to catch up.
+    queue.put(task(1, 10))
+    queue.put(task(2, 1))
+    assert queue.get().account_id == 1
+    queue.put(task(1, 10))
+    queue.put(task(3, 1))
+    assert [queue.get().account_id for _ in range(3)] == [2, 3, 1]
+
+    # Interactive actions come first.
+    queue.put(task(1, 10))
+    queue.put(task(2, 1), PRIORITY_LANE)
+    assert queue.depths() == {1: 10, 2: 1}
+    assert queue.get().account_id == 2
+    assert queue.get().account_id == 1
+    assert queue.empty()
+
+
+def test_interactive_actions_overtake_bulk_actions(purge_accounts_and_actions,
+                                                   patched_task):
+    with session_scope_by_shard_id(0) as db_session:
+        account = add_generic_imap_account(
+            db_session, email_address='bulk@test.com')
+        account_id = account.id
+        namespace_id = account.namespace.id
+        for id_ in range(1, 21):
+            schedule_action('change_labels', FakeRecord(id_), namespace_id,
+                            db_session, added_labels=['a'],
+                            removed_labels=[])
+        # Can't overtake the change of labels of the same message.
+        schedule_action('mark_unread', FakeRecord(100), namespace_id,
+                        db_session, unread=True)
+        schedule_action('mark_unread', FakeRecord(5), namespace_id,
+                        db_session, unread=True)
+        db_session.commit()
+        actions = db_session.query(ActionLog).order_by(ActionLog.id).all()
+        action_ids = [action.id for action in actions]
+
+    service = SyncbackService(
+        syncback_id=0, process_number=0, total_processes=2, num_workers=2,
+        batch_size=10)
+    service._process_log()
+    assert service.task_queue.qsize() == 1
+    assert service.task_queue.peek().action_log_ids == [action_ids[20]]
+
+    # No more actions are queued for the account until they're done.
+    service._process_log()
+    assert service.task_queue.qsize() == 1
+    stats = service.stats()[account_id]
+    assert stats['pending_actions'] == 22
+    assert stats['queued_actions'] == 1
+
+    task = service.task_queue.get()
+    task.execute()
+    service.notify_worker_finished(task.action_log_ids, task.account_id)
+    service._process_log()
+    # The batch is extended with the following message actions, which are
+    # collapsed into one change of labels and one change of flags.
+    task = service.task_queue.peek()
+    assert [subtask.action_name for subtask in task.tasks] == \
+        ['mark_unread', 'change_labels']
+    assert sorted(task.action_log_ids) == action_ids[:20] + [action_ids[21]]
+
+
+def test_failing_record_does_not_fail_collapsed_action(
+        purge_accounts_and_actions):
+    with session_scope_by_shard_id(0) as db_session:
+        account = add_generic_imap_account(
+            db_session, email_address='collapsed@test.com')
+        account_id = account.id
+        for id_ in range(1, 4):
+            schedule_action('mark_unread', FakeRecord(id_),
+                            account.namespace.id, db_session, unread=True)
+        db_session.commit()
+        actions = db_session.query(ActionLog).order_by(ActionLog.id).all()
+        action_ids = [action.id for action in actions]
+
+    service = SyncbackService(
+        syncback_id=0, process_number=0, total_processes=2, num_workers=2)
+    task = SyncbackTask('mark_unread', BoundedSemaphore(1), action_ids,
+                        [1, 2, 3], account_id, 'generic', service,
+                        retry_interval=0, extra_args={'unread': True})
+    task.crispin_client = mock.Mock()
+    synced = []
+
+    def mark_unread(crispin_client, account_id, message_ids, args):
+        if 2 in message_ids:
+            raise Exception('No such folder')
+        synced.extend(message_ids)
+    task.func = mark_unread
+    task.execute()
+
+    # The other records are synced back one at a time.
+    assert synced == [1, 3]
+    with session_scope_by_shard_id(0) as db_session:
+        actions = db_session.query(ActionLog).order_by(ActionLog.id).all()
+        assert [(action.status, action.retries) for action in actions] == \
+            [('successful', 0), ('pending', 1), ('successful', 0)]
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa: F401, F811
+import mock
+from pytest import fixture
+
+from inbox.models.search import MessageSearchIndex, MessageSearchTerm
+from inbox.search.index import (tokenize, index_messages, index_namespace,
+                                rank_messages)
+from inbox.search.backends.local import LocalSearchClient
+from inbox.transactions.message_search import MessageSearchIndexService
+from inbox.test.util.base import (default_account, add_fake_message,
+                                  add_fake_thread)
+
+
+@fixture
+def messages(db, default_namespace, monkeypatch):
+    monkeypatch.setattr('inbox.search.index._stats_cache', {})
+
+    def add(subject, body, from_addr):
+        thread = add_fake_thread(db.session, default_namespace.id)
+        return add_fake_message(db.session, default_namespace.id, thread,
+                                subject=subject, body=body,
+                                from_addr=[from_addr],
+                                to_addr=[('Bob', 'bob@example.com')])
+
+    return [
+        add(u'Quarterly budget meeting', u'<p>The budget for Q3. Café</p>',
+            ('Alice', 'alice@example.com')),
+        add(u'Lunch?', u'<p>Lunch? We could talk budget too.</p>',
+            ('Carol', 'carol@corp.com')),
+        add(u'Budget, budget, budget', u'<p>budget</p>',
+            ('Alice', 'alice@example.com')),
+        add(u'Meetings', u'<p>Schedule</p>',
+            ('Alice', 'alice@example.com')),
+    ]
+
+
+def test_tokenize():
+    assert tokenize(u'Re: Café déjà-vu at 10am, the_thing!') == \
+        [u'cafe', u'deja', u'vu', u'10am', u'the_thing']
+
+
+def test_rank_messages(db, default_namespace, messages):
+    meeting, lunch, budget, meetings = messages
+    index_namespace(default_namespace.id)
+    namespace_id = default_namespace.id
+
+    assert db.session.query(MessageSearchIndex).filter(
+        MessageSearchIndex.namespace_id == namespace_id).one().backfilled_at
+    # Ranked by how often and where the term occurs.
+    assert rank_messages(db.session, namespace_id, 'budget') == \
+        [budget.id, meeting.id, lunch.id]
+    # All terms must match, the last one as a prefix.
+    assert rank_messages(db.session, namespace_id, 'budget meet') == \
+        [meeting.id]
+    assert rank_messages(db.session, namespace_id, 'budg meeting') == []
+    assert rank_messages(db.session, namespace_id, 'me') == []
+    assert rank_messages(db.session, namespace_id, 'meeting') == \
+        [meeting.id, meetings.id]
+    assert rank_messages(db.session, namespace_id, u'CAFÉ') == [meeting.id]
+    assert rank_messages(db.session, namespace_id, 'carol@corp.com') == \
+        [lunch.id]
+    assert rank_messages(db.session, namespace_id, 'nothing') == []
+
+
+def test_index_service(db, default_namespace, messages):
+    meeting, lunch, budget, meetings = messages
+    transactions = [
+        mock.Mock(command='insert', record_id=message.id,
+                  namespace_id=default_namespace.id)
+        for message in messages]
+    transactions.append(mock.Mock(command='delete', record_id=meetings.id,
+                                  namespace_id=default_namespace.id))
+    MessageSearchIndexService().index(transactions, db.session)
+    db.session.commit()
+
+    assert rank_messages(db.session, default_namespace.id, 'meeting') == \
+        [meeting.id]
+    assert db.session.query(MessageSearchTerm).filter(
+        MessageSearchTerm.message_id == meetings.id).count() == 0
+
+
+def test_local_search_client(db, default_account, messages, monkeypatch):
+    meeting, lunch, budget, meetings = messages
+    namespace_id = default_account.namespace.id
+    client = LocalSearchClient(default_account)
+    client._provider_client = mock.Mock()
+    client._provider_client.search_messages.return_value = []
+
+    # Until the namespace's history is backfilled, queries which don't fill
+    # a page go to the provider.
+    index_messages(db.session, namespace_id, [meeting.id, lunch.id])
+    db.session.commit()
+    assert client.search_messages(db.session, 'budget', limit=1) == \
+        [meeting]
+    assert client.search_messages(db.session, 'budget', limit=10) == []
+    assert client._provider_client.search_messages.called
+
+    index_namespace(namespace_id)
+    db.session.commit()
+    monkeypatch.setattr('inbox.search.index._stats_cache', {})
+    assert client.search_messages(db.session, 'budget', limit=10) == \
+        [budget, meeting, lunch]
+    assert client.search_messages(db.session, 'budget', offset=1,
+                                  limit=1) == [meeting]
+    assert [thread.id for thread in
+            client.search_threads(db.session, 'budget', limit=10)] == \
+        [budget.thread.id, meeting.thread.id, lunch.thread.id]
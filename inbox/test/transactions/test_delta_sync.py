@@ -223,3 +223,18 @@ def test_account_delta_for_different_namespace_id(db):
     txns, _ = format_transactions_after_pointer(namespace, 0, db.session, 10,
                                                 exclude_account=False)
     assert txns
+
+
+def test_deltas_are_cached_across_consumers(api_client, message):
+    from inbox.transactions.delta_sync import delta_cache_stats
+    ts = int(time.time() + 22)
+    cursor = get_cursor(api_client, ts)
+
+    message_id = api_client.get_data('/messages/')[0]['id']
+    api_client.put_data('/messages/{}'.format(message_id), {'unread': False})
+
+    first = api_client.get_data('/delta?cursor={}'.format(cursor))
+    hits = delta_cache_stats['hits']
+    second = api_client.get_data('/delta?cursor={}'.format(cursor))
+    assert second == first
+    assert delta_cache_stats['hits'] - hits == len(first['deltas'])
@@ -0,0 +1,98 @@
+import json
+
+import gevent
+from sqlalchemy import desc
+
+from inbox.models import Transaction
+from inbox.transactions import notify
+from inbox.transactions.notify import (TransactionNotifier,
+                                       TransactionPublisher, notifier)
+
+from inbox.test.util.base import add_fake_message
+
+
+def test_commit_announces_latest_transaction(db, default_namespace, thread):
+    add_fake_message(db.session, default_namespace.id, thread)
+    latest = db.session.query(Transaction.id).filter(
+        Transaction.namespace_id == default_namespace.id). \
+        order_by(desc(Transaction.id)).first()[0]
+    assert notifier.latest_transaction_id(default_namespace.id) == latest
+
+
+def test_waiters_woken_by_notification():
+    n = TransactionNotifier()
+    n.subscribed = True
+
+    # Times out if nothing happens.
+    assert not n.wait(1, 10, 0.01)
+
+    waiter = gevent.spawn(n.wait, 1, 10, 5)
+    gevent.sleep(0)
+    # Notifications for other namespaces don't wake the waiter.
+    n.notify(2, 20)
+    gevent.sleep(0)
+    assert not waiter.ready()
+    n.notify(1, 11)
+    assert waiter.get(timeout=1) is True
+
+    # Already-announced transactions return immediately.
+    assert n.wait(1, 10, 5) is True
+    assert not n.wait(1, 11, 0.01)
+
+
+def test_wait_polls_when_not_subscribed():
+    n = TransactionNotifier()
+    assert n.wait(1, 10, 0.01) is True
+
+
+class FakeRedis(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.published = []
+
+    def publish(self, channel, message):
+        if self.fail:
+            raise Exception('Connection refused')
+        self.published.append(json.loads(message))
+
+
+def _publisher(monkeypatch, config, client):
+    monkeypatch.setitem(config, 'TRANSACTION_NOTIFICATION_REDIS_HOSTNAME',
+                        'localhost')
+    monkeypatch.setattr(notify, '_get_redis_client', lambda **kwargs: client)
+    return TransactionPublisher()
+
+
+def test_publish_does_not_block(monkeypatch, config):
+    client = FakeRedis()
+    publisher = _publisher(monkeypatch, config, client)
+    publisher.publish({1: 10})
+    publisher.publish({1: 12, 2: 20})
+    assert client.published == []
+
+    # Notifications queued in the meantime are published together.
+    gevent.sleep(0)
+    assert client.published == [{'1': 12, '2': 20}]
+    publisher.publish({1: 13})
+    gevent.sleep(0)
+    assert client.published[-1] == {'1': 13}
+
+
+def test_publish_suspended_after_failures(monkeypatch, config):
+    client = FakeRedis(fail=True)
+    publisher = _publisher(monkeypatch, config, client)
+    for i in range(notify.MAX_PUBLISH_FAILURES):
+        assert not publisher.suspended
+        publisher.publish({1: i})
+        gevent.sleep(0)
+    assert publisher.suspended
+
+    client.fail = False
+    publisher.publish({1: 10})
+    gevent.sleep(0)
+    assert client.published == []
+
+    publisher._suspended_until = 0
+    publisher.publish({1: 11})
+    gevent.sleep(0)
+    assert client.published == [{'1': 11}]
@@ -0,0 +1,56 @@
+from collections import namedtuple
+
+from inbox.transactions.syncback_planner import plan_actions
+
+Entry = namedtuple('Entry', ['id', 'action', 'record_id', 'extra_args'])
+
+
+def entries(*actions):
+    return [Entry(id_, action, record_id, extra_args)
+            for id_, (action, record_id, extra_args) in
+            enumerate(actions, start=1)]
+
+
+def test_repeated_actions_are_collapsed():
+    log = entries(*[('mark_unread', 1, {'unread': i % 2 == 0})
+                    for i in range(5)])
+    planned = plan_actions(log)
+    assert len(planned) == 1
+    assert planned[0].extra_args == {'unread': True}
+    assert planned[0].action_log_ids == [1, 2, 3, 4, 5]
+    assert set(planned[0].record_ids) == {1}
+
+    log = entries(('move', 1, {'destination': 'A'}),
+                  ('move', 1, {'destination': 'B'}),
+                  ('move', 2, {'destination': 'C'}),
+                  ('move', 1, {'destination': 'C'}))
+    planned = plan_actions(log)
+    assert len(planned) == 1
+    assert planned[0].extra_args == {'destination': 'C'}
+    assert planned[0].action_log_ids == [1, 2, 4, 3]
+
+
+def test_changes_of_labels_are_collapsed():
+    log = entries(
+        ('change_labels', 1, {'added_labels': ['a', 'b'],
+                              'removed_labels': ['c']}),
+        ('change_labels', 1, {'added_labels': ['c'],
+                              'removed_labels': ['a']}),
+        ('change_labels', 2, {'added_labels': ['b', 'c'],
+                              'removed_labels': ['a']}))
+    planned = plan_actions(log)
+    assert len(planned) == 1
+    assert planned[0].extra_args == {'added_labels': ['b', 'c'],
+                                     'removed_labels': ['a']}
+    assert sorted(planned[0].action_log_ids) == [1, 2, 3]
+
+
+def test_other_actions_are_barriers():
+    log = entries(('move', 1, {'destination': 'A'}),
+                  ('mark_unread', 1, {'unread': True}),
+                  ('delete_folder', 5, {}),
+                  ('move', 1, {'destination': 'B'}))
+    assert [(planned.action, planned.action_log_ids)
+            for planned in plan_actions(log)] == \
+        [('mark_unread', [2]), ('move', [1]), ('delete_folder', [3]),
+         ('move', [4])]
@@ -7,16 +7,19 @@ TODO(emfree):
 talking to the same database backend things could go really badly.
 
 """
-from collections import defaultdict
+import math
+import itertools
+from collections import defaultdict, deque, OrderedDict
 from datetime import datetime
 
 import gevent
 import gevent.event
-from gevent.queue import Queue
-import random
 from gevent.coros import BoundedSemaphore
 import weakref
 
+from sqlalchemy import and_, case, func, select, union_all
+from sqlalchemy.orm import joinedload
+
 from nylas.logging import get_logger
 from nylas.logging.sentry import log_uncaught_errors
 logger = get_logger()
@@ -24,7 +27,7 @@ from inbox.crispin import writable_connection_pool
 from inbox.ignition import engine_manager
 from inbox.util.concurrency import retry_with_logging
 from inbox.models.session import session_scope, session_scope_by_shard_id
-from inbox.models import ActionLog, Event
+from inbox.models import ActionLog, Event, Namespace
 from inbox.util.misc import DummyContextManager
 from inbox.util.stats import statsd_client
 from inbox.actions.base import (can_handle_multiple_records,
@@ -45,6 +48,10 @@ from inbox.actions.base import (can_handle_multiple_records,
                                 delete_sent_email)
 from inbox.events.actions.base import (create_event, delete_event,
                                        update_event)
+from inbox.transactions.syncback_queue import (SyncbackQueue, PRIORITY_LANE,
+                                               DEFAULT_LANE, percentiles)
+from inbox.transactions.syncback_planner import (plan_actions,
+                                                 COALESCIBLE_ACTIONS)
 from inbox.config import config
 
 MAIL_ACTION_FUNCTION_MAP = {
@@ -86,6 +93,28 @@ ACTION_MAX_NR_OF_RETRIES = 20
 NUM_PARALLEL_ACCOUNTS = 500
 INVALID_ACCOUNT_GRACE_PERIOD = 60 * 60 * 2  # 2 hours
 
+# Actions users are waiting to see the effect of, which are synced back in
+# the priority lane.
+INTERACTIVE_ACTIONS = frozenset(['mark_unread', 'mark_starred', 'move'])
+# Bulk actions, which interactive actions on other records can overtake.
+BULK_ACTIONS = frozenset(['change_labels'])
+
+# Pending actions are fetched with UNION ALLs of this many per-namespace
+# queries.
+UNION_CHUNK_SIZE = 200
+
+# The latencies of each account's last this many actions are kept, for
+# monitoring.
+LATENCY_SAMPLES = 200
+
+# A batch of message actions is extended with the account's following
+# message actions, up to this many in all, so that they're collapsed
+# together (see inbox.transactions.syncback_planner).
+MAX_PLANNED_ACTIONS = 1000
+
+# Tasks get the per-task timeout for every this many records they sync back.
+RECORDS_PER_TIMEOUT = 100
+
 
 class SyncbackService(gevent.Greenlet):
     """Asynchronously consumes the action log and executes syncback actions."""
@@ -126,15 +155,23 @@ class SyncbackService(gevent.Greenlet):
         self.num_idle_workers = 0
         self.worker_did_finish = gevent.event.Event()
         self.worker_did_finish.clear()
-        self.task_queue = Queue()
+        self.task_queue = SyncbackQueue()
         self.running_action_ids = set()
+        # Accounts with a task queued or running, which aren't given another
+        # until it's done.
+        self.busy_account_ids = set()
+        self.account_weights = config.get('SYNCBACK_ACCOUNT_WEIGHTS', {})
+        # Shard key -> {account_id: (pending actions, oldest created_at)}
+        self.pending_actions = {}
+        self.action_latencies = defaultdict(
+            lambda: deque(maxlen=LATENCY_SAMPLES))
         gevent.Greenlet.__init__(self)
 
     def _batch_log_entries(self, db_session, log_entries):
-        tasks = []
+        entries = []
         semaphore = None
         account_id = None
-        last_task = None
+        provider = None
         for log_entry in log_entries:
             if log_entry is None:
                 self.log.error('Got no action, skipping')
@@ -177,30 +214,23 @@ class SyncbackService(gevent.Greenlet):
 
             if semaphore is None:
                 semaphore = self.account_semaphores[account_id]
+                provider = namespace.account.verbose_provider
             else:
                 assert semaphore is self.account_semaphores[account_id]
-            task = SyncbackTask(action_name=log_entry.action,
-                                semaphore=semaphore,
-                                action_log_ids=[log_entry.id],
-                                record_ids=[log_entry.record_id],
-                                account_id=account_id,
-                                provider=namespace.account.
-                                verbose_provider,
-                                service=self,
-                                retry_interval=self.retry_interval,
-                                extra_args=log_entry.extra_args)
-            if last_task is None:
-                last_task = task
-            else:
-                merged_task = last_task.try_merge_with(task)
-                if merged_task is None:
-                    tasks.append(last_task)
-                    last_task = task
-                else:
-                    last_task = merged_task
-        if last_task is not None:
-            assert len(tasks) == 0 or last_task != tasks[-1]
-            tasks.append(last_task)
+            entries.append(log_entry)
+
+        # Redundant actions are collapsed, and actions on many records are
+        # synced back together.
+        tasks = [SyncbackTask(action_name=planned.action,
+                              semaphore=semaphore,
+                              action_log_ids=planned.action_log_ids,
+                              record_ids=planned.record_ids,
+                              account_id=account_id,
+                              provider=provider,
+                              service=self,
+                              retry_interval=self.retry_interval,
+                              extra_args=planned.extra_args)
+                 for planned in plan_actions(entries)]
 
         if len(tasks) == 0:
             return None
@@ -215,36 +245,212 @@ class SyncbackService(gevent.Greenlet):
                            task_count=self.task_queue.qsize())
         return SyncbackBatchTask(semaphore, tasks, account_id)
 
+    def _pending_namespaces(self, db_session):
+        """
+        A summary of the pending actions of each namespace on the shard:
+        their number, the id of the first and of the first which isn't a
+        bulk action, and when the oldest was created.
+
+        """
+        # The discriminator filter restricts actions to IMAP. EAS uses a
+        # different system.
+        return db_session.query(
+            ActionLog.namespace_id, Namespace.account_id,
+            func.count(ActionLog.id).label('count'),
+            func.min(ActionLog.id).label('first_id'),
+            func.min(case([(ActionLog.action.notin_(BULK_ACTIONS),
+                            ActionLog.id)])).label('first_nonbulk_id'),
+            func.min(ActionLog.created_at).label('oldest')). \
+            join(Namespace, Namespace.id == ActionLog.namespace_id). \
+            filter(ActionLog.discriminator == 'actionlog',
+                   ActionLog.status == 'pending'). \
+            group_by(ActionLog.namespace_id, Namespace.account_id).all()
+
+    def _first_pending(self, limit, *criteria):
+        """A select of the ids of the first `limit` pending actions which
+        match the criteria."""
+        return select([ActionLog.id]).where(and_(
+            ActionLog.discriminator == 'actionlog',
+            ActionLog.status == 'pending', *criteria)). \
+            order_by(ActionLog.id).limit(limit).alias().select()
+
+    def _load_log_entries(self, db_session, selects):
+        """
+        The ActionLog entries with the ids the selects return, as a
+        namespace_id -> entries dict.
+
+        """
+        ids = []
+        for i in range(0, len(selects), UNION_CHUNK_SIZE):
+            ids.extend(id_ for id_, in db_session.execute(
+                union_all(*selects[i:i + UNION_CHUNK_SIZE])))
+
+        entries = defaultdict(list)
+        for i in range(0, len(ids), 1000):
+            for entry in db_session.query(ActionLog).filter(
+                    ActionLog.id.in_(ids[i:i + 1000])).options(
+                    joinedload(ActionLog.namespace).
+                    joinedload(Namespace.account)):
+                entries[entry.namespace_id].append(entry)
+        for namespace_entries in entries.itervalues():
+            namespace_entries.sort(key=lambda entry: entry.id)
+        return entries
+
+    def _fetch_log_entries(self, db_session, namespaces):
+        """
+        The first batch_size pending actions of each of the namespaces, and
+        if they start with bulk actions, the batch_size following those.
+        Returns a namespace_id -> entries dict.
+
+        """
+        selects = []
+        for ns in namespaces:
+            selects.append(self._first_pending(
+                self.batch_size, ActionLog.namespace_id == ns.namespace_id))
+            if ns.first_nonbulk_id is not None and \
+                    ns.first_nonbulk_id != ns.first_id:
+                selects.append(self._first_pending(
+                    self.batch_size,
+                    ActionLog.namespace_id == ns.namespace_id,
+                    ActionLog.id >= ns.first_nonbulk_id))
+        return self._load_log_entries(db_session, selects)
+
+    def _extend_batches(self, db_session, batches):
+        """
+        Extend full batches of message actions with the namespace's
+        following pending actions, as long as they're in the batch's set of
+        actions and up to MAX_PLANNED_ACTIONS in all, so that they're
+        collapsed together. `batches` is a namespace_id -> (entries,
+        actions) dict; the entries are extended in place.
+
+        """
+        selects = [
+            self._first_pending(MAX_PLANNED_ACTIONS - len(batch),
+                                ActionLog.namespace_id == namespace_id,
+                                ActionLog.id > batch[-1].id)
+            for namespace_id, (batch, _) in batches.iteritems()]
+        if not selects:
+            return
+        following = self._load_log_entries(db_session, selects)
+        for namespace_id, (batch, actions) in batches.iteritems():
+            batch.extend(itertools.takewhile(
+                lambda entry: entry.action in actions,
+                following[namespace_id]))
+
+    def _interactive_runs(self, db_session, namespaces, entries):
+        """
+        For namespaces whose pending actions start with bulk actions, the
+        interactive actions which follow them (up to the next action of
+        another kind) and can safely overtake them, since no earlier bulk
+        action is on the same record.
+
+        """
+        runs = {}
+        for ns in namespaces:
+            if ns.first_nonbulk_id is None or \
+                    ns.first_nonbulk_id == ns.first_id:
+                continue
+            run = []
+            for entry in entries[ns.namespace_id]:
+                if entry.id < ns.first_nonbulk_id:
+                    continue
+                if entry.action not in INTERACTIVE_ACTIONS or \
+                        len(run) >= self.batch_size:
+                    break
+                run.append(entry)
+            if run:
+                runs[ns.namespace_id] = run
+        if not runs:
+            return runs
+
+        record_ids = {entry.record_id for run in runs.itervalues()
+                      for entry in run}
+        first_bulk_ids = {
+            (namespace_id, record_id): first_id
+            for namespace_id, record_id, first_id in db_session.query(
+                ActionLog.namespace_id, ActionLog.record_id,
+                func.min(ActionLog.id)).filter(
+                ActionLog.discriminator == 'actionlog',
+                ActionLog.status == 'pending',
+                ActionLog.action.in_(BULK_ACTIONS),
+                ActionLog.namespace_id.in_(runs),
+                ActionLog.record_id.in_(record_ids)).group_by(
+                ActionLog.namespace_id, ActionLog.record_id)}
+        for namespace_id, run in runs.items():
+            for i, entry in enumerate(run):
+                first_bulk_id = first_bulk_ids.get(
+                    (namespace_id, entry.record_id))
+                if first_bulk_id is not None and first_bulk_id < entry.id:
+                    del run[i:]
+                    break
+            if not run:
+                del runs[namespace_id]
+        return runs
+
     def _process_log(self):
         for key in self.keys:
             with session_scope_by_shard_id(key) as db_session:
+                namespaces = self._pending_namespaces(db_session)
+                self.pending_actions[key] = {
+                    ns.account_id: (ns.count, ns.oldest)
+                    for ns in namespaces}
+
+                # Fetch actions for the accounts which have had the least
+                # of their share of syncback so far, so that a single
+                # account with 100k actions doesn't hog the action log.
+                namespaces = [ns for ns in namespaces if ns.account_id
+                              not in self.busy_account_ids]
+                namespaces.sort(key=lambda ns: (
+                    self.task_queue.finish_tag(ns.account_id), ns.first_id))
+                namespaces = namespaces[:NUM_PARALLEL_ACCOUNTS]
+                if not namespaces:
+                    continue
 
-                # Get the list of namespace ids with pending actions
-                namespace_ids = [ns_id[0] for ns_id in db_session.query(ActionLog.namespace_id).filter(
-                    ActionLog.discriminator == 'actionlog',
-                    ActionLog.status == 'pending').distinct()]
-
-                # Pick NUM_PARALLEL_ACCOUNTS randomly to make sure we're
-                # executing actions equally for each namespace_id --- we
-                # don't want a single account with 100k actions hogging
-                # the action log.
-                namespaces_to_process = []
-                if len(namespace_ids) <= NUM_PARALLEL_ACCOUNTS:
-                    namespaces_to_process = namespace_ids
-                else:
-                    namespaces_to_process = random.sample(namespace_ids,
-                                                          NUM_PARALLEL_ACCOUNTS)
-                for ns_id in namespaces_to_process:
-                    # The discriminator filter restricts actions to IMAP. EAS
-                    # uses a different system.
-                    query = db_session.query(ActionLog).filter(
-                        ActionLog.discriminator == 'actionlog',
-                        ActionLog.status == 'pending',
-                        ActionLog.namespace_id == ns_id).order_by(ActionLog.id).\
-                        limit(self.batch_size)
-                    task = self._batch_log_entries(db_session, query.all())
+                entries = self._fetch_log_entries(db_session, namespaces)
+                runs = self._interactive_runs(db_session, namespaces,
+                                              entries)
+                batches = OrderedDict()
+                for ns in namespaces:
+                    if ns.namespace_id in runs:
+                        batch = runs[ns.namespace_id]
+                    else:
+                        batch = entries[ns.namespace_id][:self.batch_size]
+                        # Interactive actions at the head of the log are
+                        # synced back on their own, in the priority lane.
+                        interactive = list(itertools.takewhile(
+                            lambda entry: entry.action in INTERACTIVE_ACTIONS,
+                            batch))
+                        if interactive:
+                            batch = interactive
+                    if not batch:
+                        continue
+                    lane = PRIORITY_LANE if all(
+                        entry.action in INTERACTIVE_ACTIONS
+                        for entry in batch) else DEFAULT_LANE
+                    batches[ns.namespace_id] = (batch, lane)
+
+                # Long runs of message actions at the head of the log are
+                # collapsed as a whole.
+                extensible = {}
+                for namespace_id, (batch, lane) in batches.iteritems():
+                    actions = INTERACTIVE_ACTIONS if lane == PRIORITY_LANE \
+                        else COALESCIBLE_ACTIONS
+                    if namespace_id not in runs and \
+                            len(batch) == self.batch_size and \
+                            len(batch) < MAX_PLANNED_ACTIONS and \
+                            all(entry.action in actions for entry in batch):
+                        extensible[namespace_id] = (batch, actions)
+                self._extend_batches(db_session, extensible)
+
+                for batch, lane in batches.itervalues():
+                    task = self._batch_log_entries(db_session, batch)
                     if task is not None:
-                        self.task_queue.put(task)
+                        self.task_queue.put(
+                            task, lane,
+                            self.account_weights.get(str(task.account_id), 1))
+                        self.busy_account_ids.add(task.account_id)
+
+        statsd_client.gauge('syncback.queue_depth', self.task_queue.qsize())
 
     def _restart_workers(self):
         while len(self.workers) < self.num_workers:
@@ -279,11 +485,37 @@ class SyncbackService(gevent.Greenlet):
     def notify_worker_active(self):
         self.num_idle_workers -= 1
 
-    def notify_worker_finished(self, action_ids):
+    def notify_worker_finished(self, action_ids, account_id):
         self.num_idle_workers += 1
         self.worker_did_finish.set()
         for action_id in action_ids:
             self.running_action_ids.remove(action_id)
+        self.busy_account_ids.discard(account_id)
+
+    def record_action_latency(self, account_id, latency):
+        self.action_latencies[account_id].append(latency)
+
+    def stats(self):
+        """
+        The number of pending and queued actions of each account, how long
+        the oldest pending one has waited, and percentiles of the latencies
+        of its recent actions, in seconds. Called from the HTTP frontend's
+        thread, so it only iterates over copies.
+
+        """
+        stats = defaultdict(lambda: {'pending_actions': 0,
+                                     'queued_actions': 0})
+        now = datetime.utcnow()
+        for pending in self.pending_actions.values():
+            for account_id, (count, oldest) in pending.items():
+                stats[account_id]['pending_actions'] = count
+                stats[account_id]['oldest_pending_action_age'] = \
+                    (now - oldest).total_seconds()
+        for account_id, depth in self.task_queue.depths().items():
+            stats[account_id]['queued_actions'] = depth
+        for account_id, latencies in self.action_latencies.items():
+            stats[account_id]['latency'] = percentiles(latencies)
+        return dict(stats)
 
     def __del__(self):
         if self.keep_running:
@@ -317,7 +549,12 @@ class SyncbackBatchTask(object):
         return any([task.uses_crispin_client() for task in self.tasks])
 
     def timeout(self, per_task_timeout):
-        return len(self.tasks) * per_task_timeout
+        return sum(task.timeout(per_task_timeout) for task in self.tasks)
+
+    @property
+    def cost(self):
+        """How much syncback work the batch is, for fair scheduling."""
+        return self.timeout(1)
 
     @property
     def action_log_ids(self):
@@ -356,41 +593,6 @@ class SyncbackTask(object):
         self.retry_interval = retry_interval
         self.crispin_client = None
 
-    def try_merge_with(self, other):
-        if self.func != other.func:
-            return None
-
-        if self.action_name == 'change_labels':
-            my_removed_labels = set(self.extra_args['removed_labels'])
-            other_removed_labels = set(other.extra_args['removed_labels'])
-            if my_removed_labels != other_removed_labels:
-                return None
-
-            my_added_labels = set(self.extra_args['added_labels'])
-            other_added_labels = set(other.extra_args['added_labels'])
-            if my_added_labels != other_added_labels:
-                return None
-
-            # If anything seems fishy, conservatively return None.
-            if (self.provider != other.provider or
-                    self.action_log_ids == other.action_log_ids or
-                    self.record_ids == other.record_ids or
-                    self.account_id != other.account_id or
-                    self.action_name != other.action_name):
-                return None
-            return SyncbackTask(
-                self.action_name,
-                self.semaphore,
-                self.action_log_ids + other.action_log_ids,
-                self.record_ids + other.record_ids,
-                self.account_id,
-                self.provider,
-                self.parent_service(),
-                self.retry_interval,
-                self.extra_args
-            )
-        return None
-
     def _log_to_statsd(self, action_log_status, latency=None):
         metric_names = [
             "syncback.overall.{}".format(action_log_status),
@@ -416,38 +618,29 @@ class SyncbackTask(object):
         if len(action_ids_to_process) == 0:
             return
 
+        if len(records_to_process) > 1:
+            # A collapsed action can cover many unrelated records. If it
+            # fails, try each record on its own, so that one bad record (e.g.
+            # a message whose folder has vanished) doesn't fail them all.
+            if self._attempt(records_to_process, action_ids_to_process):
+                return
+            self.log.warning('Multi-record action failed, retrying records '
+                             'one at a time', num_records=len(records_to_process))
+            action_log_record_map = dict(zip(self.action_log_ids, self.record_ids))
+            for record_id in records_to_process:
+                record_action_ids = [action_id for action_id in action_ids_to_process
+                                     if action_log_record_map[action_id] == record_id]
+                # Records which still fail are retried by a later task.
+                if not self._attempt([record_id], record_action_ids):
+                    self._record_failed_attempt(record_action_ids)
+            return
+
         for attempt in range(ACTION_MAX_NR_OF_RETRIES):
             self.log.debug("executing action", attempt=attempt)
-            try:
-                before, after = self._execute_timed_action(records_to_process)
-
-                with session_scope(self.account_id) as db_session:
-                    action_log_entries = db_session.query(ActionLog). \
-                        filter(ActionLog.id.in_(action_ids_to_process))
-
-                    for action_log_entry in action_log_entries:
-                        self._mark_action_as_successful(action_log_entry, before, after, db_session)
-                    return
-            except:
-                log_uncaught_errors(self.log, account_id=self.account_id,
-                                    provider=self.provider)
-                with session_scope(self.account_id) as db_session:
-                    action_log_entries = db_session.query(ActionLog). \
-                        filter(ActionLog.id.in_(action_ids_to_process))
-
-                    marked_as_failed = False
-                    for action_log_entry in action_log_entries:
-                        action_log_entry.retries += 1
-                        if action_log_entry.retries == ACTION_MAX_NR_OF_RETRIES:
-                            marked_as_failed = True
-                            self._mark_action_as_failed(action_log_entry, db_session)
-                        # If we've merged SyncbackTasks then their corresponding
-                        # actions should all fail at the same time.
-                        assert (not marked_as_failed or
-                                action_log_entry.retries == ACTION_MAX_NR_OF_RETRIES)
-                        db_session.commit()
-                    if marked_as_failed:
-                        return
+            if self._attempt(records_to_process, action_ids_to_process):
+                return
+            if self._record_failed_attempt(action_ids_to_process):
+                return
 
             # Wait before retrying
             self.log.info("Syncback task retrying action after sleeping",
@@ -459,8 +652,46 @@ class SyncbackTask(object):
             # time.
             gevent.sleep(self.retry_interval)
 
+    def _attempt(self, records_to_process, action_ids_to_process):
+        """Execute the action once, and mark its log entries as successful
+        if it succeeds. Returns whether it did."""
+        try:
+            before, after = self._execute_timed_action(records_to_process)
+
+            with session_scope(self.account_id) as db_session:
+                action_log_entries = db_session.query(ActionLog). \
+                    filter(ActionLog.id.in_(action_ids_to_process))
+
+                for action_log_entry in action_log_entries:
+                    self._mark_action_as_successful(action_log_entry, before, after, db_session)
+            return True
+        except:
+            log_uncaught_errors(self.log, account_id=self.account_id,
+                                provider=self.provider)
+            return False
+
+    def _record_failed_attempt(self, action_ids_to_process):
+        """Count a failed attempt against the action log entries, marking
+        those out of retries as failed. Returns whether any were."""
+        with session_scope(self.account_id) as db_session:
+            action_log_entries = db_session.query(ActionLog). \
+                filter(ActionLog.id.in_(action_ids_to_process))
+
+            marked_as_failed = False
+            for action_log_entry in action_log_entries:
+                action_log_entry.retries += 1
+                # Collapsed actions may have been retried a different
+                # number of times before; any still pending are
+                # retried by a later task.
+                if action_log_entry.retries >= ACTION_MAX_NR_OF_RETRIES:
+                    marked_as_failed = True
+                    self._mark_action_as_failed(action_log_entry, db_session)
+                db_session.commit()
+            return marked_as_failed
+
     def _get_records_and_actions_to_process(self):
         records_to_process = []
+        seen_record_ids = set()
         action_ids_to_process = []
         action_log_record_map = dict(zip(self.action_log_ids, self.record_ids))
         with session_scope(self.account_id) as db_session:
@@ -471,7 +702,11 @@ class SyncbackTask(object):
                     self.log.info('Skipping SyncbackTask, action is no longer pending')
                     continue
                 action_ids_to_process.append(action_log_entry.id)
-                records_to_process.append(action_log_record_map[action_log_entry.id])
+                record_id = action_log_record_map[action_log_entry.id]
+                # Collapsed actions may share records.
+                if record_id not in seen_record_ids:
+                    seen_record_ids.add(record_id)
+                    records_to_process.append(record_id)
         return records_to_process, action_ids_to_process
 
     def _execute_timed_action(self, records_to_process):
@@ -501,6 +736,7 @@ class SyncbackTask(object):
                       latency=latency,
                       process=self.parent_service().process_number,
                       func_latency=func_latency)
+        self.parent_service().record_action_latency(self.account_id, latency)
         self._log_to_statsd(action_log_entry.status, latency)
 
     def _mark_action_as_failed(self, action_log_entry, db_session):
@@ -529,7 +765,9 @@ class SyncbackTask(object):
         return action_uses_crispin_client(self.action_name)
 
     def timeout(self, per_task_timeout):
-        return per_task_timeout
+        num_records = len(set(self.record_ids))
+        return per_task_timeout * int(
+            math.ceil(float(num_records) / RECORDS_PER_TIMEOUT))
 
     def execute(self):
         with self.semaphore:
@@ -556,4 +794,4 @@ class SyncbackWorker(gevent.Greenlet):
                                account_id=task.account_id)
             finally:
                 self.parent_service().notify_worker_finished(
-                    task.action_log_ids)
+                    task.action_log_ids, task.account_id)
@@ -0,0 +1,149 @@
+import datetime
+import time
+
+from sqlalchemy import asc, or_
+from sqlalchemy.sql import func
+from gevent import Greenlet, sleep
+
+from inbox.ignition import engine_manager
+from inbox.models import Transaction, Namespace, DataProcessingCache
+from inbox.util.stats import statsd_client
+from inbox.models.session import session_scope_by_shard_id
+from inbox.contacts.scores import update_scores, REBUILD_INTERVAL
+
+from nylas.logging import get_logger
+from nylas.logging.sentry import log_uncaught_errors
+
+log = get_logger()
+
+
+class ContactScoresService(Greenlet):
+    """
+    Poll the transaction log for new and updated messages, and add the
+    namespaces' newly sent messages to their stored contact rankings and
+    groups (see inbox.contacts.scores), so that the API only has to read
+    them.
+
+    Only namespaces whose rankings or groups have been requested before
+    have stored scores to update. Since each update picks up every sent
+    message not counted yet, the transaction pointers aren't persisted:
+    the service starts from the latest transactions.
+
+    Stored scores are also rebuilt from scratch every REBUILD_INTERVAL days,
+    including those of namespaces which haven't sent anything since; every
+    `rebuild_check_interval` seconds, the service looks for scores due a
+    rebuild, up to `rebuild_chunk_size` namespaces at a time.
+
+    """
+
+    def __init__(self, poll_interval=30, chunk_size=1000,
+                 rebuild_check_interval=600, rebuild_chunk_size=10):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.rebuild_check_interval = rebuild_check_interval
+        self.rebuild_chunk_size = rebuild_chunk_size
+        self.transaction_pointers = {}
+        self.next_rebuild_checks = {}
+
+        self.log = log.new(component='contact-scores')
+        Greenlet.__init__(self)
+
+    def _set_transaction_pointers(self):
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                self.transaction_pointers[key] = db_session.query(
+                    func.max(Transaction.id)).scalar() or 0
+
+    def _process_transactions(self):
+        shard_should_sleep = []
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                transactions = db_session.query(
+                    Transaction.id, Transaction.namespace_id).filter(
+                    Transaction.id > self.transaction_pointers[key],
+                    Transaction.object_type == 'message',
+                    Transaction.command != 'delete') \
+                    .order_by(asc(Transaction.id)) \
+                    .limit(self.chunk_size).all()
+
+                if transactions:
+                    namespace_ids = {t.namespace_id for t in transactions}
+                    self.update(namespace_ids, db_session)
+                    db_session.commit()
+                    self.transaction_pointers[key] = transactions[-1].id
+
+                rebuilt_all = True
+                if time.time() >= self.next_rebuild_checks.get(key, 0):
+                    rebuilt_all = self.rebuild_stale(db_session)
+                    db_session.commit()
+                    if rebuilt_all:
+                        self.next_rebuild_checks[key] = \
+                            time.time() + self.rebuild_check_interval
+                shard_should_sleep.append(not transactions and rebuilt_all)
+        if all(shard_should_sleep):
+            sleep(self.poll_interval)
+
+    def _run(self):
+        try:
+            self._set_transaction_pointers()
+
+            self.log.info('Starting contact-scores service',
+                          transaction_pointers=self.transaction_pointers)
+
+            while True:
+                statsd_client.incr('contact_scores.heartbeat')
+                self._process_transactions()
+
+        except Exception:
+            log_uncaught_errors(log)
+
+    def update(self, namespace_ids, db_session):
+        """Update the stored scores of those of the namespaces which have
+        any."""
+        dpcaches = db_session.query(DataProcessingCache).filter(
+            DataProcessingCache.namespace_id.in_(namespace_ids),
+            DataProcessingCache.scores_last_message_id.isnot(None))
+        updated = self._update_scores(dpcaches, db_session)
+        if updated:
+            statsd_client.incr('contact_scores.namespaces_updated', updated)
+        self.log.info('contact scores updated', namespaces=updated)
+
+    def rebuild_stale(self, db_session):
+        """Rebuild stored scores which are due a rebuild. Returns whether
+        all of them were."""
+        cutoff = datetime.datetime.now() - \
+            datetime.timedelta(days=REBUILD_INTERVAL)
+        dpcaches = db_session.query(DataProcessingCache).filter(
+            DataProcessingCache.scores_last_message_id.isnot(None),
+            or_(DataProcessingCache.scores_rebuilt_at == None,
+                DataProcessingCache.scores_rebuilt_at < cutoff)) \
+            .order_by(asc(DataProcessingCache.scores_rebuilt_at)) \
+            .limit(self.rebuild_chunk_size).all()
+        rebuilt = self._update_scores(dpcaches, db_session, rebuild=True)
+        if rebuilt:
+            statsd_client.incr('contact_scores.namespaces_rebuilt', rebuilt)
+            self.log.info('contact scores rebuilt', namespaces=rebuilt)
+        return len(dpcaches) < self.rebuild_chunk_size
+
+    def _update_scores(self, dpcaches, db_session, rebuild=False):
+        updated = 0
+        for dpcache in dpcaches:
+            namespace = db_session.query(Namespace).get(dpcache.namespace_id)
+            if namespace is None:
+                continue
+            try:
+                update_scores(db_session, namespace, dpcache, rebuild)
+            except Exception:
+                # Don't let one namespace stop the others from being updated.
+                self.log.error('Error updating contact scores',
+                               namespace_id=dpcache.namespace_id,
+                               exc_info=True)
+                statsd_client.incr('contact_scores.errors')
+                # Discard any partial changes.
+                db_session.expire(dpcache)
+                if rebuild:
+                    # Don't retry until the next rebuild is due.
+                    dpcache.scores_rebuilt_at = datetime.datetime.now()
+                continue
+            updated += 1
+        return updated
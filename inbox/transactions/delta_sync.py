@@ -1,14 +1,18 @@
+import json
 import time
-import gevent
 import collections
 from datetime import datetime
 
 from sqlalchemy import asc, desc, bindparam
 from inbox.api.kellogs import APIEncoder, encode
+from inbox.config import config
 from inbox.models import Transaction, Message, Thread, Account, Namespace
 from inbox.models.session import session_scope
 from inbox.models.util import transaction_objects
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.transactions.notify import notifier
+from inbox.util.blockcache import SizedLRU
+from inbox.util.stats import statsd_client
 
 
 EVENT_NAME_FOR_COMMAND = {
@@ -17,6 +21,27 @@ EVENT_NAME_FOR_COMMAND = {
     'delete': 'delete'
 }
 
+# Recheck the transaction log at least this often (in seconds) while waiting
+# for change notifications, in case a notification was lost.
+NOTIFICATION_FALLBACK_INTERVAL = 60
+
+# Serialized API representations of the objects referenced by recent
+# transactions, keyed by (transaction public id, expand, is_n1). Several clients
+# usually tail the same namespace, and this lets them share the work of
+# loading and encoding each delta. Bounded by the total length of the JSON.
+_encoded_deltas = SizedLRU(config.get('DELTA_CACHE_MAX_BYTES', 64 * 2 ** 20))
+delta_cache_stats = dict(hits=0, misses=0)
+
+
+def _get_cached_delta(key):
+    encoded = _encoded_deltas.get(key)
+    stat = 'hits' if encoded is not None else 'misses'
+    delta_cache_stats[stat] += 1
+    statsd_client.incr('delta_cache.{}'.format(stat))
+    if encoded is None:
+        return None
+    return json.loads(encoded)
+
 
 def get_transaction_cursor_near_timestamp(namespace_id, timestamp, db_session):
     """
@@ -132,6 +157,7 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
     if include_types is not None and 'metadata' in include_types:
         include_types.remove('metadata')
 
+    encoder = APIEncoder(namespace.public_id, expand=expand, is_n1=is_n1)
     last_trx = _get_last_trx_id_for_namespace(namespace.id, db_session)
     if last_trx == pointer:
         return ([], pointer)
@@ -170,13 +196,24 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
             # one (which is what we want).
             latest_trxs = {(trx.record_id, trx.command): trx for trx in
                            sorted(trxs, key=lambda t: t.id)}.values()
-            # Load all referenced not-deleted objects.
+            # Reuse representations already encoded for other clients.
+            cached = {}
+            for trx in latest_trxs:
+                if trx.command != 'delete':
+                    repr_ = _get_cached_delta(
+                        (trx.public_id, expand, is_n1))
+                    if repr_ is not None:
+                        cached[trx.id] = repr_
+            # Load all other referenced not-deleted objects.
             ids_to_query = [trx.record_id for trx in latest_trxs
-                            if trx.command != 'delete']
+                            if trx.command != 'delete' and
+                            trx.id not in cached]
 
             object_cls = transaction_objects()[obj_type]
 
-            if object_cls == Account:
+            if not ids_to_query:
+                objects = {}
+            elif object_cls == Account:
                 # The base query for Account queries the /Namespace/ table
                 # since the API-returned "`account`" is a `namespace`
                 # under-the-hood.
@@ -209,13 +246,19 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
                     'id': trx.object_public_id,
                     'cursor': trx.public_id
                 }
-                if trx.command != 'delete':
+                if trx.id in cached:
+                    delta['attributes'] = cached[trx.id]
+                elif trx.command != 'delete':
                     obj = objects.get(trx.record_id)
                     if obj is None:
                         continue
                     repr_ = encode(
                         obj, namespace_public_id=namespace.public_id,
                         expand=expand, is_n1=is_n1)
+                    encoded = encoder.cereal(repr_)
+                    _encoded_deltas.set(
+                        (trx.public_id, expand, is_n1), encoded,
+                        len(encoded))
                     delta['attributes'] = repr_
 
                 results.append((trx.id, delta))
@@ -232,20 +275,41 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
             pointer = transactions[-1].id
 
 
+def wait_for_transactions(namespace_id, after_id, poll_interval, deadline):
+    """
+    Wait until the namespace may have transactions newer than `after_id`, or
+    until the `deadline` timestamp. Yields every `poll_interval` seconds that
+    pass without changes, so that callers can send keep-alives.
+
+    """
+    waited = 0
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        if notifier.wait(namespace_id, after_id,
+                         min(poll_interval, remaining)):
+            return
+        waited += poll_interval
+        if waited >= NOTIFICATION_FALLBACK_INTERVAL:
+            return
+        yield
+
+
 def streaming_change_generator(namespace, poll_interval, timeout,
                                transaction_pointer, exclude_types=None,
                                include_types=None, exclude_folders=True,
                                exclude_metadata=True, exclude_account=True,
                                expand=False, is_n1=False):
     """
-    Poll the transaction log for the given `namespace_id` until `timeout`
+    Watch the transaction log for the given `namespace_id` until `timeout`
     expires, and yield each time new entries are detected.
     Arguments
     ---------
     namespace_id: int
         Id of the namespace for which to check changes.
     poll_interval: float
-        How often to check for changes.
+        How often to send keep-alives while waiting for changes.
     timeout: float
         How many seconds to allow the connection to remain open.
     transaction_pointer: int, optional
@@ -256,6 +320,9 @@ def streaming_change_generator(namespace, poll_interval, timeout,
     encoder = APIEncoder(is_n1=is_n1)
     start_time = time.time()
     while time.time() - start_time < timeout:
+        # Anything announced before we query the log will be included in the
+        # results, so we only need to wait for later notifications.
+        notified_id = notifier.latest_transaction_id(namespace.id)
         with session_scope(namespace.id) as db_session:
             deltas, new_pointer = format_transactions_after_pointer(
                 namespace, transaction_pointer, db_session, 100,
@@ -268,4 +335,7 @@ def streaming_change_generator(namespace, poll_interval, timeout,
                 yield encoder.cereal(delta) + '\n'
         else:
             yield '\n'
-            gevent.sleep(poll_interval)
+            for _ in wait_for_transactions(
+                    namespace.id, max(transaction_pointer, notified_id),
+                    poll_interval, start_time + timeout):
+                yield '\n'
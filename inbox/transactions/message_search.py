@@ -0,0 +1,137 @@
+from datetime import datetime
+
+from sqlalchemy import asc
+from sqlalchemy.sql import func
+from gevent import Greenlet, sleep
+
+from inbox.ignition import engine_manager
+from inbox.models import Transaction, Message
+from inbox.util.stats import statsd_client
+from inbox.models.session import session_scope_by_shard_id
+from inbox.models.search import MessageSearchIndexCursor
+from inbox.search.index import index_messages, unindex_messages
+
+from nylas.logging import get_logger
+from nylas.logging.sentry import log_uncaught_errors
+
+log = get_logger()
+
+
+class MessageSearchIndexService(Greenlet):
+    """
+    Poll the transaction log for message operations (inserts, updates,
+    deletes) for all namespaces and update their local search indexes
+    accordingly (see inbox.search.index).
+
+    """
+
+    def __init__(self, poll_interval=30, chunk_size=500):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.transaction_pointers = {}
+
+        self.log = log.new(component='message-search-index')
+        Greenlet.__init__(self)
+
+    def _set_transaction_pointers(self):
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                pointer = db_session.query(
+                    MessageSearchIndexCursor).first()
+                if pointer:
+                    self.transaction_pointers[key] = pointer.transaction_id
+                else:
+                    # Never start from 0; if the service hasn't run before
+                    # start from the latest transaction, with the expectation
+                    # that a backfill will be run separately.
+                    self.transaction_pointers[key] = db_session.query(
+                        func.max(Transaction.id)).scalar() or 0
+
+    def _index_transactions(self):
+        shard_should_sleep = []
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                transactions = db_session.query(Transaction).filter(
+                    Transaction.id > self.transaction_pointers[key],
+                    Transaction.object_type.in_(['message', 'draft'])) \
+                    .order_by(asc(Transaction.id)) \
+                    .limit(self.chunk_size).all()
+
+                if transactions:
+                    self.index(transactions, db_session)
+                    oldest_transaction = min(
+                        transactions, key=lambda t: t.created_at)
+                    latency = (datetime.utcnow() -
+                               oldest_transaction.created_at).seconds
+                    statsd_client.timing(
+                        'message_search_index.transactions.latency', latency)
+                    self.update_pointer(transactions[-1].id, key, db_session)
+                    db_session.commit()
+                shard_should_sleep.append(not transactions)
+        if all(shard_should_sleep):
+            sleep(self.poll_interval)
+
+    def _run(self):
+        try:
+            self._set_transaction_pointers()
+
+            self.log.info('Starting message-search-index service',
+                          transaction_pointers=self.transaction_pointers)
+
+            while True:
+                statsd_client.incr('message_search_index.heartbeat')
+                self._index_transactions()
+
+        except Exception:
+            log_uncaught_errors(log)
+
+    def index(self, transactions, db_session):
+        """
+        Index new messages, reindex updated drafts, whose contents can
+        change, and remove deleted messages from the index.
+
+        """
+        deleted = set()
+        changed = {}
+        for txn in transactions:
+            if txn.command == 'delete':
+                deleted.add(txn.record_id)
+                changed.pop(txn.record_id, None)
+            else:
+                changed[txn.record_id] = txn.namespace_id
+                deleted.discard(txn.record_id)
+
+        unindex_messages(db_session, deleted)
+
+        drafts = set()
+        if changed:
+            drafts = {id_ for id_, in db_session.query(Message.id).filter(
+                Message.id.in_(changed), Message.is_draft)}
+        by_namespace = {}
+        for message_id, namespace_id in changed.iteritems():
+            by_namespace.setdefault(namespace_id, []).append(message_id)
+        indexed = 0
+        for namespace_id, message_ids in by_namespace.iteritems():
+            indexed += index_messages(
+                db_session, namespace_id,
+                [id_ for id_ in message_ids if id_ not in drafts])
+            indexed += index_messages(
+                db_session, namespace_id,
+                [id_ for id_ in message_ids if id_ in drafts], reindex=True)
+
+        statsd_client.incr('message_search_index.messages_indexed', indexed)
+        self.log.info('messages indexed', indexed=indexed,
+                      deleted=len(deleted))
+
+    def update_pointer(self, new_pointer, shard_key, db_session):
+        """
+        Persist transaction pointer to support restarts, update
+        self.transaction_pointer.
+
+        """
+        pointer = db_session.query(MessageSearchIndexCursor).first()
+        if pointer is None:
+            pointer = MessageSearchIndexCursor()
+            db_session.add(pointer)
+        pointer.transaction_id = new_pointer
+        self.transaction_pointers[shard_key] = new_pointer
@@ -0,0 +1,227 @@
+"""
+Change notifications for the transaction log.
+
+When a session which created transactions commits, the id of the latest new
+transaction for each affected namespace is published to a Redis pub/sub
+channel (and to waiters in the same process). Delta streaming and longpoll
+requests block on these notifications instead of polling the transaction
+table, so the database is only queried when a namespace actually has new
+transactions.
+
+Publishing happens in a background greenlet, so that committing never blocks
+on Redis. If Redis is unavailable, publishing is suspended for a while
+after a few failures; waiters periodically recheck the log anyway.
+
+If no Redis host is configured, only in-process notifications are delivered
+and waiters fall back to polling.
+
+"""
+import json
+import time
+from collections import defaultdict
+
+import gevent
+from gevent.event import Event
+from gevent.queue import Queue, Full
+from redis import StrictRedis
+
+from inbox.config import config
+from inbox.util.blockcache import SizedLRU
+from nylas.logging import get_logger
+log = get_logger()
+
+CHANNEL = 'transactions'
+SOCKET_CONNECT_TIMEOUT = 5
+SOCKET_TIMEOUT = 5
+RECONNECT_INTERVAL = 5
+# Number of namespaces for which we remember the latest transaction id.
+MAX_TRACKED_NAMESPACES = 100000
+# Socket connect/read timeout when publishing.
+PUBLISH_TIMEOUT = 0.5
+# Number of notifications waiting to be published; more are dropped.
+MAX_PENDING_NOTIFICATIONS = 1000
+# After this many consecutive failures, publishing is suspended for
+# PUBLISH_RETRY_INTERVAL seconds.
+MAX_PUBLISH_FAILURES = 3
+PUBLISH_RETRY_INTERVAL = 30
+
+
+def _get_redis_client(socket_timeout=SOCKET_TIMEOUT,
+                      socket_connect_timeout=SOCKET_CONNECT_TIMEOUT):
+    host = config.get('TRANSACTION_NOTIFICATION_REDIS_HOSTNAME')
+    if host is None:
+        return None
+    return StrictRedis(host=host,
+                       port=config.get('REDIS_PORT', 6379),
+                       db=config.get('TRANSACTION_NOTIFICATION_REDIS_DB', 0),
+                       socket_connect_timeout=socket_connect_timeout,
+                       socket_timeout=socket_timeout)
+
+
+class TransactionNotifier(object):
+    """
+    Tracks the latest transaction id per namespace, as announced by
+    publishers, and lets greenlets wait for a namespace to advance.
+
+    """
+
+    def __init__(self):
+        self._latest = SizedLRU(MAX_TRACKED_NAMESPACES)
+        self._waiters = defaultdict(set)
+        self._listener = None
+        self.subscribed = False
+
+    def latest_transaction_id(self, namespace_id):
+        return self._latest.get(namespace_id) or 0
+
+    def notify(self, namespace_id, transaction_id):
+        if transaction_id > self.latest_transaction_id(namespace_id):
+            self._latest.set(namespace_id, transaction_id, 1)
+        for waiter in self._waiters.pop(namespace_id, ()):
+            waiter.set()
+
+    def wait(self, namespace_id, after_id, timeout):
+        """
+        Block until a transaction newer than `after_id` has been committed
+        for the namespace, or until `timeout` seconds pass.
+
+        Returns True if the caller should check the transaction log: either
+        because there are new transactions, or because we can't receive
+        notifications from other processes and have to poll. Returns False
+        on timeout.
+
+        """
+        self._start_listener()
+        if self.latest_transaction_id(namespace_id) > after_id:
+            return True
+        waiter = Event()
+        self._waiters[namespace_id].add(waiter)
+        try:
+            woken = waiter.wait(timeout)
+        finally:
+            waiters = self._waiters.get(namespace_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[namespace_id]
+        return woken or not self.subscribed
+
+    def _start_listener(self):
+        if self._listener is None and \
+                config.get('TRANSACTION_NOTIFICATION_REDIS_HOSTNAME'):
+            self._listener = gevent.spawn(self._listen)
+
+    def _listen(self):
+        while True:
+            try:
+                # Subscribers sit idle for long periods, so don't time out
+                # socket reads.
+                pubsub = _get_redis_client(socket_timeout=None).pubsub(
+                    ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                self.subscribed = True
+                # We may have missed notifications while disconnected.
+                self._wake_all()
+                for message in pubsub.listen():
+                    for namespace_id, transaction_id in \
+                            json.loads(message['data']).iteritems():
+                        self.notify(int(namespace_id), transaction_id)
+            except Exception:
+                log.error('Error listening for transaction notifications',
+                          exc_info=True)
+            self.subscribed = False
+            self._wake_all()
+            gevent.sleep(RECONNECT_INTERVAL)
+
+    def _wake_all(self):
+        waiters, self._waiters = self._waiters, defaultdict(set)
+        for namespace_waiters in waiters.itervalues():
+            for waiter in namespace_waiters:
+                waiter.set()
+
+
+class TransactionPublisher(object):
+    """
+    Publishes notifications to Redis from a background greenlet.
+
+    Notifications queued while a publish is in progress are coalesced into
+    a single message. If the queue is full, or publishing is suspended
+    after MAX_PUBLISH_FAILURES consecutive failures, notifications are
+    dropped.
+
+    """
+
+    def __init__(self):
+        self._queue = Queue(MAX_PENDING_NOTIFICATIONS)
+        self._publisher = None
+        self._client = None
+        self._failures = 0
+        self._suspended_until = 0
+
+    def publish(self, latest_transaction_ids):
+        if self.suspended:
+            return
+        if self._publisher is None:
+            if not config.get('TRANSACTION_NOTIFICATION_REDIS_HOSTNAME'):
+                return
+            self._publisher = gevent.spawn(self._run)
+        try:
+            self._queue.put_nowait(latest_transaction_ids)
+        except Full:
+            log.warning('Transaction notification queue full, dropping '
+                        'notification')
+
+    @property
+    def suspended(self):
+        return time.time() < self._suspended_until
+
+    def _run(self):
+        while True:
+            latest = dict(self._queue.get())
+            while not self._queue.empty():
+                for namespace_id, transaction_id in \
+                        self._queue.get_nowait().iteritems():
+                    latest[namespace_id] = max(latest.get(namespace_id, 0),
+                                               transaction_id)
+            if not self.suspended:
+                self._publish(latest)
+
+    def _publish(self, latest_transaction_ids):
+        try:
+            if self._client is None:
+                self._client = _get_redis_client(
+                    socket_timeout=PUBLISH_TIMEOUT,
+                    socket_connect_timeout=PUBLISH_TIMEOUT)
+            self._client.publish(CHANNEL, json.dumps(latest_transaction_ids))
+            self._failures = 0
+        except Exception:
+            # Waiters periodically recheck the log anyway, so a lost
+            # notification only delays them.
+            self._failures += 1
+            log.warning('Error publishing transaction notification',
+                        failures=self._failures, exc_info=True)
+            if self._failures >= MAX_PUBLISH_FAILURES:
+                log.error('Suspending transaction notifications',
+                          retry_in=PUBLISH_RETRY_INTERVAL)
+                self._failures = 0
+                self._suspended_until = time.time() + PUBLISH_RETRY_INTERVAL
+
+
+notifier = TransactionNotifier()
+publisher = TransactionPublisher()
+
+
+def publish(latest_transaction_ids):
+    """
+    Announce newly committed transactions. Doesn't block: other processes
+    are notified in the background.
+
+    Parameters
+    ----------
+    latest_transaction_ids: dict
+        Maps namespace ids to the id of their latest new transaction.
+
+    """
+    for namespace_id, transaction_id in latest_transaction_ids.iteritems():
+        notifier.notify(namespace_id, transaction_id)
+    publisher.publish(latest_transaction_ids)
@@ -7,13 +7,14 @@ from sqlalchemy.orm import joinedload
 from gevent import Greenlet, sleep
 
 from inbox.ignition import engine_manager
-from inbox.util.itert import partition
 from inbox.models import Transaction, Contact
 from inbox.util.stats import statsd_client
 from inbox.models.session import session_scope_by_shard_id
 from inbox.models.search import ContactSearchIndexCursor
 from inbox.contacts.search import (get_doc_service, DOC_UPLOAD_CHUNK_SIZE,
-                                   cloudsearch_contact_repr)
+                                   cloudsearch_contact_repr,
+                                   cloudsearch_configured, index_contacts,
+                                   unindex_contacts)
 
 from nylas.logging import get_logger
 from nylas.logging.sentry import log_uncaught_errors
@@ -25,7 +26,9 @@ class ContactSearchIndexService(Greenlet):
     """
     Poll the transaction log for contact operations
     (inserts, updates, deletes) for all namespaces and perform the
-    corresponding CloudSearch index operations.
+    corresponding operations on the local contact index (see
+    inbox.contacts.search), and on the CloudSearch index if it's
+    configured.
 
     """
 
@@ -121,7 +124,7 @@ class ContactSearchIndexService(Greenlet):
 
     def _run(self):
         """
-        Index into CloudSearch the contacts of all namespaces.
+        Index the contacts of all namespaces.
 
         """
         try:
@@ -139,33 +142,43 @@ class ContactSearchIndexService(Greenlet):
 
     def index(self, transactions, db_session):
         """
-        Translate database operations to CloudSearch index operations
-        and perform them.
+        Translate database operations to index operations and perform
+        them. The caller commits.
 
         """
-        docs = []
-        doc_service = get_doc_service()
-        add_txns, delete_txns = partition(
-            lambda trx: trx.command == 'delete', transactions)
-        delete_docs = [{'type': 'delete', 'id': txn.record_id}
-                       for txn in delete_txns]
-        add_record_ids = [txn.record_id for txn in add_txns]
+        delete_ids = set()
+        add_record_ids = set()
+        for txn in transactions:
+            if txn.command == 'delete':
+                delete_ids.add(txn.record_id)
+                add_record_ids.discard(txn.record_id)
+            else:
+                add_record_ids.add(txn.record_id)
+                delete_ids.discard(txn.record_id)
         add_records = db_session.query(Contact).options(
             joinedload("phone_numbers")).filter(
-                Contact.id.in_(add_record_ids))
-        add_docs = [{'type': 'add', 'id': obj.id,
-                     'fields': cloudsearch_contact_repr(obj)}
-                    for obj in add_records]
-        docs = delete_docs + add_docs
-
-        if docs:
-            doc_service.upload_documents(
-                documents=json.dumps(docs),
-                contentType='application/json')
-            self._report_batch_upload()
-
-        self.log.info('docs indexed', adds=len(add_docs),
-                      deletes=len(delete_docs))
+                Contact.id.in_(add_record_ids)).all()
+
+        unindex_contacts(db_session, delete_ids)
+        index_contacts(db_session, add_records)
+
+        if cloudsearch_configured():
+            delete_docs = [{'type': 'delete', 'id': id_}
+                           for id_ in delete_ids]
+            add_docs = [{'type': 'add', 'id': obj.id,
+                         'fields': cloudsearch_contact_repr(obj)}
+                        for obj in add_records]
+            docs = delete_docs + add_docs
+
+            if docs:
+                doc_service = get_doc_service()
+                doc_service.upload_documents(
+                    documents=json.dumps(docs),
+                    contentType='application/json')
+                self._report_batch_upload()
+
+        self.log.info('docs indexed', adds=len(add_records),
+                      deletes=len(delete_ids))
 
     def update_pointer(self, new_pointer, shard_key, db_session):
         """
@@ -0,0 +1,84 @@
+"""
+Planning of syncback: pending actions are collapsed into the fewest remote
+operations with the same final effect.
+
+Message actions (changes of flags, labels and folders) only matter through
+the state they leave each message in, so a run of them is collapsed to the
+final value of each message's flags, labels and folder, however many times
+they were changed, and messages which end up with the same values are synced
+back together, with one command per folder (see inbox.actions.backends).
+Other actions, e.g. creating folders or saving drafts, are planned as they
+are, and message actions aren't collapsed across them.
+
+"""
+import json
+from collections import namedtuple, OrderedDict
+
+COALESCIBLE_ACTIONS = frozenset(['mark_unread', 'mark_starred',
+                                 'change_labels', 'move'])
+
+# The order collapsed actions are synced back in: flags and labels are set
+# before messages are moved, so that they're moved with them.
+_COLLAPSED_ORDER = ('mark_unread', 'mark_starred', 'change_labels', 'move')
+
+# A remote operation: `action` applied to records with the given
+# `extra_args`, which completes the ActionLog entries with the given ids.
+# `record_ids` holds the record of each of them.
+PlannedAction = namedtuple('PlannedAction', ['action', 'extra_args',
+                                             'action_log_ids', 'record_ids'])
+
+
+def plan_actions(log_entries):
+    """
+    The operations which sync back the given ActionLog entries of an
+    account, in the order to perform them.
+
+    """
+    planned = []
+    run = []
+    for entry in log_entries:
+        if entry.action in COALESCIBLE_ACTIONS:
+            run.append(entry)
+            continue
+        planned.extend(_collapse(run))
+        run = []
+        planned.append(PlannedAction(entry.action, entry.extra_args,
+                                     [entry.id], [entry.record_id]))
+    planned.extend(_collapse(run))
+    return planned
+
+
+def _collapse(entries):
+    final_args = OrderedDict()
+    entry_ids = {}
+    for entry in entries:
+        key = (entry.action, entry.record_id)
+        entry_ids.setdefault(key, []).append(entry.id)
+        args = entry.extra_args or {}
+        if entry.action == 'change_labels':
+            # Whether each label ends up added or removed.
+            labels = final_args.setdefault(key, {})
+            for label in args.get('added_labels', []):
+                labels[label] = True
+            for label in args.get('removed_labels', []):
+                labels[label] = False
+        else:
+            final_args[key] = args
+
+    groups = OrderedDict()
+    for (action, record_id), args in final_args.iteritems():
+        if action == 'change_labels':
+            args = {
+                'added_labels': sorted(label for label, added in
+                                       args.iteritems() if added),
+                'removed_labels': sorted(label for label, added in
+                                         args.iteritems() if not added)}
+        group_key = (action, json.dumps(args, sort_keys=True))
+        if group_key not in groups:
+            groups[group_key] = PlannedAction(action, args, [], [])
+        group = groups[group_key]
+        for entry_id in entry_ids[(action, record_id)]:
+            group.action_log_ids.append(entry_id)
+            group.record_ids.append(record_id)
+    return sorted(groups.itervalues(),
+                  key=lambda planned: _COLLAPSED_ORDER.index(planned.action))
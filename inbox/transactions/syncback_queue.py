@@ -0,0 +1,102 @@
+"""
+Queue of syncback tasks, shared fairly between accounts.
+
+Tasks are dispatched in two lanes: the priority lane, for actions users are
+waiting to see the effect of, is always served before the default lane.
+Within each lane, accounts are served by start-time fair queuing: each task
+is tagged with the virtual time at which its account would start being
+served if every account got a share of the workers in proportion to its
+weight, and the task with the earliest tag is dispatched first. The cost of
+a task is the amount of remote work it takes (see SyncbackBatchTask.cost),
+so an account with a large backlog only gets its share of the workers,
+however many actions it has pending.
+
+"""
+import heapq
+import itertools
+from collections import Counter
+
+from gevent.coros import Semaphore
+
+PRIORITY_LANE = 0
+DEFAULT_LANE = 1
+
+# Accounts' finish tags are dropped once they're behind the virtual time
+# (when they're equivalent to not having a tag), whenever there are more
+# than this many.
+MAX_FINISH_TAGS = 10000
+
+
+def percentiles(values, ranks=(50, 90, 99)):
+    """Nearest-rank percentiles of the values, as a {'p<rank>': value}
+    dict."""
+    values = sorted(values)
+    if not values:
+        return {}
+    return {'p{}'.format(rank):
+            values[max(0, int(round(rank / 100.0 * len(values))) - 1)]
+            for rank in ranks}
+
+
+class SyncbackQueue(object):
+    """
+    Queue of syncback tasks (objects with `account_id`, `action_log_ids`
+    and `cost` attributes), with a gevent.queue.Queue-like interface:
+    workers block on get() until a task is put().
+
+    """
+
+    def __init__(self):
+        self._lanes = {PRIORITY_LANE: [], DEFAULT_LANE: []}
+        self._finish_tags = {}
+        self._virtual_time = 0.0
+        self._counter = itertools.count()
+        self._available = Semaphore(0)
+
+    def finish_tag(self, account_id):
+        """The virtual time when the account's queued tasks will have been
+        served: accounts with earlier tags have had less than their share."""
+        return max(self._finish_tags.get(account_id, 0.0), self._virtual_time)
+
+    def put(self, task, lane=DEFAULT_LANE, weight=1):
+        start = self.finish_tag(task.account_id)
+        self._finish_tags[task.account_id] = \
+            start + float(task.cost) / weight
+        heapq.heappush(self._lanes[lane], (start, next(self._counter), task))
+        self._available.release()
+
+    def _next_lane(self):
+        for lane in (PRIORITY_LANE, DEFAULT_LANE):
+            if self._lanes[lane]:
+                return self._lanes[lane]
+        return None
+
+    def get(self):
+        self._available.acquire()
+        start, _, task = heapq.heappop(self._next_lane())
+        self._virtual_time = max(self._virtual_time, start)
+        if len(self._finish_tags) > MAX_FINISH_TAGS:
+            self._finish_tags = {
+                account_id: tag for account_id, tag in
+                self._finish_tags.iteritems() if tag > self._virtual_time}
+        return task
+
+    def peek(self):
+        lane = self._next_lane()
+        if lane is None:
+            return None
+        return lane[0][2]
+
+    def qsize(self):
+        return sum(len(lane) for lane in self._lanes.itervalues())
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def depths(self):
+        """The number of queued actions of each account."""
+        depths = Counter()
+        for lane in self._lanes.values():
+            for _, _, task in list(lane):
+                depths[task.account_id] += len(task.action_log_ids)
+        return depths
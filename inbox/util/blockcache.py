@@ -0,0 +1,253 @@
+"""
+Local cache in front of the S3 blockstore.
+
+Blobs are addressed by their sha256 and never change, so cached copies never
+need to be invalidated, only evicted. There are two tiers:
+
+* an in-process LRU for small blobs, and
+* a size-bounded LRU directory on local disk.
+
+Concurrent misses for the same hash are coalesced, so that a blob requested
+by several greenlets at once is only downloaded once.
+
+"""
+import os
+import errno
+import tempfile
+from collections import OrderedDict
+from cStringIO import StringIO
+from hashlib import sha256
+
+from gevent.event import AsyncResult
+
+from inbox.util.file import mkdirp
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+
+class SizedLRU(object):
+    """
+    An LRU mapping bounded by the total size of its values rather than by the
+    number of entries.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        try:
+            value, size = self._items.pop(key)
+        except KeyError:
+            return None
+        self._items[key] = (value, size)
+        return value
+
+    def set(self, key, value, size):
+        """
+        Add an entry, evicting least recently used entries to make room.
+        Returns the list of evicted keys.
+
+        """
+        self.discard(key)
+        self._items[key] = (value, size)
+        self.size += size
+        evicted = []
+        while self.size > self.max_size and self._items:
+            evicted_key, (_, evicted_size) = self._items.popitem(last=False)
+            self.size -= evicted_size
+            evicted.append(evicted_key)
+        return evicted
+
+    def discard(self, key):
+        if key in self._items:
+            _, size = self._items.pop(key)
+            self.size -= size
+
+
+class BlockCache(object):
+    """
+    Two-tier LRU cache of blockstore blobs, keyed by data_sha256.
+
+    Parameters
+    ----------
+    directory : str or None
+        Where to keep the on-disk tier. If None, only the in-memory tier is
+        used.
+    max_disk_bytes : int
+        Total size of the on-disk tier.
+    max_memory_bytes : int
+        Total size of the in-memory tier.
+    max_memory_blob_bytes : int
+        Only blobs up to this size are kept in memory.
+
+    """
+
+    def __init__(self, directory, max_disk_bytes, max_memory_bytes,
+                 max_memory_blob_bytes):
+        self.directory = directory
+        self.max_memory_blob_bytes = max_memory_blob_bytes
+        self._memory = SizedLRU(max_memory_bytes)
+        self._disk = SizedLRU(max_disk_bytes)
+        self._pending = {}
+        self.stats = dict(memory_hits=0, disk_hits=0, misses=0,
+                          coalesced=0, evictions=0)
+        if self.directory is not None:
+            self._load_disk_index()
+
+    def get(self, data_sha256, fill):
+        """
+        Return the blob for data_sha256, calling `fill()` to fetch it on a
+        cache miss. Greenlets which miss on a hash that is already being
+        fetched wait for that fetch instead of issuing their own.
+
+        """
+        data = self._memory.get(data_sha256)
+        if data is not None:
+            self._incr('memory_hits')
+            return data
+
+        data = self._get_from_disk(data_sha256)
+        if data is not None:
+            self._incr('disk_hits')
+            self._put_in_memory(data_sha256, data)
+            return data
+
+        pending = self._pending.get(data_sha256)
+        if pending is not None:
+            self._incr('coalesced')
+            return pending.get()
+
+        self._incr('misses')
+        result = AsyncResult()
+        self._pending[data_sha256] = result
+        try:
+            data = fill()
+            if data is not None:
+                self.put(data_sha256, data)
+            result.set(data)
+            return data
+        except Exception as exc:
+            result.set_exception(exc)
+            raise
+        finally:
+            del self._pending[data_sha256]
+
+    def open(self, data_sha256):
+        """
+        Return a file-like object for reading a cached blob, or None if the
+        blob isn't cached. Unlike get(), this doesn't read the whole blob into
+        memory if it's cached on disk.
+
+        """
+        data = self._memory.get(data_sha256)
+        if data is not None:
+            self._incr('memory_hits')
+            return StringIO(data)
+        if self.directory is None or data_sha256 not in self._disk:
+            return None
+        try:
+            f = open(self._path(data_sha256), 'rb')
+        except IOError:
+            self._disk.discard(data_sha256)
+            return None
+        self._incr('disk_hits')
+        # Mark as recently used.
+        self._disk.get(data_sha256)
+        return f
+
+    def put(self, data_sha256, data):
+        self._put_in_memory(data_sha256, data)
+        if self.directory is not None:
+            self._put_on_disk(data_sha256, data)
+
+    def _incr(self, stat, count=1):
+        self.stats[stat] += count
+        statsd_client.incr('blockstore_cache.{}'.format(stat), count)
+
+    def _put_in_memory(self, data_sha256, data):
+        if len(data) > self.max_memory_blob_bytes:
+            return
+        evicted = self._memory.set(data_sha256, data, len(data))
+        if evicted:
+            self._incr('evictions', len(evicted))
+
+    def _path(self, data_sha256):
+        return os.path.join(self.directory, data_sha256[:2], data_sha256)
+
+    def _load_disk_index(self):
+        # Pick up blobs cached by previous runs, oldest access first so that
+        # LRU order is approximately preserved across restarts.
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if len(filename) != 64:
+                    # Leftover temporary file from an interrupted write.
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, filename, st.st_size))
+        for _, data_sha256, size in sorted(entries):
+            self._evict_from_disk(self._disk.set(data_sha256, None, size))
+
+    def _get_from_disk(self, data_sha256):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(data_sha256), 'rb') as f:
+                data = f.read()
+        except IOError:
+            self._disk.discard(data_sha256)
+            return None
+        if sha256(data).hexdigest() != data_sha256:
+            log.warning('Discarding corrupt cached blob', sha256=data_sha256)
+            self._disk.discard(data_sha256)
+            self._remove(data_sha256)
+            return None
+        # Mark as recently used.
+        self._evict_from_disk(self._disk.set(data_sha256, None, len(data)))
+        return data
+
+    def _put_on_disk(self, data_sha256, data):
+        if data_sha256 in self._disk:
+            return
+        path = self._path(data_sha256)
+        directory = os.path.dirname(path)
+        try:
+            mkdirp(directory)
+            # Write to a temporary file and rename it into place, so that
+            # readers never see partially written blobs.
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            log.warning('Error writing blob to cache', sha256=data_sha256,
+                        exc_info=True)
+            return
+        self._evict_from_disk(self._disk.set(data_sha256, None, len(data)))
+
+    def _evict_from_disk(self, evicted):
+        for data_sha256 in evicted:
+            self._remove(data_sha256)
+        if evicted:
+            self._incr('evictions', len(evicted))
+
+    def _remove(self, data_sha256):
+        try:
+            os.remove(self._path(data_sha256))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -1,8 +1,14 @@
 import os
 import time
+from contextlib import contextmanager
 from hashlib import sha256
 
+from gevent.local import local
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Pool
+
 from inbox.config import config
+from inbox.util.blockcache import SizedLRU
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 log = get_logger()
@@ -10,10 +16,29 @@ log = get_logger()
 # TODO: store AWS credentials in a better way.
 STORE_MSG_ON_S3 = config.get('STORE_MESSAGES_ON_S3', None)
 
+# Size of the chunks yielded by stream_from_blockstore.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of concurrent S3 requests per process. This also bounds the
+# number of pooled HTTP connections to S3.
+S3_MAX_CONCURRENCY = config.get('S3_MAX_CONCURRENCY', 20)
+
 if STORE_MSG_ON_S3:
     import boto
+    from boto.exception import S3ResponseError
     from boto.s3.connection import S3Connection
     from boto.s3.key import Key
+    from inbox.util.blockcache import BlockCache
+
+    # Blobs are immutable, so we can keep a local copy of everything we fetch
+    # from S3. The on-disk tier is only enabled if a directory is configured.
+    _block_cache = BlockCache(
+        directory=config.get('BLOCKSTORE_CACHE_DIRECTORY'),
+        max_disk_bytes=config.get('BLOCKSTORE_CACHE_MAX_BYTES', 10 * 2 ** 30),
+        max_memory_bytes=config.get('BLOCKSTORE_MEMORY_CACHE_MAX_BYTES',
+                                    64 * 2 ** 20),
+        max_memory_blob_bytes=config.get(
+            'BLOCKSTORE_MEMORY_CACHE_MAX_BLOB_BYTES', 256 * 2 ** 10))
 else:
     from inbox.util.file import mkdirp
 
@@ -25,6 +50,36 @@ else:
         return os.path.join(_data_file_directory(h), h)
 
 
+_s3_semaphore = BoundedSemaphore(S3_MAX_CONCURRENCY)
+_s3_connection = None
+_s3_buckets = {}
+# (bucket name, hash) pairs which we know are already stored in S3, so that
+# saving duplicate blobs (e.g. the same attachment on many messages) doesn't
+# need any request at all.
+_known_present = SizedLRU(config.get('S3_KNOWN_PRESENT_MAX_ENTRIES', 100000))
+# Blobs whose saving is deferred by deferred_saves(), per greenlet.
+_deferred = local()
+
+
+def _get_s3_bucket(bucket_name):
+    global _s3_connection
+    if _s3_connection is None:
+        # Boto pools HTTP connections per S3Connection, so sharing one
+        # connection object per process lets us reuse keep-alive connections
+        # rather than doing a TLS handshake for every blob.
+        _s3_connection = S3Connection(
+            config.get('AWS_ACCESS_KEY_ID'),
+            config.get('AWS_SECRET_ACCESS_KEY'),
+            host=config.get('AWS_HOST', 's3.amazonaws.com'),
+            port=config.get('AWS_PORT'),
+            calling_format=boto.s3.connection.OrdinaryCallingFormat(),
+            is_secure=config.get('AWS_USE_SSL', True))
+    if bucket_name not in _s3_buckets:
+        _s3_buckets[bucket_name] = _s3_connection.get_bucket(bucket_name,
+                                                             validate=False)
+    return _s3_buckets[bucket_name]
+
+
 def save_to_blockstore(data_sha256, data):
     assert data is not None
     assert type(data) is not unicode
@@ -33,6 +88,11 @@ def save_to_blockstore(data_sha256, data):
         log.warning('Not saving 0-length data blob')
         return
 
+    deferred = getattr(_deferred, 'blobs', None)
+    if deferred is not None:
+        deferred[data_sha256] = data
+        return
+
     if STORE_MSG_ON_S3:
         _save_to_s3(data_sha256, data)
     else:
@@ -54,34 +114,81 @@ def _save_to_s3(data_sha256, data):
 def _save_to_s3_bucket(data_sha256, bucket_name, data):
     assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
     assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
-    start = time.time()
 
-    # Boto pools connections at the class level
-    conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
-                        config.get('AWS_SECRET_ACCESS_KEY'),
-                        host=config.get('AWS_HOST', 's3.amazonaws.com'),
-                        port=config.get('AWS_PORT'),
-                        calling_format=boto.s3.connection.OrdinaryCallingFormat(),
-                        is_secure=config.get('AWS_USE_SSL', True))
-    bucket = conn.get_bucket(bucket_name, validate=False)
-
-    # See if it already exists; if so, don't recreate.
-    key = bucket.get_key(data_sha256)
-    if key:
+    if (bucket_name, data_sha256) in _known_present:
+        statsd_client.incr('s3_blockstore.known_present')
         return
 
-    key = Key(bucket)
-    key.key = data_sha256
-    key.set_contents_from_string(data)
+    start = time.time()
+    with _s3_semaphore:
+        bucket = _get_s3_bucket(bucket_name)
+
+        # See if it already exists; if so, don't recreate.
+        if bucket.get_key(data_sha256) is None:
+            key = Key(bucket)
+            key.key = data_sha256
+            key.set_contents_from_string(data)
+    _known_present.set((bucket_name, data_sha256), None, 1)
 
     end = time.time()
     latency_millis = (end - start) * 1000
     statsd_client.timing('s3_blockstore.save_latency', latency_millis)
 
 
+def save_many_to_blockstore(blobs):
+    """
+    Save a list of (data_sha256, data) pairs. When storing on S3, the
+    uploads run concurrently (up to S3_MAX_CONCURRENCY at a time).
+
+    """
+    if STORE_MSG_ON_S3:
+        Pool(S3_MAX_CONCURRENCY).map(lambda b: save_to_blockstore(*b), blobs)
+    else:
+        for data_sha256, data in blobs:
+            save_to_blockstore(data_sha256, data)
+
+
+@contextmanager
+def deferred_saves():
+    """
+    Defer the blockstore saves made by the current greenlet in the block,
+    and make them all at once with save_many_to_blockstore() when it exits,
+    so that e.g. a message and its attachments are uploaded concurrently.
+    Nothing is saved if the block raises. Nested blocks are part of the
+    outermost one.
+
+    """
+    if getattr(_deferred, 'blobs', None) is not None:
+        yield
+        return
+    _deferred.blobs = {}
+    try:
+        yield
+        blobs = _deferred.blobs
+    finally:
+        _deferred.blobs = None
+    save_many_to_blockstore(blobs.items())
+
+
+def get_many_from_blockstore(data_sha256s):
+    """
+    Fetch several blobs, concurrently when storing on S3. Returns a dict
+    mapping each hash to its data (or None if it couldn't be found).
+
+    """
+    data_sha256s = list(data_sha256s)
+    if STORE_MSG_ON_S3:
+        values = Pool(S3_MAX_CONCURRENCY).map(get_from_blockstore,
+                                              data_sha256s)
+    else:
+        values = [get_from_blockstore(h) for h in data_sha256s]
+    return dict(zip(data_sha256s, values))
+
+
 def get_from_blockstore(data_sha256):
     if STORE_MSG_ON_S3:
-        value = _get_from_s3(data_sha256)
+        value = _block_cache.get(data_sha256,
+                                 lambda: _get_from_s3(data_sha256))
     else:
         value = _get_from_disk(data_sha256)
 
@@ -94,6 +201,125 @@ def get_from_blockstore(data_sha256):
         "Returned data doesn't match stored hash!"
     return value
 
+
+def _sidecar_key(data_sha256, name):
+    return '{}.{}'.format(data_sha256, name)
+
+
+def save_sidecar_to_blockstore(data_sha256, name, data):
+    """
+    Save `data` about the blob `data_sha256` (e.g. the MIME manifest of a raw
+    message) next to that blob, as its sidecar `name`. Sidecars are looked up
+    by their blob's hash rather than their own, so they aren't verified on
+    read.
+
+    """
+    save_to_blockstore(_sidecar_key(data_sha256, name), data)
+
+
+def get_sidecar_from_blockstore(data_sha256, name):
+    """
+    The sidecar `name` of the blob `data_sha256`, or None if there isn't one.
+
+    """
+    key = _sidecar_key(data_sha256, name)
+    if STORE_MSG_ON_S3:
+        bucket = _get_s3_bucket(config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'))
+        with _s3_semaphore:
+            try:
+                return Key(bucket, key).get_contents_as_string()
+            except S3ResponseError as e:
+                if e.status != 404:
+                    raise
+                return None
+
+    try:
+        with open(_data_file_path(key), 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def stream_from_blockstore(data_sha256, start=0, stop=None):
+    """
+    Stream a blob (or the byte range [start, stop) of it) from the
+    blockstore, without reading it all into memory.
+
+    Returns None if the blob can't be found; otherwise a generator of chunks
+    of at most STREAM_CHUNK_SIZE bytes. When the whole blob is streamed, its
+    hash is verified incrementally and an error is raised at the end of the
+    stream on mismatch.
+
+    """
+    if not data_sha256:
+        return None
+
+    if STORE_MSG_ON_S3:
+        f = _block_cache.open(data_sha256)
+        if f is not None:
+            f.seek(start)
+        else:
+            f = _open_s3_stream(data_sha256, start, stop)
+    else:
+        f = _open_disk_stream(data_sha256, start)
+
+    if f is None:
+        log.error('No data returned!', sha256=data_sha256)
+        return None
+    verify = start == 0 and stop is None
+    return _stream(f, data_sha256, stop - start if stop is not None else None,
+                   verify)
+
+
+def _stream(f, data_sha256, length, verify):
+    hasher = sha256()
+    try:
+        while length is None or length > 0:
+            read_size = STREAM_CHUNK_SIZE
+            if length is not None:
+                read_size = min(read_size, length)
+                length -= read_size
+            chunk = f.read(read_size)
+            if not chunk:
+                break
+            if verify:
+                hasher.update(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+    assert not verify or data_sha256 == hasher.hexdigest(), \
+        "Returned data doesn't match stored hash!"
+
+
+def _open_disk_stream(data_sha256, start):
+    try:
+        f = open(_data_file_path(data_sha256), 'rb')
+    except IOError:
+        return None
+    f.seek(start)
+    return f
+
+
+def _open_s3_stream(data_sha256, start, stop):
+    bucket = _get_s3_bucket(config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'))
+    key = Key(bucket, data_sha256)
+    headers = {}
+    if start or stop is not None:
+        headers['Range'] = 'bytes={}-{}'.format(
+            start, stop - 1 if stop is not None else '')
+    try:
+        # Only opening the stream is bounded; reading it is paced by the
+        # client.
+        with _s3_semaphore:
+            key.open_read(headers=headers)
+    except S3ResponseError as e:
+        if e.status != 404:
+            raise
+        return None
+    return key
+
+
 def _get_from_s3(data_sha256):
     assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
     assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
@@ -121,17 +347,20 @@ def _get_from_s3_bucket(data_sha256, bucket_name):
     if not data_sha256:
         return None
 
-    conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
-                        config.get('AWS_SECRET_ACCESS_KEY'))
-    bucket = conn.get_bucket(bucket_name, validate=False)
-
-    key = bucket.get_key(data_sha256)
-
-    if not key:
-        log.error('No key with name: {} returned!'.format(data_sha256))
-        return
-
-    return key.get_contents_as_string()
+    with _s3_semaphore:
+        # Fetch the key directly rather than checking for its existence
+        # first, which would cost an extra round trip.
+        key = Key(_get_s3_bucket(bucket_name), data_sha256)
+        try:
+            data = key.get_contents_as_string()
+        except S3ResponseError as e:
+            if e.status != 404:
+                raise
+            log.error('No key with name: {} returned!'.format(data_sha256))
+            return
+
+    _known_present.set((bucket_name, data_sha256), None, 1)
+    return data
 
 
 def _get_from_disk(data_sha256):
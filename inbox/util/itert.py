@@ -15,6 +15,29 @@ def chunk(iterable, size):
         yield group
 
 
+def chunk_by_size(iterable, size_of, max_size, max_count):
+    """ Yield chunks of an iterable, each containing at most max_count items
+        whose sizes (as given by the size_of function) sum to at most
+        max_size.
+
+        Items larger than max_size on their own are yielded as single-item
+        chunks rather than dropped.
+    """
+    group = []
+    group_size = 0
+    for item in iterable:
+        item_size = size_of(item)
+        if group and (group_size + item_size > max_size or
+                      len(group) >= max_count):
+            yield tuple(group)
+            group = []
+            group_size = 0
+        group.append(item)
+        group_size += item_size
+    if group:
+        yield tuple(group)
+
+
 def partition(pred, iterable):
     """ Use a predicate to partition entries into false entries and true
         entries.
@@ -0,0 +1,359 @@
+"""
+Parsing of raw messages, optionally out of process.
+
+Parsing a message with flanker and decoding its parts is CPU-bound, so a large
+or pathological message blocks the gevent hub, and with it every other
+greenlet in the process, for as long as it takes. With MIME_PARSER_PROCESSES
+set, messages are instead parsed by a pool of that many worker processes,
+while the calling greenlet just waits for the result. A worker which takes
+longer than MIME_PARSER_TIMEOUT seconds on a message is killed, and each
+worker's address space is capped at MIME_PARSER_MEMORY_LIMIT bytes; either
+way the message fails to parse with MimeParseError, like any malformed one.
+
+Parsing a message yields a manifest of its parts: their content types,
+dispositions, filenames, Content-Ids, offsets in the raw message and the
+sha256 of their decoded data, which is the hash of their Block. Manifests are
+stored in the blockstore as a JSON sidecar of the raw message, so that
+recovering an attachment whose Block is missing from the blockstore (see
+inbox.models.roles.Blob.data), usually in another process than the one which
+synced the message, only has to parse the one part it needs.
+
+"""
+import sys
+import json
+import struct
+import binascii
+import resource
+import cPickle as pickle
+from collections import namedtuple
+from cStringIO import StringIO
+from hashlib import sha256
+
+from flanker import mime
+from flanker.mime.message.headers import MimeHeaders
+from gevent import subprocess, Timeout
+from gevent.lock import BoundedSemaphore
+
+from inbox.config import config
+from inbox.util.blockstore import (save_sidecar_to_blockstore,
+                                   get_sidecar_from_blockstore)
+from inbox.util.stats import statsd_client
+from nylas.logging import get_logger
+log = get_logger()
+
+# Errors flanker raises on malformed messages and parts.
+PARSE_ERRORS = (mime.DecodingError, AttributeError, RuntimeError, TypeError)
+PART_ERRORS = PARSE_ERRORS + (binascii.Error, UnicodeDecodeError)
+
+# Name of the raw message's blockstore sidecar which holds its manifest.
+MANIFEST_SIDECAR = 'manifest'
+
+
+class MimeParseError(Exception):
+    pass
+
+
+# A leaf MIME part of a message. `start` and `end` are the offsets of the
+# first and last bytes of the part, headers included, in the raw message, and
+# `error` is set instead of `data_sha256` if the part couldn't be decoded.
+ManifestPart = namedtuple('ManifestPart', [
+    'content_type', 'disposition', 'filename', 'content_id', 'start', 'end',
+    'data_sha256', 'error'])
+
+
+class ParsedMessage(object):
+    """
+    The headers and leaf parts of a raw message.
+
+    Attributes
+    ----------
+    headers : flanker.mime.message.headers.MimeHeaders
+        The message's headers.
+    parts : list of (ManifestPart, data) tuples
+        The leaf MIME parts, with their decoded data: unicode for text parts,
+        str otherwise, or None if they couldn't be decoded.
+
+    """
+
+    def __init__(self, headers, parts):
+        self.headers = headers
+        self.parts = parts
+
+    @property
+    def subject(self):
+        return self.headers.get('Subject', '')
+
+    @property
+    def manifest(self):
+        return [part for part, _ in self.parts]
+
+
+def _encode(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8', 'strict')
+    return data
+
+
+def _parse_part(mimepart):
+    # Flanker keeps the span of each part of a message it parsed from a
+    # string in the part's container.
+    container = getattr(mimepart, '_container', None)
+    start = getattr(container, 'start', None)
+    end = getattr(container, 'end', None)
+    try:
+        content_type, _ = mimepart.content_type
+        disposition, _ = mimepart.content_disposition
+        filename = mimepart.detected_file_name or None
+        content_id = mimepart.headers.get('Content-Id')
+        data = mimepart.body
+        data_sha256 = sha256(_encode(data) or '').hexdigest()
+    except PART_ERRORS as e:
+        return ManifestPart(None, None, None, None, start, end, None,
+                            repr(e)), None
+    return ManifestPart(content_type, disposition, filename, content_id,
+                        start, end, data_sha256, None), data
+
+
+def parse_parts(body_string):
+    """
+    Parse the raw message `body_string` into a list of (ManifestPart, data)
+    tuples, one for each of its leaf MIME parts. This is the work the
+    worker processes do.
+
+    """
+    try:
+        parsed = mime.from_string(body_string)
+        parts = []
+        for mimepart in parsed.walk(
+                with_self=parsed.content_type.is_singlepart()):
+            if mimepart.content_type.is_multipart():
+                continue  # TODO should we store relations?
+            parts.append(_parse_part(mimepart))
+        return parts
+    except PARSE_ERRORS as e:
+        raise MimeParseError(repr(e))
+
+
+def _write_frame(f, obj):
+    payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    f.write(struct.pack('!Q', len(payload)))
+    f.write(payload)
+    f.flush()
+
+
+def _read_frame(f):
+    """Returns None if the other end went away."""
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    length, = struct.unpack('!Q', header)
+    payload = f.read(length)
+    if len(payload) < length:
+        return None
+    return pickle.loads(payload)
+
+
+class InlineParser(object):
+    """Parses messages in the calling greenlet."""
+
+    def parse(self, body_string):
+        return parse_parts(body_string)
+
+
+class ProcessParser(object):
+    """
+    Parses messages in a pool of worker processes, started as needed.
+
+    Parameters
+    ----------
+    processes : int
+        Maximum number of workers, and so of messages parsed at once.
+    timeout : float
+        How long a worker may take to parse a message before it's killed.
+    memory_limit : int
+        Address space limit of each worker, in bytes.
+
+    """
+
+    def __init__(self, processes, timeout, memory_limit):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._semaphore = BoundedSemaphore(processes)
+        self._idle = []
+
+    def _limit_memory(self):
+        resource.setrlimit(resource.RLIMIT_AS,
+                           (self.memory_limit, self.memory_limit))
+
+    def _spawn(self):
+        # Not `-m`: the manifests' class has to be importable from here.
+        return subprocess.Popen(
+            [sys.executable, '-c',
+             'from inbox.util.mime_parser import _worker_main; '
+             '_worker_main()'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True,
+            preexec_fn=self._limit_memory)
+
+    def _kill(self, worker):
+        try:
+            worker.kill()
+        except OSError:
+            pass
+        worker.wait()
+
+    def parse(self, body_string):
+        with self._semaphore:
+            worker = self._idle.pop() if self._idle else self._spawn()
+            timeout = Timeout(self.timeout)
+            timeout.start()
+            try:
+                _write_frame(worker.stdin, body_string)
+                response = _read_frame(worker.stdout)
+            except Timeout as e:
+                self._kill(worker)
+                if e is not timeout:
+                    raise
+                log.warning('MIME parser timed out, killed worker',
+                            size=len(body_string))
+                statsd_client.incr('mime_parser.timeouts')
+                raise MimeParseError('Timed out after {}s'.format(
+                    self.timeout))
+            except (IOError, OSError):
+                response = None
+            except BaseException:
+                # E.g. the greenlet was killed mid-message: the worker's
+                # state is unknown.
+                self._kill(worker)
+                raise
+            finally:
+                timeout.cancel()
+
+            if response is None:
+                # Most likely the worker ran out of memory.
+                self._kill(worker)
+                log.warning('MIME parser worker exited',
+                            returncode=worker.returncode,
+                            size=len(body_string))
+                statsd_client.incr('mime_parser.crashes')
+                raise MimeParseError('Parser process exited with {}'.format(
+                    worker.returncode))
+            self._idle.append(worker)
+
+        status, result = response
+        if status == 'error':
+            raise MimeParseError(result)
+        return result
+
+
+_parser = None
+
+
+def get_parser():
+    global _parser
+    if _parser is None:
+        processes = config.get('MIME_PARSER_PROCESSES', 0)
+        if processes:
+            _parser = ProcessParser(
+                processes, config.get('MIME_PARSER_TIMEOUT', 60),
+                config.get('MIME_PARSER_MEMORY_LIMIT', 2 ** 30))
+        else:
+            _parser = InlineParser()
+    return _parser
+
+
+def save_manifest(data_sha256, manifest):
+    try:
+        data = json.dumps(manifest)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        # E.g. a filename which isn't valid UTF-8. Recovering the message's
+        # attachments will just parse all of it.
+        log.warning('Not saving unserializable MIME manifest',
+                    data_sha256=data_sha256, error=e)
+        return
+    save_sidecar_to_blockstore(data_sha256, MANIFEST_SIDECAR, data)
+
+
+def get_manifest(data_sha256):
+    """
+    The stored manifest of the raw message `data_sha256`, as a list of
+    ManifestParts, or None if it has none.
+
+    """
+    data = get_sidecar_from_blockstore(data_sha256, MANIFEST_SIDECAR)
+    if data is None:
+        return None
+    try:
+        return [ManifestPart(*part) for part in json.loads(data)]
+    except (TypeError, ValueError):
+        log.warning('Invalid MIME manifest', data_sha256=data_sha256)
+        return None
+
+
+def parse_message(body_string, data_sha256=None):
+    """
+    Parse a raw message, storing its manifest under `data_sha256` if given.
+
+    Returns a ParsedMessage. Raises MimeParseError if the message can't be
+    parsed at all; parts which can't be decoded are flagged in the manifest
+    instead.
+
+    """
+    try:
+        headers = MimeHeaders.from_stream(StringIO(body_string))
+    except PARSE_ERRORS as e:
+        raise MimeParseError(repr(e))
+    with statsd_client.timer('mime_parser.parse_latency'):
+        parts = get_parser().parse(body_string)
+    parsed = ParsedMessage(headers, parts)
+    if data_sha256 is not None:
+        save_manifest(data_sha256, parsed.manifest)
+    return parsed
+
+
+def find_part(body_string, data_sha256):
+    """
+    The decoded data of the part of the raw message `body_string` whose
+    sha256 is `data_sha256`, or None if there isn't one.
+
+    If the message's manifest is stored, only that part is parsed, from its
+    slice of the raw message. Otherwise the whole message is parsed, and its
+    manifest stored for next time.
+
+    """
+    message_sha256 = sha256(body_string).hexdigest()
+    manifest = get_manifest(message_sha256)
+    if manifest is not None:
+        for part in manifest:
+            if part.data_sha256 != data_sha256 or part.start is None:
+                continue
+            parts = parse_message(
+                body_string[part.start:part.end + 1]).parts
+            if parts and parts[0][1] is not None:
+                data = _encode(parts[0][1])
+                if sha256(data).hexdigest() == data_sha256:
+                    statsd_client.incr('mime_parser.manifest_hits')
+                    return data
+            break
+
+    statsd_client.incr('mime_parser.manifest_misses')
+    for part, data in parse_message(body_string, message_sha256).parts:
+        if part.data_sha256 == data_sha256:
+            return _encode(data) or ''
+    return None
+
+
+def _worker_main():
+    stdin, stdout = sys.stdin, sys.stdout
+    # Keep anything printed while parsing out of the responses.
+    sys.stdout = sys.stderr
+    while True:
+        body_string = _read_frame(stdin)
+        if body_string is None:
+            return
+        try:
+            response = ('ok', parse_parts(body_string))
+        except MimeParseError as e:
+            response = ('error', str(e))
+        except MemoryError:
+            response = ('error', 'Out of memory')
+        _write_frame(stdout, response)
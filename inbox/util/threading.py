@@ -1,16 +1,90 @@
 # -*- coding: utf-8 -*-
-from inbox.models.thread import Thread
+from hashlib import sha256
+
+from inbox.models.thread import Thread, ThreadReference
 from sqlalchemy import desc
 from sqlalchemy.orm import joinedload, load_only
 from inbox.util.misc import cleanup_subject
 
 
 MAX_THREAD_LENGTH = 500
+# How many of the most recent threads with the same subject to consider when
+# a message can't be threaded by its Message-Id and References headers.
+MAX_SUBJECT_MATCHES = 20
+
+
+def message_id_hash(message_id):
+    """
+    Hash a Message-Id (with or without angle brackets) into a signed 64-bit
+    int for the threading index.
+
+    """
+    if isinstance(message_id, unicode):
+        message_id = message_id.encode('utf-8')
+    return int(sha256(message_id.strip().strip('<>')).hexdigest()[:15], 16)
+
+
+def message_id_hashes(message):
+    """
+    Hashes of the message's own Message-Id and of the Message-Ids it
+    references, which include its In-Reply-To.
+
+    """
+    message_ids = list(message.references or [])
+    if message.message_id_header:
+        message_ids.append(message.message_id_header)
+    hashes = []
+    for message_id in message_ids:
+        if not isinstance(message_id, basestring) or \
+                not message_id.strip().strip('<>'):
+            continue
+        hash_ = message_id_hash(message_id)
+        if hash_ not in hashes:
+            hashes.append(hash_)
+    return hashes
 
 
 def fetch_corresponding_thread(db_session, namespace_id, message):
     """fetch a thread matching the corresponding message. Returns None if
        there's no matching thread."""
+    # Like JWZ threading (http://www.jwz.org/doc/threading.html), look for
+    # a thread containing a message this message refers to, or which refers
+    # to this message. The threading index makes this a single lookup,
+    # however big the account is.
+    hashes = message_id_hashes(message)
+    if hashes:
+        reference = db_session.query(ThreadReference.thread_id). \
+            filter(ThreadReference.namespace_id == namespace_id,
+                   ThreadReference.message_id_hash.in_(hashes)). \
+            order_by(desc(ThreadReference.thread_id)).first()
+        if reference is not None:
+            thread = db_session.query(Thread).get(reference.thread_id)
+            if thread is not None:
+                return thread
+
+    return _fetch_thread_by_subject(db_session, namespace_id, message)
+
+
+def add_to_threading_index(db_session, namespace_id, message):
+    """Record the message's Message-Id and references in the threading
+       index, so that messages related to it are put in the same thread."""
+    thread = message.thread
+    if thread is None:
+        return
+    hashes = message_id_hashes(message)
+    if hashes and thread.id is not None:
+        indexed = {hash_ for hash_, in db_session.query(
+            ThreadReference.message_id_hash).filter(
+            ThreadReference.namespace_id == namespace_id,
+            ThreadReference.message_id_hash.in_(hashes),
+            ThreadReference.thread_id == thread.id)}
+        hashes = [hash_ for hash_ in hashes if hash_ not in indexed]
+    for hash_ in hashes:
+        db_session.add(ThreadReference(namespace_id=namespace_id,
+                                       message_id_hash=hash_, thread=thread))
+
+
+def _fetch_thread_by_subject(db_session, namespace_id, message):
     # FIXME: for performance reasons, we make the assumption that a reply
     # to a message always has a similar subject. This is only
     # right 95% of the time.
@@ -19,6 +93,7 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
         filter(Thread.namespace_id == namespace_id,
                Thread._cleaned_subject == clean_subject). \
         order_by(desc(Thread.id)). \
+        limit(MAX_SUBJECT_MATCHES). \
         options(load_only('id', 'discriminator'),
                 joinedload(Thread.messages).load_only(
                     'from_addr', 'to_addr', 'bcc_addr', 'cc_addr'))
@@ -0,0 +1,58 @@
+"""Add RecurringEventOccurrence
+
+Revision ID: 1f7c3d9a5e28
+Revises: 4e1d6a2f8c35
+Create Date: 2026-10-18 23:52:08.174392
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f7c3d9a5e28'
+down_revision = '4e1d6a2f8c35'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    shard_id = int(context.config.get_main_option('shard_id'))
+
+    op.add_column('recurringevent',
+                  sa.Column('occurrences_until', sa.DateTime(),
+                            nullable=True))
+
+    op.create_table('recurringeventoccurrence',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('master_event_id', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('override_id', sa.BigInteger(), nullable=True),
+                    sa.Column('start', sa.DateTime(), nullable=False),
+                    sa.Column('end', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.ForeignKeyConstraint(['master_event_id'],
+                                            [u'recurringevent.id'],
+                                            ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['override_id'],
+                                            [u'recurringeventoverride.id'],
+                                            ondelete='CASCADE'))
+    op.create_index('ix_recurringeventoccurrence_created_at',
+                    'recurringeventoccurrence', ['created_at'], unique=False)
+    op.create_index('ix_recurringeventoccurrence_master_event_id',
+                    'recurringeventoccurrence', ['master_event_id'],
+                    unique=False)
+    op.create_index('ix_recurringeventoccurrence_namespace_id_start',
+                    'recurringeventoccurrence', ['namespace_id', 'start'],
+                    unique=False)
+
+    conn = op.get_bind()
+    increment = (shard_id << 48) + 1
+    conn.execute('ALTER TABLE recurringeventoccurrence AUTO_INCREMENT={}'.
+                 format(increment))
+
+
+def downgrade():
+    op.drop_table('recurringeventoccurrence')
+    op.drop_column('recurringevent', 'occurrences_until')
@@ -0,0 +1,54 @@
+"""Add CategoryCounter
+
+Revision ID: 2f4e8c1a9b37
+Revises: 7c1b2e9d4f60
+Create Date: 2026-10-18 20:04:17.281145
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f4e8c1a9b37'
+down_revision = '7c1b2e9d4f60'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    shard_id = int(context.config.get_main_option('shard_id'))
+    namespace_id_type = sa.Integer() if shard_id == 0 else sa.BigInteger()
+
+    op.create_table('categorycounter',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', namespace_id_type,
+                              nullable=False),
+                    sa.Column('category_id', sa.BigInteger(), nullable=False),
+                    sa.Column('threads', sa.Integer(), nullable=False),
+                    sa.Column('unread_threads', sa.Integer(), nullable=False),
+                    sa.Column('starred_threads', sa.Integer(),
+                              nullable=False),
+                    sa.Column('messages', sa.Integer(), nullable=False),
+                    sa.Column('unread_messages', sa.Integer(),
+                              nullable=False),
+                    sa.Column('starred_messages', sa.Integer(),
+                              nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.ForeignKeyConstraint(['namespace_id'],
+                                            [u'namespace.id'],
+                                            ondelete='CASCADE'),
+                    sa.UniqueConstraint('namespace_id', 'category_id'))
+    op.create_index('ix_categorycounter_created_at', 'categorycounter',
+                    ['created_at'], unique=False)
+    op.create_index('ix_categorycounter_updated_at', 'categorycounter',
+                    ['updated_at'], unique=False)
+
+    conn = op.get_bind()
+    increment = (shard_id << 48) + 1
+    conn.execute('ALTER TABLE categorycounter AUTO_INCREMENT={}'.
+                 format(increment))
+
+
+def downgrade():
+    op.drop_table('categorycounter')
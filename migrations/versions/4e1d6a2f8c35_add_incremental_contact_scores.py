@@ -0,0 +1,48 @@
+"""Keep contact rankings and groups up to date incrementally
+
+Revision ID: 4e1d6a2f8c35
+Revises: 5d3a9e7b2c14
+Create Date: 2026-10-18 22:40:17.306518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e1d6a2f8c35'
+down_revision = '5d3a9e7b2c14'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    op.add_column('dataprocessingcache',
+                  sa.Column('group_cooccurrences', mysql.MEDIUMBLOB(),
+                            nullable=True))
+    op.add_column('dataprocessingcache',
+                  sa.Column('scores_last_message_id', sa.BigInteger(),
+                            nullable=True))
+    op.add_column('dataprocessingcache',
+                  sa.Column('scores_last_message_date', sa.DateTime(),
+                            nullable=True))
+    op.add_column('dataprocessingcache',
+                  sa.Column('scores_rebuilt_at', sa.DateTime(),
+                            nullable=True))
+
+    # Cached rankings and groups are now stored relative to a fixed epoch, so
+    # existing ones are discarded and recomputed when next requested.
+    conn = op.get_bind()
+    conn.execute('UPDATE dataprocessingcache SET contact_rankings=NULL, '
+                 'contact_groups=NULL, contact_rankings_last_updated=NULL, '
+                 'contact_groups_last_updated=NULL')
+
+
+def downgrade():
+    conn = op.get_bind()
+    conn.execute('UPDATE dataprocessingcache SET contact_rankings=NULL, '
+                 'contact_groups=NULL, contact_rankings_last_updated=NULL, '
+                 'contact_groups_last_updated=NULL')
+    op.drop_column('dataprocessingcache', 'scores_rebuilt_at')
+    op.drop_column('dataprocessingcache', 'scores_last_message_date')
+    op.drop_column('dataprocessingcache', 'scores_last_message_id')
+    op.drop_column('dataprocessingcache', 'group_cooccurrences')
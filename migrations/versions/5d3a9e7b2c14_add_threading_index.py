@@ -0,0 +1,46 @@
+"""Add ThreadReference
+
+Revision ID: 5d3a9e7b2c14
+Revises: 2f4e8c1a9b37
+Create Date: 2026-10-18 21:16:52.093514
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d3a9e7b2c14'
+down_revision = '2f4e8c1a9b37'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    shard_id = int(context.config.get_main_option('shard_id'))
+
+    op.create_table('threadreference',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('message_id_hash', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('thread_id', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.ForeignKeyConstraint(['thread_id'], [u'thread.id'],
+                                            ondelete='CASCADE'))
+    op.create_index('ix_threadreference_created_at', 'threadreference',
+                    ['created_at'], unique=False)
+    op.create_index('ix_threadreference_thread_id', 'threadreference',
+                    ['thread_id'], unique=False)
+    op.create_index('ix_threadreference_namespace_id_message_id_hash',
+                    'threadreference', ['namespace_id', 'message_id_hash'],
+                    unique=False)
+
+    conn = op.get_bind()
+    increment = (shard_id << 48) + 1
+    conn.execute('ALTER TABLE threadreference AUTO_INCREMENT={}'.
+                 format(increment))
+
+
+def downgrade():
+    op.drop_table('threadreference')
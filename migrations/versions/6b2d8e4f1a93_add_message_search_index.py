@@ -0,0 +1,108 @@
+"""Add local message search index
+
+Revision ID: 6b2d8e4f1a93
+Revises: 1f7c3d9a5e28
+Create Date: 2026-10-19 01:14:37.520193
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b2d8e4f1a93'
+down_revision = '1f7c3d9a5e28'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    shard_id = int(context.config.get_main_option('shard_id'))
+
+    op.create_table('messagesearchindexcursor',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('transaction_id', sa.BigInteger(),
+                              nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.ForeignKeyConstraint(['transaction_id'],
+                                            [u'transaction.id']))
+    op.create_index('ix_messagesearchindexcursor_created_at',
+                    'messagesearchindexcursor', ['created_at'],
+                    unique=False)
+    op.create_index('ix_messagesearchindexcursor_updated_at',
+                    'messagesearchindexcursor', ['updated_at'],
+                    unique=False)
+    op.create_index('ix_messagesearchindexcursor_deleted_at',
+                    'messagesearchindexcursor', ['deleted_at'],
+                    unique=False)
+    op.create_index('ix_messagesearchindexcursor_transaction_id',
+                    'messagesearchindexcursor', ['transaction_id'],
+                    unique=False)
+
+    op.create_table('messagesearchindex',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('backfilled_at', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('namespace_id'))
+    op.create_index('ix_messagesearchindex_created_at',
+                    'messagesearchindex', ['created_at'], unique=False)
+    op.create_index('ix_messagesearchindex_updated_at',
+                    'messagesearchindex', ['updated_at'], unique=False)
+
+    op.create_table('messagesearchdocument',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('message_id', sa.BigInteger(), nullable=False),
+                    sa.Column('length', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('message_id'),
+                    sa.ForeignKeyConstraint(['message_id'], [u'message.id'],
+                                            ondelete='CASCADE'))
+    op.create_index('ix_messagesearchdocument_created_at',
+                    'messagesearchdocument', ['created_at'], unique=False)
+    op.create_index('ix_messagesearchdocument_namespace_id_length',
+                    'messagesearchdocument', ['namespace_id', 'length'],
+                    unique=False)
+
+    op.create_table('messagesearchterm',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('term', sa.String(length=64,
+                                                collation='utf8mb4_bin'),
+                              nullable=False),
+                    sa.Column('message_id', sa.BigInteger(), nullable=False),
+                    sa.Column('frequency', sa.Integer(), nullable=False),
+                    sa.Column('length', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.ForeignKeyConstraint(['message_id'], [u'message.id'],
+                                            ondelete='CASCADE'))
+    op.create_index('ix_messagesearchterm_created_at',
+                    'messagesearchterm', ['created_at'], unique=False)
+    op.create_index('ix_messagesearchterm_message_id',
+                    'messagesearchterm', ['message_id'], unique=False)
+    op.create_index('ix_messagesearchterm_namespace_id_term_message_id',
+                    'messagesearchterm',
+                    ['namespace_id', 'term', 'message_id'], unique=False)
+
+    conn = op.get_bind()
+    increment = (shard_id << 48) + 1
+    for table in ('messagesearchindexcursor', 'messagesearchindex',
+                  'messagesearchdocument', 'messagesearchterm'):
+        conn.execute('ALTER TABLE {} AUTO_INCREMENT={}'.format(table,
+                                                               increment))
+
+
+def downgrade():
+    op.drop_table('messagesearchterm')
+    op.drop_table('messagesearchdocument')
+    op.drop_table('messagesearchindex')
+    op.drop_table('messagesearchindexcursor')
@@ -0,0 +1,23 @@
+"""Add Thread.summary
+
+Revision ID: 7c1b2e9d4f60
+Revises: 3bac7f8ccfdb
+Create Date: 2026-10-18 10:12:41.503317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c1b2e9d4f60'
+down_revision = '3bac7f8ccfdb'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('thread', sa.Column('summary', sa.Text(4194304),
+                                      nullable=True))
+
+
+def downgrade():
+    op.drop_column('thread', 'summary')
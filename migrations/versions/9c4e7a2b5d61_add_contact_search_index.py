@@ -0,0 +1,46 @@
+"""Add local contact search index
+
+Revision ID: 9c4e7a2b5d61
+Revises: 6b2d8e4f1a93
+Create Date: 2026-10-19 03:42:18.104862
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c4e7a2b5d61'
+down_revision = '6b2d8e4f1a93'
+
+from alembic import op, context
+import sqlalchemy as sa
+
+
+def upgrade():
+    shard_id = int(context.config.get_main_option('shard_id'))
+
+    op.create_table('contactsearchterm',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('term', sa.String(length=64,
+                                                collation='utf8mb4_bin'),
+                              nullable=False),
+                    sa.Column('contact_id', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.ForeignKeyConstraint(['contact_id'], [u'contact.id'],
+                                            ondelete='CASCADE'))
+    op.create_index('ix_contactsearchterm_created_at',
+                    'contactsearchterm', ['created_at'], unique=False)
+    op.create_index('ix_contactsearchterm_contact_id',
+                    'contactsearchterm', ['contact_id'], unique=False)
+    op.create_index('ix_contactsearchterm_namespace_id_term',
+                    'contactsearchterm', ['namespace_id', 'term'],
+                    unique=False)
+
+    conn = op.get_bind()
+    conn.execute('ALTER TABLE contactsearchterm AUTO_INCREMENT={}'.format(
+        (shard_id << 48) + 1))
+
+
+def downgrade():
+    op.drop_table('contactsearchterm')
@@ -43,6 +43,9 @@ setup(
              'bin/contact-search-service',
              'bin/contact-search-backfill',
              'bin/contact-search-delete-index',
+             'bin/contact-scores-service',
+             'bin/message-search-service',
+             'bin/message-search-backfill',
              'bin/backfix-generic-imap-separators.py',
              'bin/backfix-duplicate-categories.py',
              'bin/correct-autoincrements',
@@ -58,6 +61,8 @@ setup(
              'bin/balance-fleet',
              'bin/get-account-loads',
              'bin/restart-forgotten-accounts',
+             'bin/reconcile-counters',
+             'bin/backfill-thread-summaries',
              ],
 
     # See: